@@ -10,15 +10,30 @@ def do_setup():
     if __output_manager is None:
         __output_manager = output.OutputManager(sys.stdout)
 
+def configure(**kwargs):
+    """Set the options (see `output.OutputManager`) of the output that `show`
+    writes to stdout, e.g. `configure(delta=True)`.  Call this before the
+    first `show`."""
+    global __output_manager
+    if __output_manager is not None:
+        raise output.OutputStateError("output has already started")
+    __output_manager = output.OutputManager(sys.stdout, **kwargs)
+
 def _reset():
     # This is just for test cases that replace sys.stdout
     global __output_manager
     __output_manager = None
 
-def show(obj, var=None, api=None, metadata=None, _out=None):
+def show(obj, var=None, api=None, metadata=None, _out=None, sampling=None):
+    """Output a snapshot of `obj`, unless `sampling` (or else the output
+    manager's sampling policy) says to skip it."""
     if _out is None:
         do_setup()
         _out = __output_manager
+    if sampling is None:
+        sampling = _out.sampling
+    if sampling is not None and not sampling.should_show(obj):
+        return
     if api is None:
         api = visitors.DispatchVisitor
     visitor = api(_out)
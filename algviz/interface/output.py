@@ -1,26 +1,196 @@
+import collections
 import contextlib
+import hashlib
 import json
 import sys
-from algviz.parser import json_objects
+import threading
+from algviz.parser import binary, json_objects
 
 class OutputStateError(Exception):
     """For output operations that don't make sense given the state of the output"""
 
+_encode_str = json.encoder.encode_basestring_ascii
+
+def _encode_literal(lit):
+    """The same text as `json.dumps(lit)`, but quicker for the usual literals"""
+    cls = type(lit)
+    if cls is str:
+        return _encode_str(lit)
+    elif cls is int:
+        return int.__repr__(lit)
+    elif lit is None:
+        return "null"
+    elif cls is bool:
+        return "true" if lit else "false"
+    return json.dumps(lit)
+
+class _Writer:
+    """Writes the text of the contexts of one OutputManager straight to
+    `outfile`.  Don't work with this class directly."""
+    def __init__(self, outfile, compact=False):
+        self.outfile = outfile
+        self.compact = compact
+        self.key_separator = ":" if compact else ": "
+        self._indents = {}
+
+    def write(self, text):
+        self.outfile.write(text)
+
+    def newline(self, indent):
+        """Start a new line indented by `indent` spaces, unless compact"""
+        if not self.compact:
+            try:
+                text = self._indents[indent]
+            except KeyError:
+                text = self._indents[indent] = "\n" + " " * indent
+            self.write(text)
+
+    def flush(self):
+        pass
+
+    def end_snapshot(self):
+        """Called when a snapshot is complete"""
+        self.flush()
+
+    def close(self):
+        """Called after the last text has been written"""
+        self.flush()
+
+class _BufferedWriter(_Writer):
+    """Collects text in memory and writes it to `outfile` in chunks of at
+    least `buffer_size` characters, and whenever it's flushed."""
+    def __init__(self, outfile, compact=False, buffer_size=1 << 16):
+        super().__init__(outfile, compact=compact)
+        self.buffer_size = buffer_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.outfile.write("".join(self._parts))
+            self._parts.clear()
+            self._size = 0
+
+class _BackgroundWriter(_Writer):
+    """Collects the text of each snapshot in memory and hands it to a thread
+    that writes it to `outfile`, so writing never holds up the caller.
+
+    At most `max_pending` snapshots wait to be written.  When there are
+    more, `overflow` decides what happens: with "block", the caller waits
+    for the thread to catch up; with "drop_oldest", the oldest waiting
+    snapshot is thrown away (and counted in `dropped`).
+    """
+    OVERFLOW_POLICIES = ("block", "drop_oldest")
+
+    def __init__(self, outfile, compact=False, max_pending=16, overflow="block"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}, not {!r}"
+                             .format(self.OVERFLOW_POLICIES, overflow))
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1, not {!r}"
+                             .format(max_pending))
+        super().__init__(outfile, compact=compact)
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.dropped = 0
+        self._parts = []
+        # Appending is all the caller does for each piece of text
+        self.write = self._parts.append
+        # (text, droppable) pairs waiting for the thread
+        self._pending = collections.deque()
+        self._changed = threading.Condition()
+        self._closed = False
+        self._error = None
+        self._started = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="algviz-output-writer")
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._pending and not self._closed:
+                    self._changed.wait()
+                if not self._pending:
+                    return
+                text, _ = self._pending.popleft()
+                self._changed.notify_all()
+            try:
+                self.outfile.write(text)
+            except BaseException as e:
+                with self._changed:
+                    self._error = e
+                    self._pending.clear()
+                    self._closed = True
+                    self._changed.notify_all()
+                return
+
+    def _check_error(self):
+        if self._error is not None:
+            raise OutputStateError("the output writer thread failed") from self._error
+
+    def _put(self, droppable, overflow):
+        if not self._parts:
+            return
+        text = "".join(self._parts)
+        self._parts.clear()
+        with self._changed:
+            self._check_error()
+            while len(self._pending) >= self.max_pending:
+                if overflow == "drop_oldest" and self._drop_oldest():
+                    break
+                self._changed.wait()
+                self._check_error()
+            self._pending.append((text, droppable))
+            self._changed.notify_all()
+
+    def _drop_oldest(self):
+        # Drop the oldest whole snapshot waiting to be written, if any
+        for k, (_, droppable) in enumerate(self._pending):
+            if droppable:
+                del self._pending[k]
+                self.dropped += 1
+                return True
+        return False
+
+    def end_snapshot(self):
+        # The text of the first snapshot also opens the list of snapshots,
+        # so it must never be dropped.  Each later one starts with the
+        # comma that separates it from the one before.
+        self._put(droppable=self._started, overflow=self.overflow)
+        self._started = True
+
+    def close(self):
+        """Write everything that's left and wait for the thread to finish"""
+        # Never drop the last snapshot to make room for the end of the list
+        self._put(droppable=False, overflow="block")
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._thread.join()
+        self._check_error()
+
 class _OutputContext:
     """Don't work with this class directly.  Prefer to use OutputManager."""
-    def __init__(self, parent=None, outfile=sys.stdout):
+    def __init__(self, parent=None, outfile=sys.stdout, writer=None):
         self.parent = parent
         self.indent = 2 if parent is None else parent.indent + 2
         self.comma_needed = False
         self.outfile = outfile
+        if writer is None:
+            writer = _Writer(outfile) if parent is None else parent.writer
+        self.writer = writer
+        # Bound once here, since it's called for every token
+        self.write = writer.write
         self.closed = False
         self.cur_child = None
 
-    def write(self, text):
-        # if '\n' in text:
-        #     print("newline in next line: {!r}".format(text), file=sys.stderr)
-        print(text, end="", file=self.outfile)
-
     def begin(self):
         self.write(self.open_char)
 
@@ -32,7 +202,7 @@ class _OutputContext:
             if self.parent is not None:
                 self.parent.do_indent()
             else:
-                self.write("\n")
+                self.writer.newline(0)
         self.write(self.close_char)
         self.closed = True
 
@@ -45,7 +215,7 @@ class _OutputContext:
             self.cur_child  = None
 
     def do_indent(self):
-        self.write("\n" + (" " * self.indent))
+        self.writer.newline(self.indent)
 
     def comma_newline(self):
         self.end_child()
@@ -59,7 +229,7 @@ class _OutputContext:
 
     def write_literal(self, lit):
         """Write a str or int.  Could also do list or dict, I suppose."""
-        self.write(json.dumps(lit).strip("\n"))
+        self.write(_encode_literal(lit))
 
     def push_child(self, child_cls):
         if self.cur_child is not None:
@@ -81,14 +251,14 @@ class _DictOutputContext(_OutputContext):
                                    .format(key))
         self.keys_used.add(key)
         self.comma_newline()
-        self.write_literal(key)
-        self.write(": ")
-        self.write_literal(val)
+        self.write(_encode_literal(key))
+        self.write(self.writer.key_separator)
+        self.write(_encode_literal(val))
 
     def key_push(self, key, *args, **kwargs):
         self.comma_newline()
-        self.write_literal(key)
-        self.write(": ")
+        self.write(_encode_literal(key))
+        self.write(self.writer.key_separator)
         self.push_child(*args, **kwargs)
 
 class _ListOutputContext(_OutputContext):
@@ -97,7 +267,7 @@ class _ListOutputContext(_OutputContext):
     def item(self, val):
         """Add a literal to the list"""
         self.comma_newline()
-        self.write_literal(val)
+        self.write(_encode_literal(val))
 
     def item_push(self, *args, **kwargs):
         """Open a dict or list within this list"""
@@ -105,18 +275,258 @@ class _ListOutputContext(_OutputContext):
         self.push_child(*args, **kwargs)
 
 
+class _ValueContext:
+    """Builds a value in memory instead of writing text.  Has the same
+    interface as _OutputContext.  Don't work with this class directly.
+    Prefer to use BinaryOutputManager.
+    """
+    def __init__(self, parent=None, outfile=None):
+        self.parent = parent
+        self.outfile = outfile
+        self.closed = False
+        self.cur_child = None
+        self.value = self.empty()
+
+    def begin(self):
+        pass
+
+    def end(self):
+        if self.parent is not None:
+            assert not self.parent.closed, "parent block ended before this one did"
+        self.end_child()
+        self.closed = True
+        if self.parent is not None:
+            self.parent.child_ended(self)
+
+    def end_child(self):
+        if self.cur_child is not None and not self.cur_child.closed:
+            self.cur_child.end()
+            self.cur_child = None
+
+    def child_ended(self, child):
+        pass
+
+    def push_child(self, child_cls):
+        """Start a child block and return the (empty) value it builds"""
+        self.end_child()
+        self.cur_child = child_cls(parent=self, outfile=self.outfile)
+        self.cur_child.begin()
+        return self.cur_child.value
+
+class _DictValueContext(_ValueContext):
+    empty = dict
+
+    def _check_key(self, key):
+        if key in self.value:
+            raise OutputStateError("Key {!r} is a duplicate in this mapping"
+                                   .format(key))
+
+    def key_val(self, key, val):
+        self._check_key(key)
+        self.value[key] = val
+
+    def key_push(self, key, *args, **kwargs):
+        self._check_key(key)
+        self.value[key] = self.push_child(*args, **kwargs)
+
+class _ListValueContext(_ValueContext):
+    empty = list
+
+    def item(self, val):
+        self.value.append(val)
+
+    def item_push(self, *args, **kwargs):
+        self.value.append(self.push_child(*args, **kwargs))
+
+class _BinaryTraceContext(_ListValueContext):
+    """The outermost list of a binary trace.  Each snapshot is encoded and
+    written as soon as it ends, rather than being kept in memory."""
+    def begin(self):
+        binary.write_header(self.outfile)
+
+    def item_push(self, *args, **kwargs):
+        self.push_child(*args, **kwargs)
+
+    def child_ended(self, child):
+        binary.write_snapshot(self.outfile, child.value)
+
+def _flatten_objects(values):
+    """Return every object (dict with a uid) nested anywhere in `values`,
+    each with the objects directly inside it replaced by their uids."""
+    uid_key = json_objects.Tokens.UID
+    result = []
+    stack = list(reversed(values))
+    while stack:
+        obj = stack.pop()
+        skip = frozenset(json_objects.json_keys_to_skip(obj))
+        flat = {}
+        nested = []
+        for key, val in obj.items():
+            if key in skip:
+                pass
+            elif type(val) is dict and uid_key in val:
+                nested.append(val)
+                val = val[uid_key]
+            elif type(val) is list:
+                inner = [item for item in val if type(item) is dict]
+                if inner:
+                    nested.extend(inner)
+                    val = [item[uid_key] if type(item) is dict else item
+                           for item in val]
+            flat[key] = val
+        result.append(flat)
+        stack.extend(reversed(nested))
+    return result
+
+class _DeltaTraceContext(_ListOutputContext):
+    """The outermost list of a trace of delta snapshots.  Each snapshot is
+    built in memory, and only the objects that are new or changed since the
+    last snapshot are written, after a delta marker listing the uids that
+    have gone.  An array that only had a few cells replaced is written as a
+    patch of those cells.  The first snapshot is written in full.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # uid -> fingerprint of each object in the last snapshot
+        self.fingerprints = None
+        # uid -> each array in the last snapshot, as written
+        self.arrays = {}
+
+    def item_push(self, *args, **kwargs):
+        self.comma_newline()
+        self.push_child(*args, **kwargs)
+
+    def child_ended(self, child):
+        objects = _flatten_objects(child.value)
+        fingerprints = {}
+        arrays = {}
+        changed = []
+        old = self.fingerprints
+        for obj in objects:
+            uid = obj[json_objects.Tokens.UID]
+            fingerprint = hashlib.blake2b(
+                json.dumps(obj, separators=(",", ":")).encode(),
+                digest_size=16).digest()
+            fingerprints[uid] = fingerprint
+            if old is None or old.get(uid) != fingerprint:
+                patch = self._array_patch(obj, self.arrays.get(uid))
+                changed.append(obj if patch is None else patch)
+            if obj.get(json_objects.Tokens.TYPE) == json_objects.Tokens.ARRAY_T:
+                arrays[uid] = obj
+        if old is not None:
+            marker = {json_objects.Tokens.TYPE: json_objects.Tokens.DELTA_T}
+            removed = [uid for uid in old if uid not in fingerprints]
+            if removed:
+                marker[json_objects.Tokens.REMOVED] = removed
+            changed.insert(0, marker)
+        self.fingerprints = fingerprints
+        self.arrays = arrays
+        self._write_snapshot(changed)
+
+    @staticmethod
+    def _array_patch(obj, previous):
+        # A patch turning the array `previous` into `obj`, or None if they
+        # differ in more than a minority of their cells
+        Tokens = json_objects.Tokens
+        if (previous is None or obj.get(Tokens.TYPE) != Tokens.ARRAY_T or
+                previous.keys() != obj.keys()):
+            return None
+        for key, val in obj.items():
+            if key != Tokens.DATA and previous[key] != val:
+                return None
+        old_data, new_data = previous[Tokens.DATA], obj[Tokens.DATA]
+        if len(old_data) != len(new_data):
+            return None
+        cells = {}
+        limit = len(new_data) // 2
+        for i, (old_item, new_item) in enumerate(zip(old_data, new_data)):
+            # 1 == 1.0 == True, but they are written differently
+            if old_item != new_item or type(old_item) is not type(new_item):
+                cells[str(i)] = new_item
+                if len(cells) > limit:
+                    return None
+        return {Tokens.TYPE: Tokens.ARRAY_T, Tokens.UID: obj[Tokens.UID],
+                Tokens.SET: cells}
+
+    def _write_snapshot(self, objects):
+        # The same text as _ListOutputContext and _DictOutputContext write
+        indent = self.indent + 2
+        if self.writer.compact:
+            dump = lambda obj: json.dumps(obj, separators=(",", ":"))
+        else:
+            margin = "\n" + " " * indent
+            dump = lambda obj: json.dumps(obj, indent=2).replace("\n", margin)
+        self.write("[")
+        for k, obj in enumerate(objects):
+            if k:
+                self.write(",")
+            self.writer.newline(indent)
+            self.write(dump(obj))
+        if objects:
+            self.writer.newline(self.indent)
+        self.write("]")
+
 class OutputManager:
-    """Useful for outputting valid JSON without maintaining too much state."""
+    """Useful for outputting valid JSON without maintaining too much state.
+
+    By default the text is collected in memory and written to `outfile` in
+    large chunks, and at the end of every snapshot.  Pass `buffered=False`
+    to write each piece of text as it's produced.
+
+    With `background=True`, a separate thread does the writing, and
+    showing a snapshot only builds its text.  Up to `max_pending` finished
+    snapshots wait to be written, and `overflow` ("block" or "drop_oldest")
+    says what to do with any more.  `end` waits for everything to be
+    written.
+
+    With `compact=True`, the JSON has no indentation or newlines.
+    Otherwise it's indented, and the same however it's written.
+
+    `sampling` is an `algviz.interface.sampling.SamplingPolicy` that
+    `high_level.show` asks before showing each snapshot, or None to show
+    them all.
 
-    def __init__(self, outfile=sys.stdout):
+    With `delta=True`, every snapshot after the first is a delta snapshot
+    (see `json_objects.TraceDecoder`): objects that are unchanged since the
+    last snapshot aren't written again.  Changes are found by comparing a
+    fingerprint of each object, which doesn't include the objects inside
+    it, so a change deep inside a structure only rewrites what changed.  An
+    array with only a few new cells is written as a patch of those cells.
+    Delta snapshots can't be dropped, so `overflow` must be "block".
+    """
+    # Classes of the contexts for the list of snapshots, for dicts and for lists
+    _trace_context_cls = _ListOutputContext
+    _dict_context_cls = _DictOutputContext
+    _list_context_cls = _ListOutputContext
+
+    def __init__(self, outfile=sys.stdout, buffered=True, compact=False,
+                 background=False, max_pending=16, overflow="block",
+                 sampling=None, delta=False):
         # self._in_dict = False
         # self._in_list = True
         self.outfile = outfile
-        self.snapshot_ctx = _ListOutputContext(parent=None, outfile=outfile)
+        if delta:
+            if overflow != "block":
+                raise ValueError("delta snapshots depend on every snapshot"
+                                 " before them, so they can't be dropped")
+            # Snapshots are built in memory, then compared with the last one
+            self._trace_context_cls = _DeltaTraceContext
+            self._dict_context_cls = _DictValueContext
+            self._list_context_cls = _ListValueContext
+        if background:
+            self.writer = _BackgroundWriter(outfile, compact=compact,
+                                            max_pending=max_pending,
+                                            overflow=overflow)
+        elif buffered:
+            self.writer = _BufferedWriter(outfile, compact=compact)
+        else:
+            self.writer = _Writer(outfile, compact=compact)
+        self.snapshot_ctx = self._make_trace_context(outfile)
         self.context = self.snapshot_ctx
         self.context.begin()
         self.uids = set()
         self._next_key = None
+        self.sampling = sampling
     # The idea is that the user calls next_item repeatedly if in an array context,
     # or alternates calls to next_key and next_item if in a dict context.
     def next_key(self, key):
@@ -125,7 +535,7 @@ class OutputManager:
         if self._next_key is not None:
             raise OutputStateError("previous key ({}) not used when new key ({}) added"
                                    .format(self._next_key, key))
-        elif not isinstance(self.context, _DictOutputContext):
+        elif not isinstance(self.context, self._dict_context_cls):
             raise OutputStateError("cannot set a key ({}) in non-mapping context {}"
                                    .format(key, self.context))
         else:
@@ -142,7 +552,7 @@ class OutputManager:
         """Use this to append a literal (or JSON-encodable) value as the next
         item in the current context.
         """
-        if isinstance(self.context, _DictOutputContext):
+        if isinstance(self.context, self._dict_context_cls):
             # sneakily keep track of uids
             if (self._next_key == json_objects.Tokens.UID
                     or json_objects.aliases.get(self._next_key) == json_objects.Tokens.UID):
@@ -156,7 +566,7 @@ class OutputManager:
             self.context.item(val)
 
     def _push(self, *args, **kwargs):
-        if isinstance(self.context, _DictOutputContext):
+        if isinstance(self.context, self._dict_context_cls):
             self.context.key_push(self._use_key(), *args, **kwargs)
         else:
             self.context.item_push(*args, **kwargs)
@@ -175,26 +585,59 @@ class OutputManager:
         `OutputManager.context` field to its original value.
         """
         if mapping:
-            self._push(_DictOutputContext)
+            self._push(self._dict_context_cls)
         else:
-            self._push(_ListOutputContext)
+            self._push(self._list_context_cls)
         try:
             yield
         finally:
             self.context.end()
             self.context = self.context.parent
 
+    def _make_trace_context(self, outfile):
+        return self._trace_context_cls(parent=None, outfile=outfile,
+                                       writer=self.writer)
+
+    @contextlib.contextmanager
     def start_snapshot(self):
         """Write a snapshot.  Use as a context manager"""
         # if self.context is not self.snapshot_ctx:
         #     self.snapshot_ctx.cur_child.
         self.context = self.snapshot_ctx
-        return self.push(mapping=False)
+        # Each snapshot defines its own objects
+        self.uids = set()
+        try:
+            with self.push(mapping=False):
+                yield
+        finally:
+            self.writer.end_snapshot()
 
     def end(self):
         self.snapshot_ctx.end()
+        self.writer.close()
         self.outfile.flush()
         # print("", file=self.outfile)
 
     def current_snapshot(self):
         return self.snapshot_ctx.cur_child
+
+class BinaryOutputManager(OutputManager):
+    """Like OutputManager, but writes the compact binary format of
+    `algviz.parser.binary` to `outfile`, which must be opened in binary mode.
+
+    Each snapshot is built in memory and written when it ends.  The
+    `delta` and `background` options of OutputManager aren't supported.
+    """
+    _trace_context_cls = _BinaryTraceContext
+    _dict_context_cls = _DictValueContext
+    _list_context_cls = _ListValueContext
+
+    def __init__(self, *args, delta=False, background=False, **kwargs):
+        if delta or background:
+            raise ValueError("BinaryOutputManager can't write {} output"
+                             .format("delta" if delta else "background"))
+        super().__init__(*args, **kwargs)
+
+    def _make_trace_context(self, outfile):
+        # Encoded snapshots are written whole, so there is no text to buffer
+        return self._trace_context_cls(parent=None, outfile=outfile)
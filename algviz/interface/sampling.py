@@ -0,0 +1,82 @@
+"""Policies that decide which calls to `high_level.show` produce a snapshot.
+
+A policy is asked before anything is traversed, so a skipped call costs
+little more than the policy's own bookkeeping.  Give one to
+`OutputManager(sampling=...)` to apply it to every snapshot, or to
+`high_level.show(..., sampling=...)` for the calls at one place in the code.
+"""
+import abc
+import hashlib
+import time
+
+class SamplingPolicy(metaclass=abc.ABCMeta):
+
+    @abc.abstractmethod
+    def should_show(self, obj):
+        """Return True if the snapshot of `obj` should be output"""
+        return True
+
+class EveryNth(SamplingPolicy):
+    """Show the first call and every `n`th call after it"""
+
+    def __init__(self, n):
+        if n < 1:
+            raise ValueError("n must be at least 1, not {!r}".format(n))
+        self.n = n
+        self._countdown = 0
+
+    def should_show(self, obj):
+        if self._countdown:
+            self._countdown -= 1
+            return False
+        self._countdown = self.n - 1
+        return True
+
+class RateLimit(SamplingPolicy):
+    """Show at most `per_second` snapshots per second, by leaving at least
+    `1 / per_second` seconds between them.
+
+    `clock` is a function returning the time in seconds.
+    """
+
+    def __init__(self, per_second, clock=time.monotonic):
+        if per_second <= 0:
+            raise ValueError("per_second must be positive, not {!r}"
+                             .format(per_second))
+        self.interval = 1 / per_second
+        self.clock = clock
+        self._next_time = None
+
+    def should_show(self, obj):
+        now = self.clock()
+        if self._next_time is not None and now < self._next_time:
+            return False
+        self._next_time = now + self.interval
+        return True
+
+def repr_fingerprint(obj):
+    """A digest of `repr(obj)`, which is good enough for the built-in
+    containers and for objects whose `repr` shows their whole state."""
+    return hashlib.blake2b(repr(obj).encode(), digest_size=16).digest()
+
+class OnChange(SamplingPolicy):
+    """Show a snapshot only when the fingerprint of the object being shown
+    differs from the last time it was shown.
+
+    `fingerprint` is a function from the object to something comparable.
+    The default, `repr_fingerprint`, can't see changes to objects with the
+    default `repr`, so give a better function for those.
+    """
+
+    def __init__(self, fingerprint=repr_fingerprint):
+        self.fingerprint = fingerprint
+        self._last = None
+        self._shown = False
+
+    def should_show(self, obj):
+        current = self.fingerprint(obj)
+        if self._shown and current == self._last:
+            return False
+        self._last = current
+        self._shown = True
+        return True
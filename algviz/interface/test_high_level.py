@@ -5,7 +5,7 @@ from unittest import mock
 
 from . import visitors
 from .testutil import TempFileTestMixin
-from algviz.parser import json_objects
+from algviz.parser import json_objects, structures
 
 import contextlib
 
@@ -38,12 +38,37 @@ class HighLevelTestCase(TempFileTestMixin, unittest.TestCase):
         self.assertEqual(str(str_snapshot.names["stringname"]),
                          "mystring")
 
+    def test_configure(self):
+        mylist = [1, 2, 3]
+        with self.patched_high_level() as hl:
+            hl.configure(delta=True)
+            hl.show(mylist, "x")
+            mylist.append(4)
+            hl.show(mylist, "x")
+            with self.assertRaises(hl.output.OutputStateError):
+                hl.configure(compact=True)
+        text = self.read_tempfile()
+        self.assertEqual([list(s.names["x"]) for s in json_objects.reads(text)],
+                         [[1, 2, 3], [1, 2, 3, 4]])
+
     def test_string_snapshot(self):
         mylist = [1, 2, 3, 4, 5]
         with self.patched_high_level() as hl:
             text = hl.string_snapshot(mylist)
         self.assertIsInstance(text, str)
 
+    def test_output_passes_validation(self):
+        mylist = [True, 1, 2.5, None, "s", [False]]
+        with self.patched_high_level() as hl:
+            text = hl.string_snapshot(mylist, "x")
+        [snapshot] = json_objects.reads(text)
+        decoded = snapshot.names["x"]
+        self.assertEqual(list(decoded)[:3], [True, 1, 2.5])
+        self.assertIs(decoded[0], True)
+        self.assertIs(decoded[3], structures.Null)
+        self.assertEqual(str(decoded[4]), "s")
+        self.assertIs(decoded[5][0], False)
+
     def test_string_snapshot_matches_normal_snapshot(self):
         mylist = [1, 2, 3, 4, 5]
         with self.patched_high_level():
@@ -1,8 +1,13 @@
-import unittest
-import tempfile
 import contextlib
+import io
+import json
+import tempfile
+import threading
+import unittest
 
+from . import high_level
 from . import output
+from algviz.parser import binary, json_objects
 
 class OutputManagerTestCase(unittest.TestCase):
 
@@ -103,5 +108,266 @@ class OutputManagerTestCase(unittest.TestCase):
         self.tmpfile.seek(0)
         return self.tmpfile.read()
 
+class WriterModesTestCase(unittest.TestCase):
+
+    def _write(self, f, **kwargs):
+        outman = output.OutputManager(outfile=f, **kwargs)
+        for uid, data in [("a", [1, 2.5, "f\u00f6ur-a"]), ("b", [])]:
+            with outman.start_snapshot():
+                with outman.push():
+                    for key, val in [("uid", uid), ("type", "array"), ("var", uid)]:
+                        outman.next_key(key)
+                        outman.next_val(val)
+                    outman.next_key("data")
+                    with outman.push(mapping=False):
+                        for item in data:
+                            outman.next_val(item)
+                with outman.push():
+                    outman.next_key("uid")
+                    outman.next_val("f\u00f6ur-" + uid)
+                    outman.next_key("type")
+                    outman.next_val("string")
+                    outman.next_key("data")
+                    outman.next_val("f\u00f6ur")
+        outman.end()
+
+    def _text(self, **kwargs):
+        with tempfile.TemporaryFile("w+") as f:
+            self._write(f, **kwargs)
+            f.seek(0)
+            return f.read()
+
+    def test_buffered_output_matches_unbuffered(self):
+        self.assertEqual(self._text(buffered=True), self._text(buffered=False))
+
+    def test_compact_output(self):
+        text = self._text(compact=True)
+        self.assertNotIn("\n", text)
+        self.assertNotIn(": ", text)
+        self.assertEqual(json_objects.reads(text), json_objects.reads(self._text()))
+
+    def test_literals_match_json_dumps(self):
+        for lit in ["", "quote\" and \\", "\u00e9\n\U0001f600", 0, -12, 10**30,
+                    1.5, float("inf"), True, False, None, [1, "two"], {"k": 3}]:
+            with self.subTest(lit=lit):
+                self.assertEqual(output._encode_literal(lit), json.dumps(lit))
+
+    def test_buffer_is_flushed_after_each_snapshot(self):
+        with tempfile.TemporaryFile("w+") as f:
+            outman = output.OutputManager(outfile=f)
+            high_level.show([1, 2], _out=outman)
+            f.seek(0)
+            self.assertIn("[\n  [\n", f.read())
+
+class _GatedFile(io.StringIO):
+    """Blocks every write until `gate` is set"""
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def write(self, text):
+        self.gate.wait()
+        return super().write(text)
+
+class _BrokenFile(io.StringIO):
+    def write(self, text):
+        raise OSError("disk on fire")
+
+class BackgroundWriterTestCase(unittest.TestCase):
+
+    def _show_all(self, outman, count=10):
+        # Distinct lists, so each snapshot defines its own
+        lists = [[j] for j in range(count)]
+        for lst in lists:
+            high_level.show(lst, var="x", _out=outman)
+
+    def test_matches_foreground_output(self):
+        texts = []
+        for background in (False, True):
+            f = io.StringIO()
+            outman = output.OutputManager(outfile=f, background=background)
+            with outman.start_snapshot():
+                with outman.push():
+                    outman.next_key("uid")
+                    outman.next_val("s")
+                    outman.next_key("type")
+                    outman.next_val("string")
+                    outman.next_key("data")
+                    outman.next_val("\u00e9")
+            outman.end()
+            texts.append(f.getvalue())
+        self.assertEqual(texts[0], texts[1])
+
+    def test_end_waits_for_everything(self):
+        f = _GatedFile()
+        outman = output.OutputManager(outfile=f, background=True, max_pending=100)
+        self._show_all(outman)
+        self.assertEqual(f.getvalue(), "")
+        f.gate.set()
+        outman.end()
+        snapshots = json_objects.reads(f.getvalue())
+        self.assertEqual([s.names["x"][0] for s in snapshots], list(range(10)))
+
+    def test_drop_oldest(self):
+        f = _GatedFile()
+        outman = output.OutputManager(outfile=f, background=True, max_pending=2,
+                                      overflow="drop_oldest")
+        self._show_all(outman)
+        f.gate.set()
+        outman.end()
+        snapshots = json_objects.reads(f.getvalue())
+        self.assertEqual(len(snapshots) + outman.writer.dropped, 10)
+        self.assertGreater(outman.writer.dropped, 0)
+        # The newest snapshot always survives
+        self.assertEqual(snapshots[-1].names["x"][0], 9)
+
+    def test_block(self):
+        f = _GatedFile()
+        outman = output.OutputManager(outfile=f, background=True, max_pending=2)
+        shower = threading.Thread(target=self._show_all, args=(outman,))
+        shower.start()
+        shower.join(0.05)
+        self.assertTrue(shower.is_alive())
+        f.gate.set()
+        shower.join()
+        outman.end()
+        self.assertEqual(len(json_objects.reads(f.getvalue())), 10)
+
+    def test_write_errors_reach_the_caller(self):
+        outman = output.OutputManager(outfile=_BrokenFile(), background=True)
+        with self.assertRaisesRegex(output.OutputStateError, "writer thread failed"):
+            self._show_all(outman)
+            outman.end()
+
+    def test_invalid_overflow_policy(self):
+        with self.assertRaisesRegex(ValueError, "overflow"):
+            output.OutputManager(outfile=io.StringIO(), background=True,
+                                 overflow="explode")
+
+class DeltaOutputTestCase(unittest.TestCase):
+
+    def _trace(self, delta, steps):
+        f = io.StringIO()
+        outman = output.OutputManager(outfile=f, delta=delta)
+        for rows in steps():
+            high_level.show(rows, var="rows", _out=outman)
+        outman.end()
+        return f.getvalue()
+
+    def _steps(self):
+        rows = [[10 * i + j for j in range(3)] for i in range(4)]
+        yield rows
+        yield rows
+        rows[1][0] = -1
+        yield rows
+        rows[3].append("new")
+        del rows[2]
+        yield rows
+
+    def assertSameTrace(self, delta_text, full_text):
+        self.assertEqual(
+            [[list(row) for row in s.names["rows"]]
+             for s in json_objects.reads(delta_text)],
+            [[list(row) for row in s.names["rows"]]
+             for s in json_objects.reads(full_text)])
+
+    def test_decodes_like_full_snapshots(self):
+        delta_text = self._trace(True, self._steps)
+        self.assertSameTrace(delta_text, self._trace(False, self._steps))
+        # Both formats can be read without validation too
+        self.assertEqual(len(json_objects.reads(delta_text, trusted=True)), 4)
+
+    def test_only_changes_are_written(self):
+        raw = json.loads(self._trace(True, self._steps))
+        markers = [snapshot[0] for snapshot in raw[1:]]
+        self.assertEqual([marker["type"] for marker in markers], ["delta"] * 3)
+        # Nothing changed in the second snapshot
+        self.assertEqual(raw[1], [{"type": "delta"}])
+        # Just the changed cell of the changed row in the third
+        self.assertEqual([(obj["type"], obj["set"]) for obj in raw[2][1:]],
+                         [("array", {"0": -1})])
+        # A row and the string added to it are new; another row is gone
+        self.assertEqual(len(markers[2]["removed"]), 1)
+        self.assertEqual(sorted(obj["type"] for obj in raw[3][1:]),
+                         ["array", "array", "string"])
+
+    def _cell_steps(self):
+        data = list(range(1000))
+        rows = [[1, 2], [3, 4]]
+        both = [data, rows]
+        for step in range(4):
+            data[step * 7] = -step
+            if step == 2:
+                rows[1] = ["new", True]
+            yield both
+
+    def test_array_patches(self):
+        delta_text = self._trace(True, self._cell_steps)
+        full_text = self._trace(False, self._cell_steps)
+        raw = json.loads(delta_text)
+        # The cells each patch sets, and how many objects are written in full
+        self.assertEqual([([list(obj["set"]) for obj in snapshot[1:] if "set" in obj],
+                           len([obj for obj in snapshot[1:] if "set" not in obj]))
+                          for snapshot in raw[1:]],
+                         [([["7"]], 0), ([["14"], ["1"]], 2), ([["21"]], 0)])
+        self.assertLess(len(delta_text) * 3, len(full_text))
+        def describe(snapshot):
+            data, rows = snapshot.names["rows"]
+            return list(data), [list(row) for row in rows]
+        self.assertEqual([describe(s) for s in json_objects.reads(delta_text)],
+                         [describe(s) for s in json_objects.reads(full_text)])
+
+    def test_compact(self):
+        f = io.StringIO()
+        outman = output.OutputManager(outfile=f, delta=True, compact=True)
+        for rows in self._steps():
+            high_level.show(rows, var="rows", _out=outman)
+        outman.end()
+        self.assertNotIn("\n", f.getvalue())
+        self.assertSameTrace(f.getvalue(), self._trace(False, self._steps))
+
+    def test_deltas_cannot_be_dropped(self):
+        with self.assertRaises(ValueError):
+            output.OutputManager(outfile=io.StringIO(), delta=True,
+                                 background=True, overflow="drop_oldest")
+
+class BinaryOutputManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpfile = tempfile.TemporaryFile("w+b")
+        self.outman = output.BinaryOutputManager(outfile=self.tmpfile)
+
+    def tearDown(self):
+        self.tmpfile.close()
+
+    def test_rejects_unsupported_options(self):
+        for option in ("delta", "background"):
+            with self.subTest(option=option):
+                with self.assertRaisesRegex(ValueError, option):
+                    output.BinaryOutputManager(outfile=self.tmpfile, **{option: True})
+
+    def test_matches_json_output(self):
+        objects = [([1, 2, [3, "four"]], "mylist"), ("a string", "mystr")]
+        with tempfile.TemporaryFile("w+") as json_file:
+            json_outman = output.OutputManager(outfile=json_file)
+            for outman in (self.outman, json_outman):
+                for obj, var in objects:
+                    high_level.show(obj, var=var, _out=outman)
+                outman.end()
+            json_file.seek(0)
+            expected = json_objects.read(json_file)
+        self.tmpfile.seek(0)
+        self.assertEqual(binary.load(self.tmpfile), expected)
+
+    def test_error_for_duplicate_key(self):
+        with self.assertRaisesRegex(output.OutputStateError,
+                                     "Key .data. is a duplicate.*"):
+            with self.outman.start_snapshot():
+                with self.outman.push():
+                    self.outman.next_key("data")
+                    self.outman.next_val(1)
+                    self.outman.next_key("data")
+                    self.outman.next_val(2)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+import io
+import unittest
+from unittest import mock
+
+from . import high_level, output, sampling
+from algviz.parser import json_objects
+
+class PolicyTestCase(unittest.TestCase):
+
+    def _pattern(self, policy, objects):
+        return [policy.should_show(obj) for obj in objects]
+
+    def test_every_nth(self):
+        self.assertEqual(self._pattern(sampling.EveryNth(3), range(7)),
+                         [True, False, False, True, False, False, True])
+        self.assertEqual(self._pattern(sampling.EveryNth(1), range(3)),
+                         [True, True, True])
+        with self.assertRaises(ValueError):
+            sampling.EveryNth(0)
+
+    def test_rate_limit(self):
+        times = iter([0.0, 0.1, 0.49, 0.5, 0.7, 1.2])
+        policy = sampling.RateLimit(2, clock=lambda: next(times))
+        self.assertEqual(self._pattern(policy, range(6)),
+                         [True, False, False, True, False, True])
+        with self.assertRaises(ValueError):
+            sampling.RateLimit(0)
+
+    def test_on_change(self):
+        policy = sampling.OnChange()
+        mylist = [1, 2]
+        shown = []
+        for change in [None, None, 3, None, 4]:
+            if change is not None:
+                mylist.append(change)
+            shown.append(policy.should_show(mylist))
+        self.assertEqual(shown, [True, False, True, False, True])
+
+    def test_on_change_with_custom_fingerprint(self):
+        policy = sampling.OnChange(fingerprint=len)
+        self.assertEqual(self._pattern(policy, ["ab", "cd", "abc"]),
+                         [True, False, True])
+
+class SampledShowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.outfile = io.StringIO()
+
+    def _snapshots(self, outman):
+        outman.end()
+        return json_objects.reads(self.outfile.getvalue())
+
+    def test_manager_policy(self):
+        outman = output.OutputManager(self.outfile, sampling=sampling.EveryNth(4))
+        mylist = []
+        for j in range(10):
+            mylist.append(j)
+            high_level.show(mylist, var="x", _out=outman)
+        self.assertEqual([len(s.names["x"]) for s in self._snapshots(outman)],
+                         [1, 5, 9])
+
+    def test_show_policy_overrides_manager_policy(self):
+        outman = output.OutputManager(self.outfile, sampling=sampling.EveryNth(4))
+        policy = sampling.OnChange()
+        for obj in ["a", "a", "b", "b", "a"]:
+            high_level.show(obj, var="x", _out=outman, sampling=policy)
+        self.assertEqual([str(s.names["x"]) for s in self._snapshots(outman)],
+                         ["a", "b", "a"])
+
+    def test_skipped_calls_do_not_traverse(self):
+        outman = output.OutputManager(self.outfile, sampling=sampling.EveryNth(3))
+        api = mock.MagicMock()
+        for j in range(5):
+            high_level.show(j, _out=outman, api=api)
+        self.assertEqual(api.return_value.traverse.call_count, 2)
+
+    def test_same_object_in_every_snapshot(self):
+        # Each snapshot must define the object again, not just refer to it
+        outman = output.OutputManager(self.outfile)
+        mylist = [1, 2]
+        for _ in range(3):
+            high_level.show(mylist, var="x", _out=outman)
+        self.assertEqual([list(s.names["x"]) for s in self._snapshots(outman)],
+                         [[1, 2]] * 3)
+
+if __name__ == "__main__":
+    unittest.main()
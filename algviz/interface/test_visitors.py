@@ -83,6 +83,37 @@ class WidgetVisitorTestCase(VisitorTestCaseMixin, unittest.TestCase):
     def sample_instance(self):
         return object()
 
+class DispatchVisitorTestCase(VisitorTestCaseMixin, unittest.TestCase):
+    visitor_cls = visitors.DispatchVisitor
+
+    def sample_instance(self):
+        return [1, 2, 3]
+
+    def test_one_visitor_per_class(self):
+        first = self.visitor._visitor_for(1)
+        self.assertIsInstance(first, visitors.NumberVisitor)
+        self.assertIs(self.visitor._visitor_for(2), first)
+        self.assertIsInstance(self.visitor._visitor_for(True), visitors.NumberVisitor)
+        self.assertIsNot(self.visitor._visitor_for(True), first)
+
+    def test_changes_to_dispatch_dict_are_seen(self):
+        self.visitor._visitor_for(7)
+        self.visitor.dispatch_dict[int] = visitors.WidgetVisitor
+        self.assertIsInstance(self.visitor._visitor_for(7), visitors.WidgetVisitor)
+        self.visitor.dispatch_dict.update({int: visitors.NumberVisitor})
+        self.assertIsInstance(self.visitor._visitor_for(7), visitors.NumberVisitor)
+        # With nothing left to handle ints
+        self.visitor.dispatch_dict = {str: visitors.StringVisitor}
+        self.assertIsNone(self.visitor._visitor_for(7))
+
+    def test_instances_do_not_share_dispatch_dicts(self):
+        other = visitors.DispatchVisitor(self.output_mngr,
+                                         updates={int: visitors.WidgetVisitor})
+        self.assertIsInstance(other._visitor_for(7), visitors.WidgetVisitor)
+        self.assertIsInstance(self.visitor._visitor_for(7), visitors.NumberVisitor)
+        self.assertNotIn(int, [t for t, cls in visitors._dispatch_visit_dict.items()
+                               if cls is visitors.WidgetVisitor])
+
 class ArrayVisitorTestCase(VisitorTestCaseMixin, unittest.TestCase):
     visitor_cls = visitors.ArrayVisitor
 
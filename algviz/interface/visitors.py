@@ -60,6 +60,49 @@ class Visitor(metaclass=abc.ABCMeta):
             self.output_mngr.next_val(var)
 
 
+class _DispatchDict(dict):
+    """A dict of visitor classes that counts how many times it has been
+    changed, so anything cached from it can tell when it's out of date."""
+    version = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def pop(self, *args):
+        try:
+            return super().pop(*args)
+        finally:
+            self.version += 1
+
+    def popitem(self):
+        try:
+            return super().popitem()
+        finally:
+            self.version += 1
+
+    def setdefault(self, *args):
+        try:
+            return super().setdefault(*args)
+        finally:
+            self.version += 1
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
 class DispatchVisitor(Visitor):
     """Handle objects with a default handler.  Useful when data stored is of mixed types.
 
@@ -70,6 +113,9 @@ class DispatchVisitor(Visitor):
     By default, the handlers are given in `_dispatch_visit_dict`.  The
     `updates` keyword argument to `__init__` is used to modify the instance's
     copy of that dictionary for more customized behavior.
+
+    One visitor instance is made for each class of object, the first time an
+    object of that class is seen.  Changing `dispatch_dict` starts over.
     """
 
     def __init__(self, output_mngr, updates=None, **kwargs):
@@ -77,25 +123,54 @@ class DispatchVisitor(Visitor):
         # created.  So we must use `self` instead to prevent a crash.
         kwargs.setdefault("data_visitor", self)
         super().__init__(output_mngr, **kwargs)
-        self.dispatch_dict = _dispatch_visit_dict.copy()
+        self.dispatch_dict = _dispatch_visit_dict
         if updates is not None:
             # This lets us do interesting things like choose non-default handlers for some data structure.  E.g. assume a `list` instance represents a heap
             self.dispatch_dict.update(updates)
 
+    @property
+    def dispatch_dict(self):
+        return self._dispatch_dict
+
+    @dispatch_dict.setter
+    def dispatch_dict(self, handlers):
+        # Always a copy, so changes to it can be seen
+        self._dispatch_dict = _DispatchDict(handlers)
+        self._visitors = {}
+        self._visitors_version = self._dispatch_dict.version
+
+    def _visitor_for(self, obj):
+        # The visitor instance for objects of this class, or None if nothing
+        # handles them
+        cls = type(obj)
+        if self._visitors_version != self._dispatch_dict.version:
+            self._visitors = {}
+            self._visitors_version = self._dispatch_dict.version
+        try:
+            return self._visitors[cls]
+        except KeyError:
+            pass
+        visitor = None
+        for superclass in cls.mro():
+            if superclass in self._dispatch_dict:
+                visitor = self._dispatch_dict[superclass](self.output_mngr, data_visitor=self)
+                break
+        self._visitors[cls] = visitor
+        return visitor
+
     def _dispatch_method(self, methodname, obj, *args, **kwargs):
         # Call the named method on the appropriate visitor subclass
-        for superclass in type(obj).mro():
-            if superclass in self.dispatch_dict:
-                # Get an appropriate visitor
-                visitor = self.dispatch_dict[superclass](self.output_mngr, data_visitor=self)
-                # Call the desired method on that visitor
-                return getattr(visitor, methodname)(obj, *args, **kwargs)
+        visitor = self._visitor_for(obj)
+        if visitor is not None:
+            return getattr(visitor, methodname)(obj, *args, **kwargs)
 
     def uid(self, obj, **kwargs):
         return self._dispatch_method("uid", obj, **kwargs)
 
     def traverse(self, obj, *args, **kwargs):
-        return self._dispatch_method("traverse", obj, *args, **kwargs)
+        visitor = self._visitor_for(obj)
+        if visitor is not None:
+            return visitor.traverse(obj, *args, **kwargs)
 
     def visit(self, obj, *args, **kwargs):
         return self._dispatch_method("visit", obj, *args, **kwargs)
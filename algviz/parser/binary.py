@@ -0,0 +1,377 @@
+"""A compact binary encoding of algviz traces.
+
+The binary format carries exactly the same objects as the JSON format, so
+decoding it gives the same `structures.Snapshot`s.  It is much smaller,
+mostly because strings are interned, small integers fit in one byte, and
+there is no whitespace.  It is not faster to decode: the parser is pure
+Python, and building the snapshots costs the same for both formats.
+
+Layout:
+
+* The file starts with `MAGIC`.
+* Then there is one record per snapshot.  A record is the length of its
+  payload (a varint) followed by the payload, so a reader can skip snapshots
+  without decoding them.
+* A payload is a single value: the list of objects in the snapshot.
+
+Every value starts with a tag byte:
+
+* `0x80 | n` is the integer `n`, for 0 <= n < 128.
+* `0x40 | n` is entry `n` of the string table, for n < 64.
+* The other tags are listed in `_Tags`.
+
+Each snapshot has its own string table, so snapshots can be decoded
+independently.  The table starts out holding `_PRESET_STRINGS`, and each
+string spelled out in full (`_Tags.STR`) is appended to it.
+
+Varints are unsigned LEB128.  Signed integers are zigzag-encoded first.
+"""
+
+import array
+import itertools
+import struct
+import sys
+
+from . import json_objects
+from .json_objects import Tokens
+
+MAGIC = b"ALGVIZB\x01"
+
+class _Tags:
+    NONE = 0x00
+    FALSE = 0x01
+    TRUE = 0x02
+    INT = 0x03  # zigzag varint
+    FLOAT = 0x04  # little-endian IEEE 754 double
+    STR = 0x05  # varint byte length, then UTF-8; added to the string table
+    STR_REF = 0x06  # varint index into the string table
+    LIST = 0x07  # varint item count, then the items
+    DICT = 0x08  # varint pair count, then alternating keys and values
+    INT_LIST = 0x09  # varint item count, typecode byte, little-endian ints
+    # Tags 0x40 and up hold small string references and small integers
+    SMALL_STR_REF = 0x40
+    SMALL_INT = 0x80
+
+_SMALL_STR_LIMIT = 0x40
+_SMALL_INT_LIMIT = 0x80
+
+# The strings every snapshot table starts with.  Only ever append to this
+# tuple; reordering it would break existing files.
+_PRESET_STRINGS = (
+    Tokens.UID, Tokens.TYPE, Tokens.FROM, Tokens.TO, Tokens.CHILDREN,
+    Tokens.DATA, Tokens.GRAPH_NODES, Tokens.GRAPH_EDGES, Tokens.VARNAME,
+    Tokens.METADATA,
+    Tokens.ARRAY_T, Tokens.TREE_NODE_T, Tokens.EDGE_T, Tokens.GRAPH_T,
+    Tokens.NODE_T, Tokens.NULL_T, Tokens.POINTER_T, Tokens.STRING_T,
+    Tokens.WIDGET_T,
+    Tokens.DELTA_T, Tokens.REMOVED,
+    Tokens.SET,
+)
+
+_double = struct.Struct("<d")
+
+# Lists of at least this many ints are packed with `_Tags.INT_LIST`, using
+# the first of these `array` typecodes that is wide enough.
+_MIN_INT_LIST = 4
+_INT_TYPECODES = [(code, -2 ** (8 * size - 1), 2 ** (8 * size - 1))
+                  for code, size in [("b", 1), ("h", 2), ("i", 4), ("q", 8)]
+                  if array.array(code).itemsize == size]
+_BIG_ENDIAN = sys.byteorder == "big"
+
+def _int_typecode(items):
+    """Return the typecode for packing `items`, or None if they aren't all
+    (non-bool) ints of a packable size."""
+    if len(items) < _MIN_INT_LIST:
+        return None
+    for item in items:
+        if type(item) is not int:
+            return None
+    low, high = min(items), max(items)
+    for code, min_val, max_val in _INT_TYPECODES:
+        if min_val <= low and high < max_val:
+            return code
+    return None
+
+class BinaryFormatError(json_objects.JSONObjectError):
+    pass
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _truncated(pos):
+    return BinaryFormatError("value truncated at position {}".format(pos))
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise _truncated(pos)
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def encode_value(value, out=None):
+    """Append the encoding of a JSON-compatible `value` (e.g. the list of raw
+    objects in a snapshot) to the bytearray `out` and return `out`.
+
+    Uses a fresh string table, i.e. `value` is encoded as one payload.
+    """
+    if out is None:
+        out = bytearray()
+    table = {string: i for i, string in enumerate(_PRESET_STRINGS)}
+    # Each stack entry is an iterator over the items still to be written
+    stack = [iter((value,))]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, str):
+                index = table.get(item)
+                if index is None:
+                    table[item] = len(table)
+                    encoded = item.encode("utf-8")
+                    out.append(_Tags.STR)
+                    _write_varint(out, len(encoded))
+                    out += encoded
+                elif index < _SMALL_STR_LIMIT:
+                    out.append(_Tags.SMALL_STR_REF | index)
+                else:
+                    out.append(_Tags.STR_REF)
+                    _write_varint(out, index)
+            elif item is True:
+                out.append(_Tags.TRUE)
+            elif item is False:
+                out.append(_Tags.FALSE)
+            elif isinstance(item, int):
+                if 0 <= item < _SMALL_INT_LIMIT:
+                    out.append(_Tags.SMALL_INT | item)
+                else:
+                    out.append(_Tags.INT)
+                    _write_varint(out, (item << 1) if item >= 0 else ((-item << 1) - 1))
+            elif isinstance(item, float):
+                out.append(_Tags.FLOAT)
+                out += _double.pack(item)
+            elif item is None:
+                out.append(_Tags.NONE)
+            elif isinstance(item, (list, tuple)):
+                typecode = _int_typecode(item)
+                if typecode is not None:
+                    packed = array.array(typecode, item)
+                    if _BIG_ENDIAN:
+                        packed.byteswap()
+                    out.append(_Tags.INT_LIST)
+                    _write_varint(out, len(item))
+                    out += typecode.encode("ascii")
+                    out += packed.tobytes()
+                    continue
+                out.append(_Tags.LIST)
+                _write_varint(out, len(item))
+                stack.append(iter(item))
+                break
+            elif isinstance(item, dict):
+                out.append(_Tags.DICT)
+                _write_varint(out, len(item))
+                stack.append(itertools.chain.from_iterable(item.items()))
+                break
+            else:
+                raise TypeError("{!r} can't be encoded".format(item))
+        else:
+            stack.pop()
+    return out
+
+_NO_KEY = object()
+
+def decode_value(buf, pos=0, object_hook=json_objects.fix_aliases):
+    """Decode the value that starts at `buf[pos]`, using a fresh string table.
+
+    Returns `(value, position after the value)`.  `object_hook` is called on
+    every dict, as with `json.loads`.  Raises `BinaryFormatError` if the value
+    is truncated or malformed.
+    """
+    try:
+        return _decode_value(buf, pos, object_hook)
+    except IndexError:
+        # Only the tag reads and the small string references aren't checked
+        raise BinaryFormatError("truncated value or invalid string reference")
+    except (TypeError, ValueError) as e:
+        # An unhashable dict key, an unknown INT_LIST typecode or invalid UTF-8
+        raise BinaryFormatError("malformed value: {}".format(e))
+
+def _decode_value(buf, pos, object_hook):
+    table = list(_PRESET_STRINGS)
+    # Local names for speed
+    SMALL_INT, SMALL_STR_REF = _Tags.SMALL_INT, _Tags.SMALL_STR_REF
+    STR, LIST, DICT, INT_LIST = _Tags.STR, _Tags.LIST, _Tags.DICT, _Tags.INT_LIST
+    no_key = _NO_KEY
+    # Each frame is [container, items remaining, pending dict key]
+    stack = []
+    while True:
+        tag = buf[pos]
+        pos += 1
+        if tag >= SMALL_INT:
+            val = tag & 0x7F
+        elif tag >= SMALL_STR_REF:
+            val = table[tag & 0x3F]
+        elif tag == STR:
+            length, pos = _read_varint(buf, pos)
+            end = pos + length
+            if end > len(buf):
+                raise _truncated(pos)
+            val = str(buf[pos:end], "utf-8")
+            table.append(val)
+            pos = end
+        elif tag == DICT or tag == LIST:
+            count, pos = _read_varint(buf, pos)
+            container = {} if tag == DICT else []
+            if count:
+                stack.append([container, count, no_key])
+                continue
+            val = container if tag == LIST else object_hook(container)
+        elif tag == INT_LIST:
+            count, pos = _read_varint(buf, pos)
+            packed = array.array(chr(buf[pos]))
+            end = pos + 1 + count * packed.itemsize
+            if end > len(buf):
+                raise _truncated(pos)
+            packed.frombytes(buf[pos + 1:end])
+            if _BIG_ENDIAN:
+                packed.byteswap()
+            val = packed.tolist()
+            pos = end
+        else:
+            val, pos = _decode_rare(tag, buf, pos, table)
+        # Put `val` in its container, closing every container that fills up
+        while stack:
+            frame = stack[-1]
+            container = frame[0]
+            if type(container) is list:
+                container.append(val)
+            elif frame[2] is no_key:
+                frame[2] = val
+                break
+            else:
+                container[frame[2]] = val
+                frame[2] = no_key
+            frame[1] -= 1
+            if frame[1]:
+                break
+            stack.pop()
+            val = container if type(container) is list else object_hook(container)
+        else:
+            return val, pos
+
+def _decode_rare(tag, buf, pos, table):
+    # Decode the less common scalar types for decode_value
+    if tag == _Tags.INT:
+        n, pos = _read_varint(buf, pos)
+        return ((n >> 1) if not n & 1 else -((n + 1) >> 1)), pos
+    elif tag == _Tags.STR_REF:
+        index, pos = _read_varint(buf, pos)
+        if index >= len(table):
+            raise BinaryFormatError("invalid string reference {} at position {}"
+                                    .format(index, pos))
+        return table[index], pos
+    elif tag == _Tags.FLOAT:
+        if pos + 8 > len(buf):
+            raise _truncated(pos)
+        return _double.unpack_from(buf, pos)[0], pos + 8
+    elif tag == _Tags.NONE:
+        return None, pos
+    elif tag == _Tags.TRUE:
+        return True, pos
+    elif tag == _Tags.FALSE:
+        return False, pos
+    raise BinaryFormatError("invalid tag {:#x} at position {}".format(tag, pos - 1))
+
+def write_header(file_obj):
+    file_obj.write(MAGIC)
+
+def write_snapshot(file_obj, raw_snapshot):
+    """Write the record for one snapshot, given as a list of raw JSON objects"""
+    payload = encode_value(raw_snapshot)
+    record = bytearray()
+    _write_varint(record, len(payload))
+    file_obj.write(bytes(record + payload))
+
+def dumps(raw_trace):
+    """Encode a list of snapshots, each a list of raw JSON objects"""
+    out = bytearray(MAGIC)
+    for raw_snapshot in raw_trace:
+        payload = encode_value(raw_snapshot)
+        _write_varint(out, len(payload))
+        out += payload
+    return bytes(out)
+
+def iter_payloads(file_obj):
+    """Yield the undecoded payload of each snapshot in a binary trace"""
+    if file_obj.read(len(MAGIC)) != MAGIC:
+        raise BinaryFormatError("not a binary algviz trace")
+    while True:
+        prefix = bytearray()
+        while True:
+            byte = file_obj.read(1)
+            if not byte:
+                if prefix:
+                    raise BinaryFormatError("trace ends in the middle of a record length")
+                return
+            prefix += byte
+            if byte[0] < 0x80:
+                break
+        length, _ = _read_varint(prefix, 0)
+        payload = file_obj.read(length)
+        if len(payload) != length:
+            raise BinaryFormatError("trace ends in the middle of a snapshot")
+        yield payload
+
+def _no_hook(obj):
+    return obj
+
+def parse_payload(payload, trusted=False):
+    """Decode the raw JSON objects of one snapshot, and validate them unless
+    `trusted` is true (see `json_objects.decode_json`)"""
+    raw_snapshot, end = decode_value(
+        payload, object_hook=_no_hook if trusted else json_objects.fix_aliases)
+    if end != len(payload):
+        raise BinaryFormatError("snapshot payload has {} extra bytes"
+                                .format(len(payload) - end))
+    if not trusted:
+        json_objects.validate_snapshot(raw_snapshot)
+    return raw_snapshot
+
+def decode_payload(payload, decoder=None, trusted=False):
+    """Decode one snapshot.  A delta snapshot needs the `TraceDecoder` that
+    decoded the snapshots before it."""
+    if decoder is None:
+        decoder = json_objects.TraceDecoder()
+    return decoder.decode(parse_payload(payload, trusted=trusted))
+
+def iter_snapshots(file_obj, trusted=False):
+    """Decode the snapshots of a binary trace one at a time"""
+    decoder = json_objects.TraceDecoder()
+    for payload in iter_payloads(file_obj):
+        yield decode_payload(payload, decoder, trusted=trusted)
+
+def load(file_obj, trusted=False):
+    return list(iter_snapshots(file_obj, trusted=trusted))
+
+def loads(data, trusted=False):
+    """Decode all the snapshots in a binary trace held in `data`"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise BinaryFormatError("not a binary algviz trace")
+    buf = memoryview(data)
+    pos = len(MAGIC)
+    decoder = json_objects.TraceDecoder()
+    snapshots = []
+    while pos < len(buf):
+        length, pos = _read_varint(buf, pos)
+        if pos + length > len(buf):
+            raise BinaryFormatError("trace ends in the middle of a snapshot")
+        snapshots.append(decoder.decode(
+            parse_payload(buf[pos:pos + length], trusted=trusted)))
+        pos += length
+    return snapshots
@@ -1,4 +1,13 @@
+import array
+import collections
+import concurrent.futures
+import copy
+import functools
+import itertools
 import json
+import os
+import re
+import sys
 from . import structures
 import logging
 logger = logging.getLogger(__name__)
@@ -16,9 +25,12 @@ class Tokens:
     GRAPH_EDGES = "edges"
     VARNAME = "var"
     METADATA = "metadata"  # we probably should only use this for prototyping
+    REMOVED = "removed"  # uids dropped by a delta snapshot
+    SET = "set"  # the cells an array patch in a delta snapshot changes
     # Possible values for TYPE.  Keep these alphabetized and give them all the
     # _T suffix, please.
     ARRAY_T = "array"
+    DELTA_T = "delta"  # marks a delta snapshot; see `TraceDecoder`
     TREE_NODE_T = "treenode"
     EDGE_T = "edge"
     GRAPH_T = "graph"
@@ -81,10 +93,14 @@ class SnapshotDecoder(metaclass=Dispatcher):
     """Decodes a list of json objects and eventually produces a snapshot with
     the `finalize` method.
     """
-    def __init__(self):
+    def __init__(self, auto_uid_prefix="#"):
         self.table = structures.ObjectTable()
         self.namespace = {}
+        # Automatic uids are the prefix followed by a count
+        self.auto_uid_prefix = auto_uid_prefix
         self._next_auto_uid = 0
+        # One shared reference per uid, rather than one per occurrence
+        self._refs = {}
 
     def _auto_uid(self, type_=None):
         # Produce a suitable UID if the user didn't specify one.
@@ -92,31 +108,37 @@ class SnapshotDecoder(metaclass=Dispatcher):
             return structures.Null.uid
         else:
             # Guaranteed unique because user-supplied tokens may not contain "#"
-            result = "#{}".format(self._next_auto_uid)
+            result = "{}{}".format(self.auto_uid_prefix, self._next_auto_uid)
             self._next_auto_uid += 1
             return result
 
     def obj_decode(self, obj):
         if isinstance(obj, str):
-            return structures.ObjectTableReference(uid=obj)
+            ref = self._refs.get(obj)
+            if ref is None:
+                ref = self._refs[obj] = structures.ObjectTableReference(sys.intern(obj))
+            return ref
         elif isinstance(obj, (list, float, int)):
             # note that we may return a structures.Array if obj is a dict with "type": "array"
             return obj
         elif not isinstance(obj, dict):
             raise TypeError("Expected a dict but got {!r}".format(obj))
         # call the appropriate method for the type of the thing
-        ref = structures.ObjectTableReference(
-            obj.get(Tokens.UID, self._auto_uid(type_=obj.get(Tokens.TYPE))))
+        uid = sys.intern(obj[Tokens.UID] if Tokens.UID in obj
+                         else self._auto_uid(type_=obj.get(Tokens.TYPE)))
         # assert isinstance(obj[Tokens.TYPE], str), obj  # Should happen during validation
-        self.table[ref] = self._dispatch(obj[Tokens.TYPE])(
-            obj, uid=ref.uid, metadata=obj.get(Tokens.METADATA))
+        result = self.table[uid] = self._dispatch(obj[Tokens.TYPE])(
+            obj, uid=uid, metadata=obj.get(Tokens.METADATA))
         if Tokens.VARNAME in obj:
-            self.namespace[obj[Tokens.VARNAME]] = ref
-        return self.table[ref]
+            self.namespace[obj[Tokens.VARNAME]] = uid
+            self.table.index_var(obj[Tokens.VARNAME], uid)
+        return result
 
     @Dispatcher.dispatch(Tokens.ARRAY_T)
     def array_decode(self, array, **kwargs):
-        return structures.Array(array[Tokens.DATA], **kwargs)
+        data = array[Tokens.DATA]
+        packed = structures.pack_numbers(data)
+        return structures.Array(data if packed is None else packed, **kwargs)
 
     @Dispatcher.dispatch(Tokens.TREE_NODE_T)
     def tree_node_decode(self, tree_node, **kwargs):
@@ -132,8 +154,43 @@ class SnapshotDecoder(metaclass=Dispatcher):
 
     @Dispatcher.dispatch(Tokens.GRAPH_T)
     def graph_decode(self, graph, **kwargs):
-        return structures.Graph(graph[Tokens.GRAPH_NODES],
-                                graph[Tokens.GRAPH_EDGES], **kwargs)
+        edges = graph[Tokens.GRAPH_EDGES]
+        if edges and isinstance(edges[0], dict):
+            # Left undecoded by `keys_to_skip`, to be stored compactly
+            edges = self._compact_edges(kwargs["uid"], edges)
+        return structures.Graph(graph[Tokens.GRAPH_NODES], edges, **kwargs)
+
+    def _compact_edges(self, graph_uid, raw_edges):
+        ends = []
+        # uid, or (type, value) for a literal -> index in `ends`
+        end_index = {}
+        orig, dest = array.array("q"), array.array("q")
+        data = []
+        for raw_edge in raw_edges:
+            for key, column in ((Tokens.FROM, orig), (Tokens.TO, dest)):
+                end = decode_in_place(raw_edge[key], self.obj_decode,
+                                      skip=self.keys_to_skip)
+                end_key = structures.CompactEdgeSet.end_key(end)
+                if end_key not in end_index:
+                    end_index[end_key] = len(ends)
+                    ends.append(end)
+                column.append(end_index[end_key])
+            data.append(decode_in_place(raw_edge[Tokens.DATA], self.obj_decode,
+                                        skip=self.keys_to_skip)
+                        if Tokens.DATA in raw_edge else structures.Null)
+        if all(item is structures.Null for item in data):
+            data = None
+        return structures.CompactEdgeSet(graph_uid, ends, orig, dest, data)
+
+    def keys_to_skip(self, json_node):
+        """Like `json_keys_to_skip`, but also skips the edges of a graph when
+        none of them have a uid, name or metadata.  `graph_decode` stores
+        those as a `structures.CompactEdgeSet` without making `Edge`s."""
+        yield from json_keys_to_skip(json_node)
+        if (isinstance(json_node, dict) and
+                json_node.get(Tokens.TYPE) == Tokens.GRAPH_T and
+                _are_anonymous_edges(json_node.get(Tokens.GRAPH_EDGES))):
+            yield Tokens.GRAPH_EDGES
 
     @Dispatcher.dispatch(Tokens.NODE_T)
     def node_decode(self, node, **kwargs):
@@ -156,24 +213,29 @@ class SnapshotDecoder(metaclass=Dispatcher):
     def widget_decode(self, widget, **kwargs):
         return structures.Widget(**kwargs)
 
-    def finalize(self):
-        self.table.finalize()
-        self.namespace = {key: self.table[val]
-                          for key, val in self.namespace.items()}
+    def finalize(self, lazy=False, strict=True):
+        """Return the decoded snapshot.  With `lazy=True`, references are
+        only resolved for the objects that are looked up, and with
+        `strict=False`, references to missing objects are left unresolved
+        (see `ObjectTable.finalize`)."""
+        self.table.finalize(lazy=lazy, strict=strict)
+        if lazy:
+            self.namespace = structures.LazyNames(self.namespace, self.table)
+        else:
+            self.namespace = {key: self.table[val]
+                              for key, val in self.namespace.items()}
         return structures.Snapshot(obj_table=self.table, names=self.namespace)
 
-def post_order_visit(node, visit=lambda x: x, skip=lambda x: ()):
-    # traverse the dictionary.  post-order traversal
-    if isinstance(node, dict):
-        keys_to_skip = tuple(skip(node))
-        return visit({key: (val if key in keys_to_skip
-                            else post_order_visit(val, visit=visit, skip=skip))
-                      for key, val in node.items()})
-    elif isinstance(node, list):
-        return visit([post_order_visit(elt, visit=visit, skip=skip) for elt in node])
-    else:
-        # node is a str, int, float
-        return visit(node)
+_ANONYMOUS_EDGE_KEYS = frozenset([Tokens.TYPE, Tokens.FROM, Tokens.TO, Tokens.DATA])
+
+def _are_anonymous_edges(raw_edges):
+    # Is `raw_edges` a non-empty list of edge objects with nothing but ends
+    # and data?
+    return (isinstance(raw_edges, list) and bool(raw_edges) and
+            all(isinstance(edge, dict) and
+                edge.get(Tokens.TYPE) == Tokens.EDGE_T and
+                Tokens.FROM in edge and Tokens.TO in edge and
+                edge.keys() <= _ANONYMOUS_EDGE_KEYS for edge in raw_edges))
 
 def json_keys_to_skip(json_node):
     # Some nodes shouldn't be visited during our post_order_visit
@@ -188,52 +250,874 @@ def json_keys_to_skip(json_node):
         if json_node.get(Tokens.TYPE) == Tokens.STRING_T:
             yield Tokens.DATA  # don't turn a string literal into a label
 
-def decode_json(text):
-    raw_stuff = parse(text)
-    validate(raw_stuff)
+def post_order_visit(node, visit=lambda x: x, skip=lambda x: ()):
+    """Traverse a tree of JSON dicts and lists in post-order.
+
+    Returns `visit(copy)`, where `copy` is a copy of `node` whose items have
+    all been replaced by the results of visiting them.  The values of dict
+    keys yielded by `skip(the_dict)` are copied without being visited.
+
+    An explicit stack is used instead of recursion, so arbitrarily deep input
+    is fine.
+    """
+    if not isinstance(node, (dict, list)):
+        return visit(node)
+    # Each frame is [node, iterator over its items, copy, keys to skip, pending key]
+    stack = [_visit_frame(node, skip)]
+    while True:
+        frame = stack[-1]
+        _, items, copy, keys_to_skip, _ = frame
+        for key, val in items:
+            if keys_to_skip and key in keys_to_skip:
+                copy[key] = val
+            elif isinstance(val, (dict, list)):
+                frame[4] = key
+                stack.append(_visit_frame(val, skip))
+                break
+            elif isinstance(copy, dict):
+                copy[key] = visit(val)
+            else:
+                copy.append(visit(val))
+        else:
+            stack.pop()
+            result = visit(copy)
+            if not stack:
+                return result
+            parent_copy, parent_key = stack[-1][2], stack[-1][4]
+            if isinstance(parent_copy, dict):
+                parent_copy[parent_key] = result
+            else:
+                parent_copy.append(result)
+
+def _visit_frame(node, skip):
+    if isinstance(node, dict):
+        return [node, iter(node.items()), {}, tuple(skip(node)), None]
+    else:
+        return [node, enumerate(node), [], (), None]
+
+def decode_in_place(node, decode, skip=json_keys_to_skip):
+    """Like `post_order_visit(node, visit=decode, skip=skip)`, but each
+    visited value replaces the original inside its parent dict or list, so no
+    intermediate containers are built.
+
+    Uses an explicit stack, so arbitrarily deep input is fine.  `node` is
+    modified in place.
+    """
+    if not isinstance(node, (dict, list)):
+        return decode(node)
+    # Each frame is [container, iterator over keys to visit, pending key]
+    stack = [[node, _keys_to_visit(node, skip), None]]
+    while True:
+        frame = stack[-1]
+        container, keys, _ = frame
+        for key in keys:
+            val = container[key]
+            if isinstance(val, (dict, list)):
+                frame[2] = key
+                stack.append([val, _keys_to_visit(val, skip), None])
+                break
+            container[key] = decode(val)
+        else:
+            stack.pop()
+            result = decode(container)
+            if not stack:
+                return result
+            parent, _, key = stack[-1]
+            parent[key] = result
+
+def _keys_to_visit(node, skip):
+    if isinstance(node, dict):
+        keys_to_skip = tuple(skip(node))
+        return iter([key for key in node if key not in keys_to_skip])
+    else:
+        return iter(range(len(node)))
+
+def is_array_patch(raw_obj):
+    """Is `raw_obj` an array patch in a delta snapshot (see `TraceDecoder`)?"""
+    return (isinstance(raw_obj, dict) and
+            raw_obj.get(Tokens.TYPE) == Tokens.ARRAY_T and Tokens.SET in raw_obj)
+
+def is_delta_snapshot(raw_snapshot):
+    """Is `raw_snapshot` (a list of raw JSON objects) a delta snapshot?"""
+    return (bool(raw_snapshot) and isinstance(raw_snapshot[0], dict) and
+            raw_snapshot[0].get(Tokens.TYPE) == Tokens.DELTA_T)
+
+class TraceDecoder:
+    """Decodes the snapshots of a trace in chronological order.
+
+    A snapshot may be a delta snapshot, which only lists what changed since
+    the snapshot before it.  Its first object is a marker,
+
+        {"type": "delta", "removed": [uids of objects that no longer exist]}
+
+    and the rest are the objects that were added or changed, written out in
+    full as usual.  An array that only had some cells replaced may be given
+    as a patch instead,
+
+        {"type": "array", "uid": uid, "set": {"index": value, ...}}
+
+    which is the array from the previous snapshot, with the same variable
+    names, and with those cells set to the new values.  Every other object is the same as in the previous
+    snapshot.  Variable names carry over too, except for those of changed
+    and removed objects; a changed object gets the names in its new body.
+
+    Unchanged objects are shared between the decoded snapshots.  An object
+    that refers to a changed object is copied (along with whatever refers to
+    it, and so on), so older snapshots still see the objects as they were.
+    """
+    def __init__(self, lazy=False):
+        # Passed on to `decode_snapshot` for full snapshots
+        self.lazy = lazy
+        self.previous = None
+        self._history = None
+        # uid -> set of uids of the objects that refer to it
+        self._referrers = None
+        # The uids that the last snapshot changed or removed, if it was a
+        # delta, or None if it was a full snapshot
+        self.delta_uids = None
+        # Numbers the delta snapshots, to keep their automatic uids apart
+        self._deltas = 0
+
+    def decode(self, raw_snapshot):
+        """Decode the next snapshot, a list of raw JSON objects"""
+        if is_delta_snapshot(raw_snapshot):
+            snapshot = self._decode_delta(raw_snapshot[0], raw_snapshot[1:])
+        else:
+            snapshot = decode_snapshot(*raw_snapshot, lazy=self.lazy)
+            self._history = self._referrers = None
+            self.delta_uids = None
+        self.previous = snapshot
+        return snapshot
+
+    def set_previous(self, snapshot):
+        """Use a full snapshot that was decoded elsewhere as the previous one"""
+        self.previous = snapshot
+        self._history = self._referrers = None
+        self.delta_uids = None
+
+    def _decode_delta(self, marker, objects):
+        if self.previous is None:
+            raise JSONObjectError("a delta snapshot must come after another snapshot")
+        if self._history is None:
+            self._history = structures.ObjectHistory(self.previous.obj_table)
+            self._referrers = {}
+            for uid, obj in self.previous.obj_table.items():
+                self._add_referrer(uid, obj)
+        history = self._history
+        prev_step = history.steps
+        removed = set(marker.get(Tokens.REMOVED, ()))
+        # Anonymous objects in a delta are new objects, so their uids
+        # mustn't be those of anonymous objects in earlier snapshots
+        self._deltas += 1
+        sd = SnapshotDecoder(auto_uid_prefix="#{}.".format(self._deltas))
+        patched = set()
+        for raw_obj in objects:
+            if is_array_patch(raw_obj):
+                self._patch_array(raw_obj, sd, prev_step)
+                patched.add(raw_obj[Tokens.UID])
+            else:
+                decode_in_place(raw_obj, sd.obj_decode, skip=sd.keys_to_skip)
+        changed = {uid: obj for uid, obj in sd.table.items()
+                   if obj is not structures.Null}
+        self.delta_uids = removed.union(changed)
+        # Copy everything that (indirectly) refers to a changed object
+        copied = {}
+        stack = list(changed) + list(removed)
+        while stack:
+            for referrer in self._referrers.get(stack.pop(), ()):
+                if (referrer not in changed and referrer not in copied and
+                        referrer not in removed):
+                    copied[referrer] = copy.copy(history.lookup(referrer, prev_step))
+                    stack.append(referrer)
+        # A patched array keeps its names, since a patch has none of its own
+        name_uids = {var: obj.uid for var, obj in self.previous.names.items()
+                     if obj.uid not in removed and
+                     (obj.uid not in changed or obj.uid in patched)}
+        name_uids.update(sd.namespace)
+        step = history.add_step(dict(copied, **changed), removed, names=name_uids)
+        view = structures.ObjectTableView(history, step)
+        relink = structures.RelinkingTable(view)
+        for uid, obj in changed.items():
+            # Patched arrays still hold objects from the previous snapshot
+            obj.untablify(relink if uid in patched else view)
+        for obj in copied.values():
+            obj.untablify(relink)
+            obj.invalidate_fingerprint()
+        # Keep the referrer index up to date for the next delta
+        for uid in itertools.chain(changed, removed):
+            try:
+                old = history.lookup(uid, prev_step)
+            except KeyError:
+                continue
+            for target in structures.iter_references(old):
+                self._referrers.get(target.uid, set()).discard(uid)
+        for uid, obj in changed.items():
+            self._add_referrer(uid, obj)
+        names = {var: view[uid] for var, uid in name_uids.items()}
+        return structures.Snapshot(names=names, obj_table=view)
+
+    def _patch_array(self, patch, sd, prev_step):
+        # Add a copy of the array in the previous snapshot with the patch's
+        # cells set to `sd.table`
+        uid = patch[Tokens.UID]
+        try:
+            old = self._history.lookup(uid, prev_step)
+        except KeyError:
+            old = None
+        if not isinstance(old, structures.Array):
+            raise JSONObjectError("array patch for {!r}, which isn't an array in"
+                                  " the previous snapshot".format(uid))
+        patched = copy.copy(old)
+        patched.data = old.copy().data
+        for index, value in patch[Tokens.SET].items():
+            index = int(index)
+            if not 0 <= index < len(patched):
+                raise JSONObjectError("array patch for {!r} sets cell {}, but the"
+                                      " array has {} cells"
+                                      .format(uid, index, len(patched)))
+            patched[index] = decode_in_place(value, sd.obj_decode,
+                                             skip=sd.keys_to_skip)
+        patched.invalidate_fingerprint()
+        sd.table[sys.intern(uid)] = patched
+
+    def _add_referrer(self, uid, obj):
+        if hasattr(obj, "fields"):
+            for target in structures.iter_references(obj):
+                self._referrers.setdefault(target.uid, set()).add(uid)
+
+def decode_json(text, workers=None, trusted=False):
+    """Decode a trace.  If `workers` is more than 1, the snapshots are decoded
+    in that many processes (see `decode_json_parallel`).
+
+    Pass `trusted=True` for traces that are known to be well-formed and free
+    of aliases (e.g. ones written by `algviz.interface`) to skip validation
+    and alias fixing.  This goes for the other decoding functions too.
+    """
+    if workers is not None and workers > 1:
+        return decode_json_parallel(text, workers=workers, trusted=trusted)
+    raw_stuff = parse(text, trusted=trusted)
+    if not trusted:
+        validate(raw_stuff)
     # If no exception has been raised, then we have a list of snapshots in chronological order.
+    decoder = TraceDecoder()
+    return [decoder.decode(raw_snapshot) for raw_snapshot in raw_stuff]
+
+def decode_json_parallel(text, workers=None, trusted=False):
+    """Decode the snapshots of a trace in a pool of `workers` processes
+    (default: one per CPU).  Returns the snapshots in chronological order.
+
+    Every snapshot is decoded independently, so the text of each snapshot is
+    found with a `SnapshotScanner` and handed to a worker.  Workers send back
+    flat tables, where objects refer to each other by uid, and the references
+    are resolved here; pickling linked objects would recurse along every
+    chain of references.  The tables are still pickled, so this only pays
+    off with several CPUs and when decoding is slow compared to pickling,
+    e.g. for many large snapshots.
+    """
+    scanner = SnapshotScanner.for_text(text)
+    texts = [span.text for span in scanner]
+    if scanner.truncated_at is not None:
+        raise JSONObjectError("trace ends in the middle of the snapshot"
+                              " starting at offset {}"
+                              .format(scanner.truncated_at))
+    workers = workers or os.cpu_count() or 1
+    # A few chunks per worker keeps them all busy without much overhead
+    chunksize = max(1, len(texts) // (4 * workers))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            functools.partial(_decode_full_snapshot_text, trusted=trusted),
+            texts, chunksize=chunksize))
+    # Delta snapshots depend on the snapshot before them, so they are decoded
+    # here, in order
+    decoder = TraceDecoder()
     snapshots = []
-    for raw_snapshot in raw_stuff:
-        snapshots.append(decode_snapshot(*raw_snapshot))
+    for text, flat in zip(texts, results):
+        if flat is None:
+            snapshot = decoder.decode(parse_snapshot(text, trusted=trusted))
+        else:
+            snapshot = _resolve_flat_snapshot(*flat)
+            decoder.set_previous(snapshot)
+        snapshots.append(snapshot)
     return snapshots
 
-def decode_snapshot_text(text):
-    raw_snapshot = parse(text)
-    validate_snapshot(raw_snapshot)
-    return decode_snapshot(*raw_snapshot)
+class _ReferencingLookup:
+    # Passed to `untablify` to do the opposite: every object with a uid is
+    # replaced by a reference to it.  References are shared, so each uid is
+    # pickled once.
+    def __init__(self):
+        self._refs = {}
+
+    def __getitem__(self, item):
+        if not hasattr(item, "_fingerprint") or item is structures.Null:
+            return item
+        ref = self._refs.get(item.uid)
+        if ref is None:
+            ref = self._refs[item.uid] = structures.ObjectTableReference(item.uid)
+        return ref
 
-def decode_snapshot(*objects):
+def _decode_full_snapshot_text(text, trusted=False):
+    # Returns the objects of a snapshot by uid, referring to each other only
+    # by uid, and its variables, so the result pickles without recursing.
+    # Returns None for a delta snapshot, which can't be decoded on its own.
+    raw_snapshot = parse(text, trusted=trusted)
+    if is_delta_snapshot(raw_snapshot):
+        return None
+    if not trusted:
+        validate_snapshot(raw_snapshot)
     sd = SnapshotDecoder()
-    for raw_obj in objects:
-        post_order_visit(raw_obj,
-                         visit=sd.obj_decode,
-                         skip=json_keys_to_skip)
+    for raw_obj in raw_snapshot:
+        decode_in_place(raw_obj, sd.obj_decode, skip=sd.keys_to_skip)
+    lookup = _ReferencingLookup()
+    objects = {}
+    for uid, obj in dict.items(sd.table):
+        if obj is not structures.Null:
+            obj.untablify(lookup)
+            objects[uid] = obj
+    return objects, sd.namespace
+
+def _resolve_flat_snapshot(objects, namespace):
+    # The snapshot for a result of `_decode_full_snapshot_text`
+    sd = SnapshotDecoder()
+    for uid, obj in objects.items():
+        sd.table[uid] = obj
+    for var, uid in namespace.items():
+        sd.namespace[var] = uid
+        sd.table.index_var(var, uid)
     return sd.finalize()
 
-def reads(text):
+def parse_snapshot(text, trusted=False):
+    """Parse and validate the text of one snapshot, without decoding it"""
+    raw_snapshot = parse(text, trusted=trusted)
+    if not trusted:
+        validate_snapshot(raw_snapshot)
+    return raw_snapshot
+
+def decode_snapshot_text(text, trusted=False, **kwargs):
+    """Decode the text of one snapshot.  Keyword arguments are passed on to
+    `decode_snapshot`."""
+    return decode_snapshot(*parse_snapshot(text, trusted=trusted), **kwargs)
+
+def decode_snapshot(*objects, lazy=False, roots=None, root_vars=None):
+    """Decode the raw JSON objects of one snapshot.  The objects are modified
+    in place, so don't reuse them afterwards.
+
+    With `lazy=True`, the references between objects are only resolved for
+    the objects that are looked up, which is much cheaper when only a small
+    part of a big snapshot will be used.
+
+    If `roots` (uids) or `root_vars` (variable names) are given, only the
+    objects reachable from those objects are decoded.  References to
+    anything else are left as `ObjectTableReference`s, and automatically
+    assigned uids may differ from those of a full decode.
+    """
+    sd = SnapshotDecoder()
+    if roots is None and root_vars is None:
+        for raw_obj in objects:
+            decode_in_place(raw_obj, sd.obj_decode, skip=sd.keys_to_skip)
+        return sd.finalize(lazy=lazy)
+    index = _RawObjectIndex(objects)
+    for raw_obj in index.reachable(roots or (), root_vars or ()):
+        decode_in_place(raw_obj, sd.obj_decode, skip=sd.keys_to_skip)
+    return sd.finalize(lazy=lazy, strict=False)
+
+class _RawObjectIndex:
+    """The objects in the raw JSON of a snapshot and the references between
+    them, found without decoding anything."""
+    def __init__(self, objects):
+        self.raw = []  # the dict of each object, in document order
+        self.parent = []  # the index of the object each one is nested in
+        self.links = []  # uids (str) and nested objects (int) of each object
+        self.by_uid = {}
+        self.by_var = {}
+        # Each entry is (raw JSON node, index of the innermost object holding it)
+        stack = [(obj, None) for obj in reversed(objects)]
+        while stack:
+            node, holder = stack.pop()
+            if isinstance(node, dict):
+                i = len(self.raw)
+                self.raw.append(node)
+                self.parent.append(holder)
+                self.links.append([])
+                if holder is not None:
+                    self.links[holder].append(i)
+                if Tokens.UID in node:
+                    self.by_uid[node[Tokens.UID]] = i
+                if Tokens.VARNAME in node:
+                    self.by_var[node[Tokens.VARNAME]] = i
+                skip = tuple(json_keys_to_skip(node))
+                items = [val for key, val in node.items() if key not in skip]
+                holder = i
+            else:
+                items = node
+            for item in reversed(items):
+                if isinstance(item, (dict, list)):
+                    stack.append((item, holder))
+                elif isinstance(item, str) and holder is not None:
+                    self.links[holder].append(item)
+
+    def reachable(self, roots, root_vars):
+        """Return the raw objects reachable from the given uids and variable
+        names that aren't nested inside other reachable objects, in document
+        order."""
+        stack = [self.by_uid[uid] for uid in roots if uid in self.by_uid]
+        stack.extend(self.by_var[var] for var in root_vars if var in self.by_var)
+        seen = set()
+        while stack:
+            i = stack.pop()
+            if i in seen:
+                continue
+            seen.add(i)
+            for link in self.links[i]:
+                if type(link) is int:
+                    stack.append(link)
+                elif link in self.by_uid:
+                    stack.append(self.by_uid[link])
+        return [self.raw[i] for i in sorted(seen) if self.parent[i] not in seen]
+
+def reads(text, workers=None, trusted=False):
     """This smoothly handles the case where we never printed the closing "]",
-    since that's hard to do."""
-    try:
-        return decode_json(text)
-    except json.JSONDecodeError:
-        logger.info("decoding again with extra ']' added on the end")
-        return decode_json(text + "]")
+    since that's hard to do.  A trace that stops in the middle of a snapshot
+    is an error; use `reads_partial` to recover the snapshots before that."""
+    if workers is not None and workers > 1:
+        return decode_json_parallel(text, workers=workers, trusted=trusted)
+    trace = reads_partial(text, trusted=trusted)
+    if trace.truncated_at is not None:
+        raise JSONObjectError("trace ends in the middle of the snapshot"
+                              " starting at offset {}".format(trace.truncated_at))
+    return trace.snapshots
+
+def read(file_obj, workers=None, trusted=False):
+    return reads(file_obj.read(), workers=workers, trusted=trusted)
+
+PartialTrace = collections.namedtuple("PartialTrace", ("snapshots", "truncated_at"))
+
+def reads_partial(text, trusted=False):
+    """Decode every complete snapshot of a trace that may have been cut off,
+    e.g. because the program writing it crashed.
+
+    Returns a `PartialTrace` whose `truncated_at` is the offset where the
+    incomplete snapshot at the end starts, or None if there isn't one.  A
+    missing closing "]" doesn't count as truncation.  The text is parsed in a
+    single pass and is never copied.
+    """
+    reader = _RawSnapshotReader(text, trusted=trusted)
+    decoder = TraceDecoder()
+    snapshots = []
+    for raw_snapshot in reader:
+        if not trusted:
+            validate_snapshot(raw_snapshot)
+        snapshots.append(decoder.decode(raw_snapshot))
+    if reader.truncated_at is not None:
+        logger.info("ignoring incomplete snapshot at offset %d", reader.truncated_at)
+    return PartialTrace(snapshots, reader.truncated_at)
+
+def read_partial(file_obj, trusted=False):
+    return reads_partial(file_obj.read(), trusted=trusted)
+
+class _RawSnapshotReader:
+    """Parse the snapshots of a trace held in a `str` one at a time, in place.
+
+    Iterating yields each snapshot as a list of raw JSON objects.  Like
+    `SnapshotScanner`, iteration stops at the first incomplete snapshot and
+    `truncated_at` is set to its offset.
+    """
+    _between = re.compile(r"[ \t\r\n,]*")
+    _space = re.compile(r"[ \t\r\n]*")
+
+    def __init__(self, text, trusted=False):
+        self.text = text
+        self.truncated_at = None
+        self._json_decoder = json.JSONDecoder(
+            object_hook=None if trusted else fix_aliases)
+
+    def __iter__(self):
+        text = self.text
+        pos = self._space.match(text).end()
+        if pos == len(text):
+            return
+        if text[pos] != "[":
+            raise JSONObjectError("Unexpected {!r} at offset {} outside of any"
+                                  " snapshot".format(text[pos], pos))
+        pos += 1  # past the "[" that opens the trace
+        while True:
+            pos = self._between.match(text, pos).end()
+            if pos == len(text):
+                return
+            if text[pos] == "]":
+                # Only whitespace may follow the end of the trace
+                pos = self._space.match(text, pos + 1).end()
+                if pos != len(text):
+                    raise JSONObjectError("Unexpected {!r} at offset {} after"
+                                          " the end of the trace"
+                                          .format(text[pos], pos))
+                return
+            if text[pos] != "[":
+                raise JSONObjectError("Unexpected {!r} at offset {} outside of any"
+                                      " snapshot".format(text[pos], pos))
+            try:
+                raw_snapshot, end = self._json_decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                if not self._is_truncated(pos):
+                    raise
+                self.truncated_at = pos
+                return
+            yield raw_snapshot
+            pos = end
 
-def read(file_obj):
-    return reads(file_obj.read())
+    def _is_truncated(self, start):
+        # Did parsing fail because the text ends inside the snapshot at
+        # `start`, rather than because the snapshot is malformed?
+        scanner = SnapshotScanner.for_text(self.text, start=start)
+        for _ in scanner:
+            return False
+        return scanner.truncated_at is not None
+
+def iter_snapshots(file_obj, chunk_size=None, trusted=False):
+    """Decode the snapshots in `file_obj` one at a time, without reading the
+    whole trace into memory first.
+
+    Each `structures.Snapshot` is yielded as soon as its closing bracket has
+    been read, so memory use is bounded by the largest single snapshot rather
+    than by the size of the trace.  A missing final "]" is tolerated, as in
+    `reads`.
+    """
+    scanner = SnapshotScanner(file_obj, chunk_size=chunk_size)
+    decoder = TraceDecoder()
+    for span in scanner:
+        yield decoder.decode(parse_snapshot(span.text, trusted=trusted))
+    if scanner.truncated_at is not None:
+        raise JSONObjectError("trace ends in the middle of the snapshot"
+                              " starting at offset {}"
+                              .format(scanner.truncated_at))
+
+class _WholeText:
+    # Acts like a file that returns all of `text` in one read
+    def __init__(self, text):
+        self._text = text
+
+    def read(self, size=-1):
+        text, self._text = self._text, self._text[:0]
+        return text
+
+SnapshotSpan = collections.namedtuple("SnapshotSpan", ("start", "stop", "text"))
+
+class _ScanSyntax:
+    """Compiled patterns for scanning either `str` or `bytes` input"""
+    def __init__(self, empty):
+        def _lit(char):
+            return char if isinstance(empty, str) else char.encode("ascii")
+        self.empty = empty
+        self.open_list = _lit("[")
+        self.close_list = _lit("]")
+        self.separator = _lit(",")
+        self.quote = _lit('"')
+        self.openers = (_lit("["), _lit("{"))
+        self.structural = re.compile(_lit(r'[\[\]{}"]'))
+        self.string_special = re.compile(_lit(r'[\\"]'))
+        self.non_space = re.compile(_lit(r"[^ \t\r\n]"))
+
+_scan_syntax = {str: _ScanSyntax(""), bytes: _ScanSyntax(b"")}
+
+class SnapshotScanner:
+    """Find the top-level snapshots of a trace without decoding them.
+
+    Iterating over a scanner yields a `SnapshotSpan` for each complete
+    snapshot, giving its `text` and its `start` and `stop` offsets in the
+    input.  Offsets count characters for text files and bytes for binary
+    files.  The input is read in chunks of `chunk_size`, and each character
+    is examined once.
+
+    If the input stops in the middle of a snapshot, iteration ends normally
+    and `truncated_at` holds the offset where the incomplete snapshot starts.
+    """
+    default_chunk_size = 1 << 16
+    # States of the scanner
+    _BEFORE_TRACE, _BETWEEN, _IN_SNAPSHOT, _AFTER_TRACE = range(4)
+
+    def __init__(self, file_obj, chunk_size=None):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size or self.default_chunk_size
+        self.truncated_at = None
+        self._state = self._BEFORE_TRACE
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._pieces = []  # parts of the snapshot currently being scanned
+        self._start = None  # offset where the current snapshot began
+        self._offset = 0  # offset of the current chunk
+        self._resume_at = 0  # where to start scanning the first chunk
+
+    @classmethod
+    def for_text(cls, text, start=0):
+        """Scan a `str` or `bytes` that is already in memory, without copying it.
+
+        If `start` is given, it must be the offset of a snapshot (or of the
+        space between two snapshots), and scanning begins there.
+        """
+        scanner = cls(_WholeText(text), chunk_size=max(1, len(text)))
+        if start:
+            scanner._state = cls._BETWEEN
+            scanner._resume_at = start
+        return scanner
+
+    def __iter__(self):
+        # Reads to the end, to check that only whitespace follows the trace
+        while True:
+            chunk = self.file_obj.read(self.chunk_size)
+            if not chunk:
+                break
+            yield from self._scan_chunk(chunk)
+            self._offset += len(chunk)
+        if self._state == self._IN_SNAPSHOT:
+            self.truncated_at = self._start
+            self._pieces = []
+
+    def _scan_chunk(self, chunk):
+        syntax = _scan_syntax[type(chunk)]
+        i = piece_start = self._resume_at
+        self._resume_at = 0
+        end = len(chunk)
+        while i < end:
+            if self._state == self._IN_SNAPSHOT:
+                if self._escaped:
+                    self._escaped = False
+                    i += 1
+                elif self._in_string:
+                    match = syntax.string_special.search(chunk, i)
+                    if match is None:
+                        break
+                    i = match.end()
+                    if match.group() == syntax.quote:
+                        self._in_string = False
+                    else:
+                        self._escaped = True
+                else:
+                    match = syntax.structural.search(chunk, i)
+                    if match is None:
+                        break
+                    i = match.end()
+                    char = match.group()
+                    if char == syntax.quote:
+                        self._in_string = True
+                    elif char in syntax.openers:
+                        self._depth += 1
+                    else:
+                        self._depth -= 1
+                        if self._depth == 0:
+                            self._pieces.append(chunk[piece_start:i])
+                            text = syntax.empty.join(self._pieces)
+                            self._pieces = []
+                            self._state = self._BETWEEN
+                            yield SnapshotSpan(self._start, self._offset + i, text)
+            else:
+                match = syntax.non_space.search(chunk, i)
+                if match is None:
+                    break
+                i = match.start()
+                self._scan_outside(chunk[i:i + 1], syntax, i)
+                if self._state == self._IN_SNAPSHOT:
+                    piece_start = i
+                    self._start = self._offset + i
+                    self._depth = 1
+                i += 1
+        if self._state == self._IN_SNAPSHOT:
+            self._pieces.append(chunk[piece_start:])
+
+    def _scan_outside(self, char, syntax, i):
+        # Handle a non-whitespace character that isn't part of a snapshot
+        if self._state == self._BEFORE_TRACE and char == syntax.open_list:
+            self._state = self._BETWEEN
+        elif self._state == self._BETWEEN and char == syntax.open_list:
+            self._state = self._IN_SNAPSHOT
+        elif self._state == self._BETWEEN and char == syntax.separator:
+            pass
+        elif self._state == self._BETWEEN and char == syntax.close_list:
+            self._state = self._AFTER_TRACE
+        elif self._state == self._AFTER_TRACE:
+            raise JSONObjectError("Unexpected {!r} at offset {} after the end"
+                                  " of the trace".format(char, self._offset + i))
+        else:
+            raise JSONObjectError("Unexpected {!r} at offset {} outside of any"
+                                  " snapshot".format(char, self._offset + i))
+
+class ValidationError(JSONObjectError):
+    pass
 
 def validate(json_stuff):
-    # We will want to check stuff here, but obviously we don't yet.
-    # TODO open an issue for this.
-    # This is just for example:
-    if isinstance(json_stuff, dict):
-        if json_stuff.get(Tokens.TYPE) == Tokens.NULL_T:
-            validate_null(json_stuff)
+    """Check that `json_stuff` is a list of snapshots that match the schema
+    in `Tokens`.  Raises a `ValidationError` if not."""
+    if not isinstance(json_stuff, list):
+        raise ValidationError("A trace should be a list of snapshots, not {!r}"
+                              .format(type(json_stuff).__name__))
+    for raw_snapshot in json_stuff:
+        validate_snapshot(raw_snapshot)
 
 def validate_snapshot(snapshot):
-    pass  # TODO
+    """Check one snapshot, i.e. a list of raw JSON objects (with aliases
+    already fixed).  Raises a `ValidationError` if anything is wrong."""
+    if not isinstance(snapshot, list):
+        raise ValidationError("A snapshot should be a list of objects, not {!r}"
+                              .format(type(snapshot).__name__))
+    objects = snapshot
+    # Nested objects are pushed on a stack rather than checked recursively
+    stack = []
+    if is_delta_snapshot(snapshot):
+        _check_delta_marker(snapshot[0])
+        objects = []
+        for item in snapshot[1:]:
+            if is_array_patch(item):
+                _check_object(item, _array_patch_check, stack)
+            else:
+                objects.append(item)
+    for item in objects:
+        _check_value(item, _VALUE, None, None, stack)
+    checks = _object_checks
+    while stack:
+        obj = stack.pop()
+        type_ = obj.get(Tokens.TYPE)
+        check = checks.get(type_) if isinstance(type_, str) else None
+        if check is None:
+            if type_ == Tokens.DELTA_T:
+                raise ValidationError("Only the first object in a snapshot may be"
+                                      " a {} marker".format(Tokens.DELTA_T))
+            raise ValidationError("Object with {} = {!r} has an invalid {}: {!r}"
+                                  .format(Tokens.UID, obj.get(Tokens.UID),
+                                          Tokens.TYPE, type_))
+        _check_object(obj, check, stack)
+
+def _check_object(obj, check, stack):
+    type_ = obj[Tokens.TYPE]
+    if not check.required.issubset(obj):
+        raise ValidationError("{} object {!r} is missing {}".format(
+            type_, obj.get(Tokens.UID),
+            ", ".join(sorted(check.required.difference(obj)))))
+    for key, val in obj.items():
+        if key not in check.kinds:
+            raise ValidationError("{} object {!r} has an unexpected key {!r}"
+                                  .format(type_, obj.get(Tokens.UID), key))
+        _check_value(val, check.kinds[key], obj, key, stack)
+    if check.extra is not None:
+        check.extra(obj)
+
+# The kinds of value a key may have, as used in `_ObjectCheck`
+# JSON null is never a value, since a missing value is a {"type": "null"}
+# object, and the decoder has nothing to decode null into
+_VALUE = "a uid, a number, a boolean or an object"
+_VALUES = "a list of uids, numbers, booleans and objects"
+_LITERAL_TYPES = (str, int, float, bool)
+_TEXT = "a string"
+_CELLS = "an object mapping indices to uids, numbers, booleans and objects"
+_INDEX = re.compile(r"0|[1-9][0-9]*")
+_UIDS = "a list of uids"
+_ANYTHING = "any JSON"
+
+def _check_value(val, kind, obj, key, stack):
+    # Check that `val` (found at `obj[key]`) is of the given kind, pushing
+    # any objects inside it onto `stack` to be checked later
+    if kind is _VALUE:
+        if type(val) is dict:
+            stack.append(val)
+            return
+        elif type(val) in _LITERAL_TYPES:
+            return
+    elif kind is _VALUES:
+        if type(val) is list:
+            for item in val:
+                if type(item) is dict:
+                    stack.append(item)
+                elif type(item) not in _LITERAL_TYPES:
+                    break
+            else:
+                return
+    elif kind is _TEXT:
+        if type(val) is str:
+            return
+    elif kind is _CELLS:
+        if type(val) is dict:
+            for index, item in val.items():
+                if not _INDEX.fullmatch(index):
+                    break
+                if type(item) is dict:
+                    stack.append(item)
+                elif type(item) not in _LITERAL_TYPES:
+                    break
+            else:
+                return
+    elif kind is _UIDS:
+        if type(val) is list and all(type(item) is str for item in val):
+            return
+    elif kind is _ANYTHING:
+        return
+    if obj is None:
+        raise ValidationError("Snapshots should contain {}, not {!r}".format(kind, val))
+    raise ValidationError("In {} object {!r}, {} should be {}, not {!r}".format(
+        obj.get(Tokens.TYPE), obj.get(Tokens.UID), key, kind, val))
 
-def parse(text):
+class _ObjectCheck:
+    """What an object of one type may contain.  `kinds` maps each allowed key
+    to the kind of value it may have, `required` is the set of keys that
+    must be present, and `extra` is an optional further check."""
+    def __init__(self, required=(), optional=(), extra=None):
+        self.kinds = {Tokens.TYPE: _TEXT, Tokens.UID: _TEXT,
+                      Tokens.VARNAME: _TEXT, Tokens.METADATA: _ANYTHING}
+        self.kinds.update(required)
+        self.kinds.update(optional)
+        self.required = frozenset([Tokens.TYPE] + [key for key, _ in required])
+        self.extra = extra
+
+def validate_null(obj):
+    # Null is a singleton, so the only uid it can have is its own
+    if obj.get(Tokens.UID, structures.Null.uid) != structures.Null.uid:
+        raise ValidationError("objects of type {} should have no {} field.  Has: {}"
+                              .format(obj[Tokens.TYPE], Tokens.UID, obj[Tokens.UID]))
+
+def _check_uid(obj):
+    uid = obj.get(Tokens.UID)
+    if uid is not None and "#" in uid:
+        # "#" is reserved for uids made up by the decoder
+        raise ValidationError("{} object {!r} has a {} containing '#'"
+                              .format(obj[Tokens.TYPE], uid, Tokens.UID))
+
+# Built once, when the module is imported
+_object_checks = {
+    Tokens.ARRAY_T: _ObjectCheck(required=[(Tokens.DATA, _VALUES)],
+                                 extra=_check_uid),
+    Tokens.TREE_NODE_T: _ObjectCheck(optional=[(Tokens.DATA, _VALUE),
+                                               (Tokens.CHILDREN, _VALUES)],
+                                     extra=_check_uid),
+    Tokens.EDGE_T: _ObjectCheck(required=[(Tokens.FROM, _VALUE), (Tokens.TO, _VALUE)],
+                                optional=[(Tokens.DATA, _VALUE)],
+                                extra=_check_uid),
+    Tokens.GRAPH_T: _ObjectCheck(required=[(Tokens.GRAPH_NODES, _VALUES),
+                                           (Tokens.GRAPH_EDGES, _VALUES)],
+                                 extra=_check_uid),
+    Tokens.NODE_T: _ObjectCheck(optional=[(Tokens.DATA, _VALUE)],
+                                extra=_check_uid),
+    Tokens.NULL_T: _ObjectCheck(extra=validate_null),
+    Tokens.POINTER_T: _ObjectCheck(required=[(Tokens.DATA, _VALUE)],
+                                   extra=_check_uid),
+    Tokens.STRING_T: _ObjectCheck(required=[(Tokens.DATA, _TEXT)],
+                                  extra=_check_uid),
+    Tokens.WIDGET_T: _ObjectCheck(extra=_check_uid),
+}
+
+# An array patch in a delta snapshot has a uid and cells, and nothing else
+_array_patch_check = _ObjectCheck(required=[(Tokens.UID, _TEXT),
+                                            (Tokens.SET, _CELLS)])
+del _array_patch_check.kinds[Tokens.VARNAME], _array_patch_check.kinds[Tokens.METADATA]
+
+_delta_marker_keys = {Tokens.TYPE: _TEXT, Tokens.REMOVED: _UIDS}
+
+def _check_delta_marker(marker):
+    for key, val in marker.items():
+        if key not in _delta_marker_keys:
+            raise ValidationError("{} marker has an unexpected key {!r}"
+                                  .format(Tokens.DELTA_T, key))
+        _check_value(val, _delta_marker_keys[key], marker, key, [])
+
+def parse(text, trusted=False):
+    if trusted:
+        return json.loads(text)
     return json.loads(text, object_hook=fix_aliases)
 
 def fix_aliases(obj):
@@ -254,10 +1138,3 @@ def fix_aliases(obj):
             obj[Tokens.TYPE] = type_aliases[obj[Tokens.TYPE]]
     return obj
 
-class ValidationError(JSONObjectError):
-    pass
-
-def validate_null(obj):
-    if Tokens.UID in obj:
-        raise ValidationError("objects of type {} should have no {} field.  Has: {}"
-                              .format(obj[Tokens.TYPE], Tokens.UID, obj[Tokens.UID]))
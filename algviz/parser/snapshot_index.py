@@ -0,0 +1,303 @@
+"""Random access to the snapshots of a trace file.
+
+A `SnapshotIndex` records the byte offsets of the top-level snapshots in a
+trace.  It is saved in a sidecar file next to the trace (the trace's name
+plus `INDEX_SUFFIX`) so later runs don't have to scan the trace again.
+`LazySnapshotSequence` uses the index to decode only the snapshots that are
+actually requested.
+
+A `ChangeHistory` records, for each uid, the snapshots where that object
+changed.  It is kept in a sidecar file too (with `HISTORY_SUFFIX`).
+"""
+
+import collections
+import collections.abc
+import json
+import logging
+import os
+
+from . import json_objects
+from . import structures
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+HISTORY_SUFFIX = ".history"
+
+class _TraceSidecar:
+    """Information about a trace file that can be saved next to it, along
+    with the size and modification time of the file when it was read.
+
+    Subclasses define `suffix`, `version`, `build(path, ...)`, and the
+    conversions `_to_json()` and `_from_json(raw, size, mtime_ns)`.
+    """
+    suffix = None
+    version = None
+
+    def __init__(self, size, mtime_ns):
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    @classmethod
+    def load(cls, sidecar_path):
+        with open(sidecar_path, "r") as f:
+            raw = json.load(f)
+        if raw.get("version") != cls.version:
+            raise ValueError("{} has an unsupported version".format(sidecar_path))
+        return cls._from_json(raw, raw["size"], raw["mtime_ns"])
+
+    def save(self, sidecar_path):
+        raw = self._to_json()
+        raw.update(version=self.version, size=self.size, mtime_ns=self.mtime_ns)
+        with open(sidecar_path, "w") as f:
+            json.dump(raw, f)
+
+    def is_current(self, path):
+        """Was this made from the file at `path` as it is now?"""
+        stat = os.stat(path)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    @classmethod
+    def for_trace(cls, path, use_sidecar=True, **kwargs):
+        """Return an instance for the trace at `path`, reusing the sidecar
+        file if it is up to date and writing a new one if it is not.  Other
+        keyword arguments go to `build`.
+        """
+        if not use_sidecar:
+            return cls.build(path, **kwargs)
+        sidecar_path = path + cls.suffix
+        try:
+            sidecar = cls.load(sidecar_path)
+            if sidecar.is_current(path):
+                return sidecar
+        except (OSError, ValueError, KeyError):
+            pass
+        sidecar = cls.build(path, **kwargs)
+        try:
+            sidecar.save(sidecar_path)
+        except OSError as e:
+            logger.info("could not save %s: %s", sidecar_path, e)
+        return sidecar
+
+class SnapshotIndex(_TraceSidecar):
+    """Byte offsets (`start`, `stop`) of each snapshot in a trace file,
+    along with the size and modification time of the file when it was
+    indexed.
+    """
+    suffix = INDEX_SUFFIX
+    version = 1
+
+    def __init__(self, spans, size, mtime_ns):
+        super().__init__(size, mtime_ns)
+        self.spans = spans
+
+    def __len__(self):
+        return len(self.spans)
+
+    @classmethod
+    def build(cls, path):
+        """Scan the trace at `path` without decoding any snapshots"""
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            scanner = json_objects.SnapshotScanner(f)
+            spans = [(span.start, span.stop) for span in scanner]
+        if scanner.truncated_at is not None:
+            logger.info("ignoring incomplete snapshot at the end of %s", path)
+        return cls(spans, stat.st_size, stat.st_mtime_ns)
+
+    def _to_json(self):
+        return {"spans": self.spans}
+
+    @classmethod
+    def _from_json(cls, raw, size, mtime_ns):
+        return cls([tuple(span) for span in raw["spans"]], size, mtime_ns)
+
+Change = collections.namedtuple("Change", ("snapshot", "kind", "fields"))
+Change.__doc__ = """A change to one object in the snapshot numbered `snapshot`.
+`kind` is one of `ChangeHistory.ADDED`, `REMOVED` or `MODIFIED`, and
+`fields` is a tuple of the names of the fields that changed (see
+`structures.field_changes`); it is empty unless the object was modified.
+"type" stands for a change of type."""
+
+class ChangeHistory(_TraceSidecar):
+    """For each uid in a trace, the snapshots where the object was added,
+    removed or modified.  Modifying an object means changing its own fields,
+    not the objects it refers to.
+
+    Building it decodes the trace once, one snapshot at a time.  Objects
+    that a delta snapshot doesn't mention aren't looked at, so that part
+    costs time in proportion to the size of the delta.
+    """
+    suffix = HISTORY_SUFFIX
+    version = 1
+    ADDED = "added"
+    REMOVED = "removed"
+    MODIFIED = "modified"
+
+    def __init__(self, changes, length, size, mtime_ns):
+        super().__init__(size, mtime_ns)
+        # uid -> [Change, ...] in order of snapshot
+        self._changes = changes
+        self.length = length
+
+    def __len__(self):
+        """The number of snapshots in the trace"""
+        return self.length
+
+    def __contains__(self, uid):
+        return uid in self._changes
+
+    def __iter__(self):
+        return iter(self._changes)
+
+    def changes(self, uid):
+        """Return the `Change`s to the object `uid`, oldest first"""
+        return list(self._changes.get(uid, ()))
+
+    def snapshots(self, uid):
+        """Return the numbers of the snapshots where the object `uid` changed"""
+        return [change.snapshot for change in self._changes.get(uid, ())]
+
+    def last_change(self, uid, snapshot=None, field=None):
+        """Return the latest `Change` to the object `uid` in or before the
+        given snapshot (by default the last one), or None.  If `field` is
+        given, only count changes to that field, along with the object
+        being added or removed.
+        """
+        for change in reversed(self._changes.get(uid, ())):
+            if snapshot is not None and change.snapshot > snapshot:
+                continue
+            if (field is None or change.kind != self.MODIFIED or
+                    field in change.fields):
+                return change
+        return None
+
+    @classmethod
+    def build(cls, path, trusted=False):
+        """Decode the trace at `path` and record what changes where"""
+        stat = os.stat(path)
+        changes = {}
+        previous = None
+        length = 0
+        with open(path, "r", encoding="utf-8") as f:
+            scanner = json_objects.SnapshotScanner(f)
+            decoder = json_objects.TraceDecoder()
+            for i, span in enumerate(scanner):
+                snapshot = decoder.decode(
+                    json_objects.parse_snapshot(span.text, trusted=trusted))
+                for change in cls._compare(previous, snapshot, decoder.delta_uids):
+                    changes.setdefault(change[0], []).append(Change(i, *change[1:]))
+                previous = snapshot
+                length = i + 1
+        if scanner.truncated_at is not None:
+            logger.info("ignoring incomplete snapshot at the end of %s", path)
+        return cls(changes, length, stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    def _compare(cls, previous, snapshot, uids=None):
+        # Yield (uid, kind, fields) for the objects that differ between two
+        # consecutive snapshots, looking only at `uids` if they're given
+        if uids is None:
+            uids = set(snapshot.obj_table)
+            if previous is not None:
+                uids.update(previous.obj_table)
+            uids.discard(structures.Null.uid)
+        for uid in sorted(uids):
+            old = None if previous is None else _lookup_uid(previous, uid)
+            new = _lookup_uid(snapshot, uid)
+            if old is new:
+                continue
+            elif old is None:
+                yield uid, cls.ADDED, ()
+            elif new is None:
+                yield uid, cls.REMOVED, ()
+            elif type(old) is not type(new):
+                yield uid, cls.MODIFIED, ("type",)
+            else:
+                fields = sorted({change.field for change in
+                                 structures.field_changes(uid, old, new)})
+                if fields:
+                    yield uid, cls.MODIFIED, tuple(fields)
+
+    def _to_json(self):
+        return {"length": self.length,
+                "changes": {uid: [[c.snapshot, c.kind, list(c.fields)]
+                                  for c in changes]
+                            for uid, changes in self._changes.items()}}
+
+    @classmethod
+    def _from_json(cls, raw, size, mtime_ns):
+        changes = {uid: [Change(i, kind, tuple(fields))
+                         for i, kind, fields in uid_changes]
+                   for uid, uid_changes in raw["changes"].items()}
+        return cls(changes, raw["length"], size, mtime_ns)
+
+def _lookup_uid(snapshot, uid):
+    try:
+        return snapshot.obj_table.getuid(uid)
+    except KeyError:
+        return None
+
+class LazySnapshotSequence(collections.abc.Sequence):
+    """A read-only sequence of the snapshots in a trace file.
+
+    Indexing decodes just the requested snapshot, so getting the last
+    snapshot of a long trace costs about as much as getting the first.  A
+    delta snapshot also needs the snapshots back to the last full one.  With
+    `lazy=True`, full snapshots are finalized lazily (see
+    `structures.ObjectTable.finalize`).  If `roots` or `root_vars` are given,
+    full snapshots only include what is reachable from those uids or
+    variable names (see `json_objects.decode_snapshot`).
+    """
+    def __init__(self, path, index=None, use_sidecar=True, trusted=False,
+                 lazy=False, roots=None, root_vars=None):
+        self.path = path
+        if index is None:
+            index = SnapshotIndex.for_trace(path, use_sidecar=use_sidecar)
+        self.index = index
+        self.trusted = trusted
+        self.lazy = lazy
+        self.roots = roots
+        self.root_vars = root_vars
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        # A delta snapshot is decoded by replaying it on top of the nearest
+        # full snapshot before it
+        raw_snapshots = [self._parse(i)]
+        if ((self.roots is not None or self.root_vars is not None) and
+                not json_objects.is_delta_snapshot(raw_snapshots[0])):
+            return json_objects.decode_snapshot(
+                *raw_snapshots[0], lazy=self.lazy, roots=self.roots,
+                root_vars=self.root_vars)
+        while json_objects.is_delta_snapshot(raw_snapshots[-1]):
+            i -= 1
+            if i < 0:
+                raise json_objects.JSONObjectError(
+                    "a delta snapshot must come after another snapshot")
+            raw_snapshots.append(self._parse(i))
+        decoder = json_objects.TraceDecoder(lazy=self.lazy)
+        for raw_snapshot in reversed(raw_snapshots):
+            snapshot = decoder.decode(raw_snapshot)
+        return snapshot
+
+    def _parse(self, i):
+        return json_objects.parse_snapshot(self.snapshot_text(i),
+                                           trusted=self.trusted)
+
+    def change_history(self):
+        """Return the `ChangeHistory` of the trace, from its sidecar file if
+        that is up to date"""
+        return ChangeHistory.for_trace(self.path, trusted=self.trusted)
+
+    def snapshot_text(self, i):
+        """Return the undecoded JSON text of the `i`th snapshot"""
+        start, stop = self.index.spans[i]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(stop - start).decode("utf-8")
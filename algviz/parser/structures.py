@@ -1,52 +1,567 @@
-import collections
 import abc
+import array
+import bisect
+import collections
+import collections.abc
+import hashlib
+import itertools
+import json
+import sys
+
+class _TableIndexes:
+    # Secondary indexes of an ObjectTable.  The sets of keys are dicts with
+    # None values, so they keep the order the objects were added in.
+    def __init__(self):
+        self.by_type = {}  # concrete type -> keys
+        self.by_metadata = {}  # metadata key -> keys
+        self.by_var = {}  # var name -> key
+
+    def add(self, key, obj):
+        # Called for every object decoded, so kept cheap
+        keys = self.by_type.get(type(obj))
+        if keys is None:
+            keys = self.by_type[type(obj)] = {}
+        keys[key] = None
+        metadata = getattr(obj, "_metadata", None)
+        if metadata:
+            for meta_key in metadata:
+                self.by_metadata.setdefault(meta_key, {})[key] = None
+
+    def remove(self, key, obj):
+        self.by_type.get(type(obj), {}).pop(key, None)
+        for meta_key in getattr(obj, "_metadata", None) or ():
+            self.by_metadata.get(meta_key, {}).pop(key, None)
+
+def _matching_types(types, type_, subclasses):
+    # The types among `types` that `by_type(type_, subclasses)` looks for
+    if subclasses:
+        return [t for t in types if issubclass(t, type_)]
+    return [type_] if type_ in types else []
 
 class ObjectTable(dict):
     """A table of references to objects.  Used to retrieve an object given its UID.
 
-    May be extended later for more interesting parser behaviors.
+    The keys are the uids themselves, as interned `str`s.  Anything equal to
+    the uid works for looking an object up, including an
+    `ObjectTableReference`, without allocating anything.
+
+    Unless `indexed=False` is passed, the table also keeps indexes for
+    finding objects by type (`by_type`), by variable name (`by_var`) and by
+    metadata (`by_metadata`) without looking at every object.  The indexes
+    follow `table[key] = obj` and `del table[key]`.  Other ways of changing
+    the table (e.g. `dict.update`), and changes to an object's metadata
+    after it was added, bypass them.
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self[ObjectTableReference(Null.uid)] = Null
+    # Class default, so `__setitem__` works while unpickling, before the
+    # instance's own attributes have been restored
+    _indexes = None
+
+    def __init__(self, *args, indexed=True, **kwargs):
+        super().__init__()
+        if indexed:
+            self._indexes = _TableIndexes()
+        for key, obj in dict(*args, **kwargs).items():
+            self[key] = obj
+        self[Null.uid] = Null
+        # Keys of objects whose references haven't been resolved yet, after
+        # `finalize(lazy=True)`
+        self._unresolved = set()
+        self._strict = True
 
     def __setitem__(self, key, val):
-        if not isinstance(key, ObjectTableReference):
-            raise TypeError("Key must be an `ObjectTableReference`, not {}".format(key))
+        if not isinstance(key, str):
+            raise TypeError("Key must be a uid (`str`), not {!r}".format(key))
+        # Store the plain uid, not an ObjectTableReference
+        key = sys.intern(str.__str__(key))
+        if self._indexes is not None:
+            if key in self:
+                self._indexes.remove(key, super().__getitem__(key))
+            self._indexes.add(key, val)
         return super().__setitem__(key, val)
 
+    def __delitem__(self, key):
+        obj = super().__getitem__(key)
+        super().__delitem__(key)
+        if self._indexes is not None:
+            self._indexes.remove(key, obj)
+            if self._indexes.by_var:
+                self._indexes.by_var = {var: ref for var, ref
+                                        in self._indexes.by_var.items()
+                                        if ref != key}
+
+    def index_var(self, var, key):
+        """Record that the variable `var` names the object at `key`"""
+        if self._indexes is not None:
+            self._indexes.by_var[var] = sys.intern(str.__str__(key))
+
+    def _require_indexes(self):
+        if self._indexes is None:
+            raise TypeError("this ObjectTable was made with indexed=False")
+        return self._indexes
+
+    def by_type(self, type_, subclasses=False):
+        """Return a list of the objects whose type is exactly `type_`, in the
+        order they were added.  With `subclasses=True`, objects of subclasses
+        of `type_` are included too, grouped by type."""
+        index = self._require_indexes().by_type
+        return [self[key] for t in _matching_types(index, type_, subclasses)
+                for key in index[t]]
+
+    def by_var(self, var):
+        """Return the object that the variable `var` names.  Raises
+        `KeyError` if there is none."""
+        return self[self._require_indexes().by_var[var]]
+
+    def by_metadata(self, meta_key, *value):
+        """Return a list of the objects whose metadata has the key
+        `meta_key`, or, if a value is given too, maps it to that value"""
+        objects = [self[key] for key in
+                   self._require_indexes().by_metadata.get(meta_key, ())]
+        if value:
+            objects = [obj for obj in objects if obj.metadata[meta_key] == value[0]]
+        return objects
+
     def __getitem__(self, key):
-        if isinstance(key, ObjectTableReference):
+        obj = self._lookup(key)
+        if self._unresolved and isinstance(key, str) and key in self._unresolved:
+            self._resolve_from(key)
+        return obj
+
+    def _lookup(self, key):
+        # Look up `key` without resolving anything
+        if isinstance(key, str):
             return super().__getitem__(key)
         elif isinstance(key, DataStructure):
             return key
         else:
-            raise TypeError("Expected a DataStructure or an ObjectTableReference, not {!r}"
+            raise TypeError("Expected a DataStructure or a uid, not {!r}"
                             .format(key))
 
-    def finalize(self):
-        for obj in self.values():
+    def finalize(self, lazy=False, strict=True):
+        """Replace the `ObjectTableReference`s inside the objects in the table
+        with the objects they refer to.
+
+        With `lazy=True`, nothing is replaced until an object is looked up in
+        the table.  Then that object and everything reachable from it are
+        resolved, and the rest of the table is left alone.
+
+        With `strict=False`, references to objects that aren't in the table
+        are left as they are instead of raising `KeyError`.
+        """
+        self._strict = strict
+        if lazy:
+            self._unresolved = set(self)
+            return
+        self._unresolved = set()
+        lookup = _UnresolvingLookup(self)
+        for obj in super().values():
             if hasattr(obj, 'untablify'):
-                obj.untablify(self)
+                obj.untablify(lookup)
+
+    def _resolve_from(self, key):
+        lookup = _UnresolvingLookup(self)
+        stack = [key]
+        while stack:
+            key = stack.pop()
+            if key not in self._unresolved:
+                continue
+            self._unresolved.discard(key)
+            obj = super().__getitem__(key)
+            if not hasattr(obj, 'untablify'):
+                continue
+            stack.extend(ref.uid for ref in iter_references(obj))
+            obj.untablify(lookup)
+
+    def resolve_all(self):
+        """Finish resolving a table that was finalized lazily"""
+        if self._unresolved:
+            self.finalize(strict=self._strict)
+
+    # Anything that hands out many objects at once resolves the whole table
+    def values(self):
+        self.resolve_all()
+        return super().values()
+
+    def items(self):
+        self.resolve_all()
+        return super().items()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        self.resolve_all()
+        if isinstance(other, ObjectTable):
+            other.resolve_all()
+        return super().__eq__(other)
+
+    def getuid(self, uid):
+        """Convenience method to return the object with the given uid (`str` type)"""
+        if not isinstance(uid, str):
+            raise TypeError("uid must be a string, not {}".format(uid))
+        return self[uid]
+
+class _UnresolvingLookup:
+    # Looks things up in an ObjectTable for `untablify` without triggering
+    # lazy resolution
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, key):
+        try:
+            return self._table._lookup(key)
+        except KeyError:
+            if self._table._strict:
+                raise
+            return key
+
+class ObjectTableReference(str):
+    """A reference to the object with the given uid, which stands in for
+    the object until the references in a table are resolved.
+
+    It is the uid itself, as a `str` subclass, so it hashes and compares
+    like the uid and looks objects up in an `ObjectTable` directly.
+    `ref.uid` gives back the plain `str`.
+    """
+    __slots__ = ()
+
+    def __new__(cls, uid):
+        return super().__new__(cls, uid)
+
+    @property
+    def uid(self):
+        return str.__str__(self)
+
+    def __repr__(self):
+        return "ObjectTableReference(uid={!r})".format(str.__str__(self))
+
+    def __reduce__(self):
+        return (ObjectTableReference, (str.__str__(self),))
+
+_REMOVED = object()
+
+class ObjectHistory:
+    """The objects of a run of snapshots where each snapshot after the first
+    only lists the objects that changed (see `json_objects.TraceDecoder`).
+
+    `base` is the `ObjectTable` of the first snapshot, which is step 0.  For
+    each uid that changed later on, the history keeps the steps at which it
+    changed and the object it changed to, so the memory used grows with the
+    number of changes rather than with the number of steps.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.steps = 0
+        # uid -> ([steps], [objects, or _REMOVED])
+        self._versions = {}
+        self._lengths = [len(base)]
+        # Like the indexes of an ObjectTable, for the objects changed after
+        # step 0; each holds every uid that was ever changed to a match
+        self._changed = _TableIndexes()
+        # var -> ([steps], [uids, or _REMOVED])
+        self._var_versions = {}
+
+    def add_step(self, changed, removed, names=None):
+        """Record a new step where the uids in the `changed` dict now refer to
+        its values and the uids in `removed` no longer exist.  If `names` (a
+        dict of variable names to uids) is given, those are the variables
+        from this step on.  Returns the number of the new step.
+        """
+        self.steps += 1
+        step = self.steps
+        length = self._lengths[-1]
+        for uid, obj in changed.items():
+            if not self._exists(uid, step - 1):
+                length += 1
+            self._add_version(self._versions, uid, step, obj)
+            self._changed.add(uid, obj)
+        for uid in removed:
+            if self._exists(uid, step - 1):
+                length -= 1
+                self._add_version(self._versions, uid, step, _REMOVED)
+        self._lengths.append(length)
+        if names is not None:
+            old = self.names(step - 1)
+            for var, uid in names.items():
+                if old.get(var) != uid:
+                    self._add_version(self._var_versions, var, step, uid)
+            for var in old.keys() - names.keys():
+                self._add_version(self._var_versions, var, step, _REMOVED)
+        return step
+
+    @staticmethod
+    def _add_version(versions, key, step, obj):
+        steps, objects = versions.setdefault(key, ([], []))
+        if steps and steps[-1] == step:
+            objects[-1] = obj
+        else:
+            steps.append(step)
+            objects.append(obj)
+
+    def _exists(self, uid, step):
+        try:
+            self.lookup(uid, step)
+        except KeyError:
+            return False
+        return True
+
+    def lookup(self, uid, step):
+        """Return the object with the given uid as of `step`"""
+        versions = self._versions.get(uid)
+        if versions is not None:
+            steps, objects = versions
+            i = bisect.bisect_right(steps, step)
+            if i:
+                obj = objects[i - 1]
+                if obj is _REMOVED:
+                    raise KeyError(uid)
+                return obj
+        return dict.__getitem__(self.base, uid)
+
+    def uids(self, step):
+        """Iterate over the uids of the objects that exist as of `step`"""
+        for uid in self.base:
+            if uid not in self._versions or self._exists(uid, step):
+                yield uid
+        for uid, (steps, objects) in self._versions.items():
+            if (uid not in self.base and steps[0] <= step
+                    and self._exists(uid, step)):
+                yield uid
+
+    def length(self, step):
+        return self._lengths[step]
+
+    @staticmethod
+    def _version_at(versions, step):
+        # The latest of `versions` as of `step`, or None if there is none
+        steps, objects = versions
+        i = bisect.bisect_right(steps, step)
+        return objects[i - 1] if i else None
+
+    def name(self, var, step):
+        """Return the uid of the object the variable `var` names as of `step`"""
+        versions = self._var_versions.get(var)
+        if versions is not None:
+            uid = self._version_at(versions, step)
+            if uid is _REMOVED:
+                raise KeyError(var)
+            elif uid is not None:
+                return uid
+        return self.base._require_indexes().by_var[var]
+
+    def names(self, step):
+        """Return a dict of the variable names and their uids as of `step`"""
+        result = dict(self.base._require_indexes().by_var)
+        for var, versions in self._var_versions.items():
+            uid = self._version_at(versions, step)
+            if uid is _REMOVED:
+                result.pop(var, None)
+            elif uid is not None:
+                result[var] = uid
+        return result
+
+    def _candidates(self, index_name, key):
+        # The uids that may be in the index `index_name` under `key` at
+        # some step, in the order they were added
+        base = getattr(self.base._require_indexes(), index_name).get(key, {})
+        changed = getattr(self._changed, index_name).get(key, {})
+        return itertools.chain(base, (uid for uid in changed if uid not in base))
+
+    def by_type(self, type_, step, subclasses=False):
+        """Return a list of the objects as of `step` whose type is `type_`
+        (see `ObjectTable.by_type`)"""
+        types = dict.fromkeys(itertools.chain(self.base._require_indexes().by_type,
+                                              self._changed.by_type))
+        result = []
+        for t in _matching_types(types, type_, subclasses):
+            for uid in self._candidates("by_type", t):
+                try:
+                    obj = self.lookup(uid, step)
+                except KeyError:
+                    continue
+                if type(obj) is t:
+                    result.append(obj)
+        return result
+
+    def by_metadata(self, meta_key, step):
+        """Return a list of the objects as of `step` whose metadata has the
+        key `meta_key`"""
+        result = []
+        for uid in self._candidates("by_metadata", meta_key):
+            try:
+                obj = self.lookup(uid, step)
+            except KeyError:
+                continue
+            if meta_key in obj.metadata:
+                result.append(obj)
+        return result
+
+class ObjectTableView(collections.abc.Mapping):
+    """A read-only `ObjectTable` for one step of an `ObjectHistory`.
+
+    Objects that didn't change at this step are the same instances as in the
+    tables of the surrounding snapshots.
+    """
+    def __init__(self, history, step):
+        self.history = history
+        self.step = step
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.history.lookup(key, self.step)
+        elif isinstance(key, DataStructure):
+            return key
+        else:
+            raise TypeError("Expected a DataStructure or a uid, not {!r}"
+                            .format(key))
+
+    def __iter__(self):
+        return self.history.uids(self.step)
+
+    def __len__(self):
+        return self.history.length(self.step)
 
     def getuid(self, uid):
         """Convenience method to return the object with the given uid (`str` type)"""
         if not isinstance(uid, str):
             raise TypeError("uid must be a string, not {}".format(uid))
-        return self[ObjectTableReference(uid=uid)]
+        return self[uid]
+
+    def by_type(self, type_, subclasses=False):
+        """See `ObjectTable.by_type`"""
+        return self.history.by_type(type_, self.step, subclasses=subclasses)
+
+    def by_var(self, var):
+        """See `ObjectTable.by_var`"""
+        return self[self.history.name(var, self.step)]
 
-ObjectTableReference = collections.namedtuple("ObjectTableReference", ("uid",))
+    def by_metadata(self, meta_key, *value):
+        """See `ObjectTable.by_metadata`"""
+        objects = self.history.by_metadata(meta_key, self.step)
+        if value:
+            objects = [obj for obj in objects if obj.metadata[meta_key] == value[0]]
+        return objects
+
+class RelinkingTable:
+    """Looks up objects by uid in `obj_table`, for passing to `untablify` on
+    a copy of an object from an earlier snapshot.
+
+    Objects the table has a version of are replaced by that version.  Other
+    objects (and literals) are left alone.
+    """
+    def __init__(self, obj_table):
+        self.obj_table = obj_table
+
+    def __getitem__(self, key):
+        uid = getattr(key, "uid", None)
+        if uid is None:
+            return self.obj_table[key]
+        try:
+            return self.obj_table[uid]
+        except KeyError:
+            return key
+
+def iter_references(obj):
+    """Yield the objects (or `ObjectTableReference`s) with uids that `obj`
+    refers to, not counting `Null`.
+    """
+    for _, value in obj.fields():
+        items = value if isinstance(value, (list, frozenset)) else (value,)
+        for item in items:
+            if (item is not Null and
+                    isinstance(item, (DataStructure, ObjectTableReference)) and
+                    getattr(item, "uid", None) is not None):
+                yield item
 
 Snapshot = collections.namedtuple("Snapshot", ("names", "obj_table"))
 
+class LazyNames(collections.abc.Mapping):
+    """The variable names of a lazily finalized snapshot.  Maps each name to
+    its object, resolving the object's references when it is looked up."""
+    def __init__(self, refs, obj_table):
+        self._refs = refs
+        self.obj_table = obj_table
+
+    def __getitem__(self, name):
+        return self.obj_table[self._refs[name]]
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+class _EmptyMapping(collections.abc.Mapping):
+    """An immutable empty mapping.  There is only one, `EMPTY_METADATA`."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def __repr__(self):
+        return "EMPTY_METADATA"
+
+    def __reduce__(self):
+        return "EMPTY_METADATA"
+
+EMPTY_METADATA = _EmptyMapping()
+
 class DataStructure(metaclass=abc.ABCMeta):
+    # Slots keep the many small objects of a big snapshot compact.  Subclasses
+    # should declare `__slots__` too, or they get a `__dict__` anyway.
+    __slots__ = ("uid", "_metadata", "_fingerprint")
 
     def __init__(self, uid=None, metadata=None):
         self.uid = uid
-        if metadata is not None:
-            self.metadata = metadata
-        else:
-            self.metadata = {}
+        self._metadata = metadata
+        self._fingerprint = None
+
+    @property
+    def metadata(self):
+        """The object's metadata.  Objects without any share `EMPTY_METADATA`,
+        which can't be modified; assign a new dict to change it."""
+        if self._metadata is None:
+            return EMPTY_METADATA
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
+    @property
+    def fingerprint(self):
+        """A digest (bytes) of what the object holds: its type, metadata and
+        data, and the fingerprints of the objects it refers to, but not its
+        uid.  Objects with equal fingerprints look the same, so whole
+        subtrees can be compared at once.
+
+        Within a cycle, a reference to another object of the cycle counts as
+        that object's uid, and each object's fingerprint also covers a digest
+        of the whole cycle, so the result doesn't depend on which object is
+        asked first.  The fingerprint is computed on first use and kept, so
+        call `invalidate_fingerprint` after changing the object.
+        """
+        if self._fingerprint is None:
+            _compute_fingerprints(self)
+        return self._fingerprint
+
+    def _literal_content(self):
+        # Bytes for whatever the fingerprint should cover besides `fields()`
+        return b""
+
+    def invalidate_fingerprint(self):
+        """Forget the fingerprint, e.g. after changing the object.  Objects
+        that refer to this one aren't affected."""
+        self._fingerprint = None
 
     def same_object(self, other):
         """Does `other` represent the same object, possibly at a different
@@ -57,6 +572,13 @@ class DataStructure(metaclass=abc.ABCMeta):
         """
         return type(self) == type(other) and self.uid == other.uid
 
+    def fields(self):
+        """Return `(name, value)` pairs for the attributes that may refer to
+        other objects.  A value is a single item, a `list` of items in a fixed
+        order, or a `frozenset` of items.
+        """
+        return ()
+
     @abc.abstractmethod
     def untablify(self, obj_table):
         """
@@ -73,13 +595,117 @@ class DataStructure(metaclass=abc.ABCMeta):
                 other.uid == self.uid)
 
     def __hash__(self):
-        return hash(ObjectTableReference(self.uid))
+        # The same as the hash of the uid, and of references to the object
+        return hash(self.uid)
+
+def _is_object(item):
+    # A DataStructure instance with a fingerprint, as opposed to a literal or
+    # an ObjectTableReference.  (Cheaper than an ABC isinstance check.)
+    return hasattr(item, "_fingerprint")
+
+def _fingerprint_part(item, cycle):
+    # The bytes standing for `item` in the fingerprint of something holding it
+    if _is_object(item):
+        if id(item) in cycle:
+            return b"@" + str(item.uid).encode()
+        return b"#" + item._fingerprint
+    elif isinstance(item, ObjectTableReference):
+        return b"@" + str(item.uid).encode()
+    return repr(item).encode()
+
+def _fingerprint_of(obj, cycle):
+    # Hash `obj`, whose referents outside `cycle` (a set of ids) already have
+    # their fingerprints
+    h = hashlib.blake2b(type(obj).__name__.encode(), digest_size=16)
+    if obj.metadata:
+        h.update(json.dumps(obj.metadata, sort_keys=True, default=repr).encode())
+    h.update(b"\0" + obj._literal_content())
+    for name, value in obj.fields():
+        h.update(b"\0" + name.encode())
+        if isinstance(value, frozenset):
+            parts = sorted(_fingerprint_part(item, cycle) for item in value)
+        elif isinstance(value, (list, array.array, memoryview)):
+            parts = [_fingerprint_part(item, cycle) for item in value]
+        else:
+            h.update(b"=" + _fingerprint_part(value, cycle))
+            continue
+        h.update(b"[")
+        for part in parts:
+            h.update(len(part).to_bytes(4, "little") + part)
+    return h.digest()
+
+def _fingerprint_component(component):
+    # Set the fingerprints of a strongly connected component, i.e. a set of
+    # objects that all refer to each other through cycles.  Every reference
+    # inside the component counts as a uid, so the result doesn't depend on
+    # which object the walk reached first.  Each object's fingerprint then
+    # also covers a digest of the whole component.
+    cycle = {id(obj) for obj in component}
+    own = [(_fingerprint_of(obj, cycle), obj) for obj in component]
+    if len(own) == 1:
+        own[0][1]._fingerprint = own[0][0]
+        return
+    h = hashlib.blake2b(digest_size=16)
+    for part in sorted(str(obj.uid).encode() + b"=" + digest
+                       for digest, obj in own):
+        h.update(len(part).to_bytes(4, "little") + part)
+    shared = h.digest()
+    for digest, obj in own:
+        obj._fingerprint = hashlib.blake2b(digest + shared,
+                                           digest_size=16).digest()
+
+def _unfingerprinted_referents(obj):
+    for _, value in obj.fields():
+        items = value if isinstance(value, (list, frozenset)) else (value,)
+        for item in items:
+            if _is_object(item) and item._fingerprint is None:
+                yield item
+
+def _compute_fingerprints(root):
+    # Tarjan's strongly connected components algorithm, with an explicit
+    # stack so long chains of objects don't hit the recursion limit.
+    # Components are finished referents first, so everything outside a
+    # component already has its fingerprint when the component is hashed.
+    index, low = {}, {}
+    members = []  # objects in components that aren't finished yet
+    on_members = set()
+    def visit(obj):
+        index[id(obj)] = low[id(obj)] = len(index)
+        members.append(obj)
+        on_members.add(id(obj))
+        work.append((obj, _unfingerprinted_referents(obj)))
+    work = []
+    visit(root)
+    while work:
+        obj, referents = work[-1]
+        for item in referents:
+            if id(item) not in index:
+                visit(item)
+                break
+            elif id(item) in on_members:
+                low[id(obj)] = min(low[id(obj)], index[id(item)])
+        else:
+            work.pop()
+            if work:
+                parent = id(work[-1][0])
+                low[parent] = min(low[parent], low[id(obj)])
+            if low[id(obj)] == index[id(obj)]:
+                component = []
+                while True:
+                    item = members.pop()
+                    on_members.discard(id(item))
+                    component.append(item)
+                    if item is obj:
+                        break
+                _fingerprint_component(component)
 
 # make int and float literals appear to be DataStructure subclasses
 DataStructure.register(int)
 DataStructure.register(float)
 
 class Pointer(DataStructure):
+    __slots__ = ("referent",)
+
     def __init__(self, referent, **kwargs):
         super().__init__(**kwargs)
         self.referent = referent
@@ -91,26 +717,263 @@ class Pointer(DataStructure):
                 isinstance(other, Pointer) and
                 other.referent == self.referent)
 
+    def fields(self):
+        return (("referent", self.referent),)
+
     def untablify(self, obj_table):
         self.referent = obj_table[self.referent]
 
     def __hash__(self):
         return super().__hash__()
 
-class Array(collections.UserList, DataStructure):
-    """An array data structure"""
-    def __init__(self, *args, **kwargs):
-        collections.UserList.__init__(self, *args)
+def pack_numbers(items):
+    """Return `items` packed into a typed `array.array` if they are all ints
+    that fit in 64 bits (typecode "q") or all floats (typecode "d").
+    Otherwise, including when `items` is empty, return None.
+
+    Mixed ints and floats are left alone, since packing them as floats
+    would change how the ints are shown.
+    """
+    if not items:
+        return None
+    first = type(items[0])
+    if first is int:
+        # array.array checks the types in C; only bools would slip through
+        try:
+            packed = array.array("q", items)
+        except (TypeError, OverflowError):
+            return None
+        if bool in map(type, items):
+            return None
+        return packed
+    elif first is float:
+        for item in items:
+            if type(item) is not float:
+                return None
+        return array.array("d", items)
+    return None
+
+def _is_typed(data):
+    # Typed storage is an `array.array`, or a memoryview of part of one
+    return isinstance(data, (array.array, memoryview))
+
+def _typecode(data):
+    if type(data) is memoryview:
+        return data.format
+    return getattr(data, "typecode", None)
+
+def _fits_typed(data, items):
+    # Whether the typed storage `data` can hold all of `items` as they are
+    kind = float if _typecode(data) == "d" else int
+    return all(type(item) is kind for item in items)
+
+def _copy_data(data):
+    # A copy of an Array's storage that the Array can resize
+    if type(data) is memoryview:
+        return array.array(data.format, data.tobytes())
+    return data[:]
+
+class Array(collections.abc.MutableSequence, DataStructure):
+    """An array data structure.
+
+    `data` is usually a list, but an array of plain numbers may keep them in
+    an `array.array` instead (see `pack_numbers`), which is much smaller.
+    Storing anything but a number of the same kind (e.g. a float or an
+    object in an array of ints) switches the storage back to a list.
+
+    Slicing an array with typed storage doesn't copy anything: the slice is
+    an Array whose `data` is a memoryview of the same storage, so setting an
+    item in either one shows in the other.  They go their separate ways once
+    either one changes length or switches to a list, which first gives it a
+    copy of its own.  Slicing an array of any other kind copies it, as with
+    a list.
+
+    Besides the `MutableSequence` methods, Arrays can be sorted, copied,
+    added, multiplied and compared (by content) like lists.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, initlist=None, **kwargs):
         DataStructure.__init__(self, **kwargs)
+        # Like UserList, the underlying list is accessible as `data`
+        if initlist is None:
+            self.data = []
+        elif _is_typed(initlist):
+            self.data = initlist
+        else:
+            self.data = list(initlist)
+
+    @property
+    def typecode(self):
+        """The `array` typecode of typed storage, or None for a list"""
+        return _typecode(self.data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if type(self.data) is array.array:
+                return self.__class__(memoryview(self.data)[i])
+            return self.__class__(self.data[i])
+        return self.data[i]
+
+    def _make_room_for(self, items):
+        # Switch from typed storage to a list if `items` don't fit in it
+        if _is_typed(self.data) and not _fits_typed(self.data, items):
+            self.data = self.data.tolist()
+
+    def _resize(self, change):
+        # Call `change` on the storage to change its length.  Typed storage
+        # that is a view, or that has views of it, can't be resized, so it is
+        # copied first.
+        if type(self.data) is memoryview:
+            self.data = _copy_data(self.data)
+        try:
+            change(self.data)
+        except BufferError:
+            self.data = _copy_data(self.data)
+            change(self.data)
+
+    def __setitem__(self, i, item):
+        if isinstance(i, slice):
+            item = list(item)
+            self._make_room_for(item)
+        else:
+            self._make_room_for((item,))
+        if not _is_typed(self.data):
+            self.data[i] = item
+            return
+        try:
+            if not isinstance(i, slice):
+                self.data[i] = item
+                return
+            packed = array.array(_typecode(self.data), item)
+        except (OverflowError, ValueError):
+            # An int too big for 64 bits (a memoryview raises ValueError)
+            self.data = self.data.tolist()
+            self.data[i] = item
+            return
+        if len(range(*i.indices(len(self.data)))) == len(packed):
+            # Same length, so views still share the storage
+            self.data[i] = packed
+        else:
+            self._resize(lambda data: data.__setitem__(i, packed))
+
+    def __delitem__(self, i):
+        if type(self.data) is list:
+            del self.data[i]
+        else:
+            self._resize(lambda data: data.__delitem__(i))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __contains__(self, item):
+        return item in self.data
+
+    def insert(self, i, item):
+        self._make_room_for((item,))
+        try:
+            self._resize(lambda data: data.insert(i, item))
+        except OverflowError:
+            self.data = self.data.tolist()
+            self.data.insert(i, item)
+
+    def extend(self, items):
+        items = list(items)
+        self._make_room_for(items)
+        if _is_typed(self.data):
+            try:
+                items = array.array(_typecode(self.data), items)
+            except OverflowError:
+                self.data = self.data.tolist()
+        self._resize(lambda data: data.extend(items))
+
+    def clear(self):
+        self.data = [] if type(self.data) is list else array.array(self.typecode)
+
+    def sort(self, *args, **kwargs):
+        if _is_typed(self.data):
+            self.data[:] = array.array(_typecode(self.data),
+                                       sorted(self.data, *args, **kwargs))
+        else:
+            self.data.sort(*args, **kwargs)
+
+    def copy(self):
+        """Return a new Array with a copy of the storage, as `list.copy`
+        would.  It has no uid or metadata."""
+        return self.__class__(_copy_data(self.data))
+
+    def _as_list(self):
+        return self.data if type(self.data) is list else self.data.tolist()
+
+    @staticmethod
+    def _cast(other):
+        # The list to compare `other` with, like UserList
+        return other._as_list() if isinstance(other, Array) else other
+
+    def __lt__(self, other):
+        return self._as_list() < self._cast(other)
+
+    def __le__(self, other):
+        return self._as_list() <= self._cast(other)
+
+    def __gt__(self, other):
+        return self._as_list() > self._cast(other)
+
+    def __ge__(self, other):
+        return self._as_list() >= self._cast(other)
+
+    def __add__(self, other):
+        result = self.copy()
+        result.extend(other)
+        return result
+
+    def __radd__(self, other):
+        result = self.__class__(other)
+        result.extend(self)
+        return result
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __mul__(self, n):
+        return self.__class__(_copy_data(self.data) * n)
+
+    __rmul__ = __mul__
+
+    def __imul__(self, n):
+        self._resize(lambda data: data.__imul__(n))
+        return self
+
+    def __repr__(self):
+        return repr(self._as_list())
+
+    def __getstate__(self):
+        # A view is pickled (and copied) with a copy of the storage, since
+        # memoryviews can't be pickled
+        state = {name: getattr(self, name) for cls in type(self).__mro__
+                 for name in getattr(cls, "__slots__", ()) if hasattr(self, name)}
+        if type(self.data) is memoryview:
+            state["data"] = _copy_data(self.data)
+        return (None, state)
+
+    def fields(self):
+        return (("data", self.data),)
 
     def untablify(self, obj_table):
-        # UserList has its underlying list accessible as a member
-        self.data = [obj_table[elt] for elt in self.data]
+        # Typed storage holds only numbers, which never refer to anything
+        if not _is_typed(self.data):
+            self.data = [obj_table[elt] for elt in self.data]
 
     def __eq__(self, other):
-        return (isinstance(other, Array) and
-                DataStructure.__eq__(self, other) and
-                collections.UserList.__eq__(self, other))
+        if not (isinstance(other, Array) and DataStructure.__eq__(self, other)):
+            return False
+        if type(self.data) is type(other.data):
+            return self.data == other.data
+        return len(self.data) == len(other.data) and list(self) == list(other)
 
     def __hash__(self):
         return DataStructure.__hash__(self)
@@ -125,9 +988,11 @@ class _Singleton(abc.ABCMeta):
 
 class NullType(DataStructure, metaclass=_Singleton):
     """A null value.  Similar to python's None.  Fun to make."""
+    __slots__ = ()
+    metadata = None  # no static dictionary allowed
+
     def __init__(self):
         super().__init__(uid="#null")
-        del self.metadata  # no static dictionary allowed
 
     def untablify(self, obj_table):
         pass
@@ -138,27 +1003,239 @@ class NullType(DataStructure, metaclass=_Singleton):
     def __repr__(self):
         return "Null"
 
+    def __reduce__(self):
+        # Unpickle as the existing singleton instead of a second NullType
+        return "Null"
+
 Null = NullType()
 
 class LinkedListNode(DataStructure):
+    __slots__ = ("value", "successor")
+
     def __init__(self, value, successor=Null, **kwargs):
         super().__init__(**kwargs)
         self.value = value
         self.successor = successor
 
+    def fields(self):
+        return (("value", self.value), ("successor", self.successor))
+
     def untablify(self, obj_table):
         self.value = obj_table[self.value]
         self.successor = obj_table[self.successor]
 
+class Adjacency:
+    """The adjacency structure of a `Graph`, in compressed sparse row (CSR)
+    form.
+
+    The graph's nodes get the ids 0, 1, ... in order of uid, and `nodes[i]`
+    is the node with id `i`.  Literal nodes (e.g. ints) come after the
+    objects, in order of type name and value.  `edges` is a sequence of the edges, in order
+    of uid or, for a `CompactEdgeSet`, the set itself.  For each node, the
+    ids of its successors (and the indices in `edges` of the edges leading
+    to them) are kept in one contiguous slice of a flat `array.array`, and
+    likewise for its predecessors.  Methods taking `i` want a node id; the
+    others take a node.  The `*_ids` methods return zero-copy `memoryview`s.
+
+    Ids belong to the graph, so a `Node` in several graphs has an id in
+    each.  Edges with an end that isn't among the graph's nodes are left
+    out.
+    """
+    __slots__ = ("nodes", "edges", "_ids", "_out_offsets", "_out_ids",
+                 "_out_edges", "_in_offsets", "_in_ids", "_in_edges")
+
+    def __init__(self, graph):
+        self.nodes = sorted(graph.nodes, key=self._order)
+        # Keyed by `CompactEdgeSet.end_key`, i.e. by uid for objects, which
+        # is much cheaper to hash than a DataStructure
+        key = CompactEdgeSet.end_key
+        self._ids = {key(node): i for i, node in enumerate(self.nodes)}
+        if isinstance(graph.edges, CompactEdgeSet):
+            # Work from the index arrays, without making any Edges
+            self.edges = graph.edges
+            end_ids = [self._ids.get(key(end)) for end in graph.edges.ends]
+            ends = [(end_ids[orig], end_ids[dest], k) for k, (orig, dest)
+                    in enumerate(zip(graph.edges.orig, graph.edges.dest))]
+        else:
+            self.edges = sorted(graph.edges, key=lambda edge: str(edge.uid))
+            ends = [(self._ids.get(key(edge.orig)), self._ids.get(key(edge.dest)), k)
+                    for k, edge in enumerate(self.edges)]
+        ends = [(orig, dest, k) for orig, dest, k in ends
+                if orig is not None and dest is not None]
+        self._out_offsets, self._out_ids, self._out_edges = self._compress(
+            len(self.nodes), [(orig, dest, k) for orig, dest, k in ends])
+        self._in_offsets, self._in_ids, self._in_edges = self._compress(
+            len(self.nodes), [(dest, orig, k) for orig, dest, k in ends])
+
+    @staticmethod
+    def _order(node):
+        # Sort key putting objects in order of uid, then literals
+        if hasattr(node, "uid"):
+            return (0, str(node.uid))
+        return (1, type(node).__name__, node)
+
+    @staticmethod
+    def _compress(node_count, triples):
+        # Counting sort of the (row, column, edge index) `triples` into CSR
+        # arrays: row i is ids[offsets[i]:offsets[i + 1]], and the matching
+        # slice of edge_indices holds the edge indices
+        offsets = array.array("q", bytes(8 * (node_count + 1)))
+        for row, _, _ in triples:
+            offsets[row + 1] += 1
+        for i in range(node_count):
+            offsets[i + 1] += offsets[i]
+        ids = array.array("q", bytes(8 * len(triples)))
+        edge_indices = array.array("q", bytes(8 * len(triples)))
+        fill = offsets[:-1]
+        for row, column, index in triples:
+            ids[fill[row]] = column
+            edge_indices[fill[row]] = index
+            fill[row] += 1
+        return offsets, ids, edge_indices
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def id(self, node):
+        """Return the id of `node`.  Raises `KeyError` if it isn't in the graph."""
+        return self._ids[CompactEdgeSet.end_key(node)]
+
+    def successor_ids(self, i):
+        return memoryview(self._out_ids)[self._out_offsets[i]:self._out_offsets[i + 1]]
+
+    def predecessor_ids(self, i):
+        return memoryview(self._in_ids)[self._in_offsets[i]:self._in_offsets[i + 1]]
+
+    def out_degree(self, node):
+        i = self.id(node)
+        return self._out_offsets[i + 1] - self._out_offsets[i]
+
+    def in_degree(self, node):
+        i = self.id(node)
+        return self._in_offsets[i + 1] - self._in_offsets[i]
+
+    def degree(self, node):
+        return self.out_degree(node) + self.in_degree(node)
+
+    def successors(self, node):
+        """Iterate over the destinations of the edges from `node`, with
+        repeats if there are parallel edges"""
+        return (self.nodes[j] for j in self.successor_ids(self.id(node)))
+
+    def predecessors(self, node):
+        return (self.nodes[j] for j in self.predecessor_ids(self.id(node)))
+
+    def out_edges(self, node):
+        i = self.id(node)
+        return (self.edges[k] for k in
+                self._out_edges[self._out_offsets[i]:self._out_offsets[i + 1]])
+
+    def in_edges(self, node):
+        i = self.id(node)
+        return (self.edges[k] for k in
+                self._in_edges[self._in_offsets[i]:self._in_offsets[i + 1]])
+
+class CompactEdgeSet(collections.abc.Set):
+    """The edges of a `Graph`, stored as parallel arrays instead of `Edge`
+    objects, for graphs with many edges that have no uids of their own.
+
+    Edge `i` goes from `ends[orig[i]]` to `ends[dest[i]]` and holds
+    `data[i]` (`data` is None if no edge holds anything).  An `Edge` is only
+    made when it is asked for, by iterating or with `set[i]`, and gets the
+    uid "<graph uid>#e<i>", which can't clash with other uids.
+
+    These edges had no uids in the input, so their uids only say where they
+    are in the graph's list of edges.  The "same" edge in two snapshots is
+    the edge at the same position, whatever its ends are.
+    """
+    __slots__ = ("graph_uid", "ends", "orig", "dest", "data")
+
+    def __init__(self, graph_uid, ends, orig, dest, data=None):
+        self.graph_uid = graph_uid
+        self.ends = ends
+        self.orig = orig
+        self.dest = dest
+        self.data = data
+
+    def __len__(self):
+        return len(self.orig)
+
+    def __getitem__(self, i):
+        return Edge(self.ends[self.orig[i]], self.ends[self.dest[i]],
+                    data=Null if self.data is None else self.data[i],
+                    uid="{}#e{}".format(self.graph_uid, range(len(self))[i]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __contains__(self, edge):
+        prefix = "{}#e".format(self.graph_uid)
+        uid = getattr(edge, "uid", None)
+        if not (isinstance(edge, Edge) and isinstance(uid, str) and
+                uid.startswith(prefix) and uid[len(prefix):].isdigit()):
+            return False
+        i = int(uid[len(prefix):])
+        return i < len(self) and self[i] == edge
+
+    __hash__ = collections.abc.Set._hash
+
+    @staticmethod
+    def end_key(end):
+        """What tells the end of an edge apart from other ends: its uid, or
+        `(type, value)` for a literal such as an int."""
+        if hasattr(end, "uid"):
+            return end.uid
+        return (type(end), end)
+
+    def endpoints(self):
+        """The (origin, destination) of each edge, in order, as `end_key`s"""
+        keys = [self.end_key(end) for end in self.ends]
+        return [(keys[o], keys[d]) for o, d in zip(self.orig, self.dest)]
+
+    def resolved(self, obj_table):
+        """Return a copy with the ends and data looked up in `obj_table`.
+        The index arrays are shared."""
+        return CompactEdgeSet(
+            self.graph_uid, [obj_table[end] for end in self.ends],
+            self.orig, self.dest,
+            None if self.data is None else [obj_table[d] for d in self.data])
+
 class Graph(DataStructure):
+    __slots__ = ("nodes", "edges", "_adjacency")
+
     def __init__(self, nodes, edges, **kwargs):
         super().__init__(**kwargs)
         self.nodes = frozenset(nodes)
-        self.edges = frozenset(edges)
+        # A CompactEdgeSet is kept as it is
+        self.edges = (edges if isinstance(edges, CompactEdgeSet)
+                      else frozenset(edges))
+        self._adjacency = None
+
+    @property
+    def adjacency(self):
+        """An `Adjacency` index of the graph, built on first use.  Assigning
+        to `nodes` or `edges` afterwards doesn't update it."""
+        if self._adjacency is None:
+            self._adjacency = Adjacency(self)
+        return self._adjacency
+
+    def fields(self):
+        if isinstance(self.edges, CompactEdgeSet):
+            # The objects compact edges refer to, and which edge joins which
+            # of them, rather than the edges
+            return (("nodes", self.nodes), ("edge_ends", self.edges.ends),
+                    ("edge_endpoints", self.edges.endpoints()),
+                    ("edge_data", self.edges.data or []))
+        return (("nodes", self.nodes), ("edges", self.edges))
 
     def untablify(self, obj_table):
         self.nodes = frozenset(obj_table[n] for n in self.nodes)
-        self.edges = frozenset(obj_table[e] for e in self.edges)
+        if isinstance(self.edges, CompactEdgeSet):
+            # A new set, since copies of the graph may share the old one
+            self.edges = self.edges.resolved(obj_table)
+        else:
+            self.edges = frozenset(obj_table[e] for e in self.edges)
+        self._adjacency = None
 
     def __eq__(self, other):
         return (isinstance(other, Graph) and
@@ -174,10 +1251,15 @@ class Node(DataStructure):
     # allows for a more flexible graph implementation (i.e. allowing subgraphs
     # over the same nodes).  If you want to store edges within your node, use
     # Tree or a subclass instead of this.
+    __slots__ = ("data",)
+
     def __init__(self, data, **kwargs):
         super().__init__(**kwargs)
         self.data = data
 
+    def fields(self):
+        return (("data", self.data),)
+
     def untablify(self, obj_table):
         self.data = obj_table[self.data]
 
@@ -190,12 +1272,17 @@ class Node(DataStructure):
         return super().__hash__()
 
 class Edge(DataStructure):
+    __slots__ = ("orig", "dest", "data")
+
     def __init__(self, orig, dest, data=Null, **kwargs):
         super().__init__(**kwargs)
         self.orig = orig
         self.dest = dest
         self.data = data
 
+    def fields(self):
+        return (("orig", self.orig), ("dest", self.dest), ("data", self.data))
+
     def untablify(self, obj_table):
         self.orig = obj_table[self.orig]
         self.dest = obj_table[self.dest]
@@ -214,6 +1301,8 @@ class Edge(DataStructure):
 class Widget(DataStructure):
     # Potentially our most useful DataStructure
     # Represents a `void` or "don't care" type.
+    __slots__ = ()
+
     def __eq__(self, other):
         return isinstance(other, Widget) and super().__eq__(other)
 
@@ -227,38 +1316,89 @@ class Tree(DataStructure):
     """A node with some number of children in a fixed order.  Edges are implicit."""
     # A common superclass could be used for linked-list nodes, since linked
     # lists are just skinny trees
+    __slots__ = ("data", "children", "_metrics")
 
     def __init__(self, data, children=None, **kwargs):
         super().__init__(**kwargs)
         self.data = data
         self.children = [] if children is None else children
+        self._metrics = None
 
     def is_leaf(self):
         return (len(self.children) == 0 or
                 all(child is Null for child in self.children))
-        
-    def width(self):
-        if self.is_leaf():
-            return 1
-        width = max(len(self.children),1)
-        for child in self.children:
-            child_width = child.width()
-            width = max(width, child_width)
-        return width
+
+    # The metrics below are computed for the whole subtree on first request
+    # and then cached on every node in it.  Children that are neither trees
+    # nor Null count as leaves.
+
+    def size(self):
+        """The number of nodes in this subtree"""
+        return self._get_metrics()[0]
 
     def height(self):
-        if self.is_leaf():
-            return 1
-        height = 0
-        for child in self.children:
-            if child is not Null:
-                child_height = child.height()
-                height = max(height,child_height)
-        return height + 1
+        """The number of levels in this subtree (1 for a leaf)"""
+        return self._get_metrics()[1]
+
+    def width(self):
+        """The largest number of children of any node in this subtree, or 1
+        for a leaf"""
+        return self._get_metrics()[2]
+
+    def leaf_count(self):
+        return self._get_metrics()[3]
+
+    def invalidate_metrics(self):
+        """Forget the cached metrics of this node.  Call this on each node
+        whose subtree changes (i.e. the changed node and its ancestors)."""
+        self._metrics = None
+
+    def _get_metrics(self):
+        if self._metrics is None:
+            self._compute_metrics()
+        return self._metrics
+
+    def _compute_metrics(self):
+        # Post-order traversal with an explicit stack, skipping subtrees whose
+        # metrics are already known.  Nodes whose children are being visited
+        # are exactly the ancestors of the node on top of the stack.
+        stack = [(self, False)]
+        in_progress = set()
+        while stack:
+            node, children_done = stack.pop()
+            if node._metrics is not None:
+                continue
+            if not children_done:
+                if id(node) in in_progress:
+                    raise ValueError("tree {!r} contains itself".format(node.uid))
+                in_progress.add(id(node))
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children
+                             if isinstance(child, Tree) and child._metrics is None)
+                continue
+            in_progress.discard(id(node))
+            size, height, width, leaves = 1, 0, max(len(node.children), 1), 0
+            for child in node.children:
+                if child is Null:
+                    continue
+                child_metrics = (child._metrics if isinstance(child, Tree)
+                                 else _LEAF_METRICS)
+                size += child_metrics[0]
+                height = max(height, child_metrics[1])
+                width = max(width, child_metrics[2])
+                leaves += child_metrics[3]
+            if leaves:
+                node._metrics = (size, height + 1, width, leaves)
+            else:
+                node._metrics = _LEAF_METRICS
+
+    def fields(self):
+        return (("data", self.data), ("children", self.children))
 
     def untablify(self, obj_table):
         self.data = obj_table[self.data]
         self.children = [obj_table[child] for child in self.children]
+        self._metrics = None
 
     def __eq__(self, other):
         return (super().__eq__(other) and
@@ -269,6 +1409,9 @@ class Tree(DataStructure):
     def __hash__(self):
         return super().__hash__()
 
+# (size, height, width, leaf count) of a leaf
+_LEAF_METRICS = (1, 1, 1, 1)
+
 class String(collections.UserString, DataStructure):
 
     def __init__(self, value, **kwargs):
@@ -278,6 +1421,9 @@ class String(collections.UserString, DataStructure):
     def untablify(self, obj_table):
         pass
 
+    def _literal_content(self):
+        return self.data.encode()
+
     def __eq__(self, other):
         return (isinstance(other, String) and
                 DataStructure.__eq__(self, other) and
@@ -285,3 +1431,117 @@ class String(collections.UserString, DataStructure):
 
     def __hash__(self):
         return DataStructure.__hash__(self)
+
+SnapshotDiff = collections.namedtuple(
+    "SnapshotDiff", ("added", "removed", "modified", "changes"))
+SnapshotDiff.__doc__ = """What changed between two snapshots.  `added`,
+`removed` and `modified` are sets of uids, and `changes` is a list of
+`FieldChange`s for the modified objects."""
+
+FieldChange = collections.namedtuple(
+    "FieldChange", ("uid", "field", "index", "old", "new"))
+FieldChange.__doc__ = """One change to a field of the object `uid`.
+
+`index` is the position of the changed item for ordered fields such as
+`Tree.children` or the cells of an `Array`, and None otherwise.  `old` and
+`new` are the values before and after; an item that was only added or only
+removed (from a longer list, or from a `Graph`'s nodes or edges) has None
+on the other side.  Changes to metadata are reported as the field
+"metadata", and changes to a `String` as the field "data".
+"""
+
+def _lookup_uid(obj_table, uid):
+    try:
+        return obj_table.getuid(uid)
+    except KeyError:
+        return None
+
+def _item_key(item):
+    # Items are the same if they're the same object or equal literals
+    if hasattr(item, "uid") and not isinstance(item, (int, float)):
+        return ("uid", item.uid)
+    return ("literal", item)
+
+def field_changes(uid, old, new):
+    """Yield the `FieldChange`s between `old` and `new`, two versions of the
+    object `uid` with the same type.  Referenced objects are compared by uid
+    only."""
+    if old.metadata != new.metadata:
+        yield FieldChange(uid, "metadata", None, old.metadata, new.metadata)
+    if old._literal_content() != new._literal_content():
+        yield FieldChange(uid, "data", None, old.data, new.data)
+    for (name, old_value), (_, new_value) in zip(old.fields(), new.fields()):
+        if isinstance(old_value, frozenset):
+            old_items = {_item_key(item): item for item in old_value}
+            new_items = {_item_key(item): item for item in new_value}
+            for key in old_items.keys() - new_items.keys():
+                yield FieldChange(uid, name, None, old_items[key], None)
+            for key in new_items.keys() - old_items.keys():
+                yield FieldChange(uid, name, None, None, new_items[key])
+        elif isinstance(old_value, (list, array.array, memoryview)):
+            if (isinstance(old_value, array.array) and
+                    isinstance(new_value, array.array) and old_value == new_value):
+                continue
+            for i in range(max(len(old_value), len(new_value))):
+                old_item = old_value[i] if i < len(old_value) else None
+                new_item = new_value[i] if i < len(new_value) else None
+                if _item_key(old_item) != _item_key(new_item):
+                    yield FieldChange(uid, name, i, old_item, new_item)
+        elif _item_key(old_value) != _item_key(new_value):
+            yield FieldChange(uid, name, None, old_value, new_value)
+
+def diff_snapshots(a, b, roots=None):
+    """Compare the snapshots `a` and `b` and return a `SnapshotDiff`.
+
+    Only the objects reachable from `roots` (uids; by default the objects
+    that variables name in either snapshot) are compared.  The walk starts at
+    the roots and skips any object that is the same object in both snapshots
+    (as unchanged objects are after a delta snapshot) or has the same
+    fingerprint, along with everything under it.  So once the fingerprints
+    are known (and they carry over between delta snapshots), the time taken
+    depends on the size of the changes rather than of the snapshots.  A side effect
+    is that swapping an object for one with equal content but a different
+    uid, somewhere below the top of an unchanged subtree, isn't noticed.
+
+    An object is modified if any of its own fields changed, not just
+    something that it refers to.  An object whose type changed is counted
+    as removed and added.
+    """
+    if roots is None:
+        roots = {obj.uid for names in (a.names, b.names)
+                 for obj in names.values() if hasattr(obj, "uid")}
+    added, removed, modified, changes = set(), set(), set(), []
+    seen = set()
+    stack = [(_lookup_uid(a.obj_table, uid), _lookup_uid(b.obj_table, uid))
+             for uid in roots]
+    while stack:
+        old, new = stack.pop()
+        if old is None and new is None:
+            continue
+        uid = (old if new is None else new).uid
+        if uid in seen or old is new:
+            continue
+        seen.add(uid)
+        if old is not None and new is not None and type(old) is not type(new):
+            removed.add(uid)
+            added.add(uid)
+        elif old is None:
+            added.add(uid)
+        elif new is None:
+            removed.add(uid)
+        elif old.fingerprint == new.fingerprint:
+            continue
+        else:
+            own_changes = list(field_changes(uid, old, new))
+            if own_changes:
+                modified.add(uid)
+                changes.extend(own_changes)
+        # Pair up what the two versions refer to, by uid
+        ref_uids = set()
+        for obj in (old, new):
+            if obj is not None:
+                ref_uids.update(ref.uid for ref in iter_references(obj))
+        stack.extend((_lookup_uid(a.obj_table, ref_uid),
+                      _lookup_uid(b.obj_table, ref_uid))
+                     for ref_uid in ref_uids - seen)
+    return SnapshotDiff(added, removed, modified, changes)
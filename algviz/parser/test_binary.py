@@ -0,0 +1,172 @@
+import io
+import json
+import os
+import unittest
+
+from . import binary
+from . import json_objects
+from . import structures
+
+_EXAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "example_objects")
+
+def _roundtrip_value(value):
+    decoded, end = binary.decode_value(binary.encode_value(value),
+                                       object_hook=lambda obj: obj)
+    return decoded
+
+class ValueEncodingTestCase(unittest.TestCase):
+
+    def test_scalars(self):
+        for value in [0, 1, 127, 128, 300, -1, -128, 2**70, -2**70, 0.5, -1e300,
+                      True, False, None, "", "uid", "ünïcode ☃"]:
+            result = _roundtrip_value(value)
+            self.assertEqual(result, value)
+            self.assertIs(type(result), type(value))
+
+    def test_containers(self):
+        value = {"data": [[], {}, [1, [2, {"x": None}]], {"y": []}], "z": "data"}
+        self.assertEqual(_roundtrip_value(value), value)
+
+    def test_many_strings(self):
+        # Enough strings to need the long form of string references
+        strings = ["s{}".format(i) for i in range(300)]
+        value = strings + list(reversed(strings))
+        self.assertEqual(_roundtrip_value(value), value)
+
+    def test_deep_nesting(self):
+        value = []
+        for _ in range(100000):
+            value = [value]
+        result = _roundtrip_value(value)
+        for _ in range(100000):
+            self.assertEqual(len(result), 1)
+            result = result[0]
+        self.assertEqual(result, [])
+
+    def test_aliases_are_fixed_by_default(self):
+        decoded, _ = binary.decode_value(binary.encode_value({"T": "null"}))
+        self.assertEqual(decoded, {"type": "null"})
+
+    def test_truncated_values(self):
+        value = {"s": "ünïcode", "n": -2**70, "f": 0.5, "ints": [300, 1, 2, 3],
+                 "refs": ["s{}".format(i) for i in range(70)] + ["s69"]}
+        encoded = bytes(binary.encode_value(value))
+        for end in range(len(encoded)):
+            with self.subTest(end=end):
+                with self.assertRaises(binary.BinaryFormatError):
+                    binary.decode_value(encoded[:end])
+
+    def test_malformed_values(self):
+        for encoded in [b"\x09\x04z", b"\x05\x01\xff", b"\x06\x7f", b"\x0a"]:
+            with self.subTest(encoded=encoded):
+                with self.assertRaises(binary.BinaryFormatError):
+                    binary.decode_value(encoded)
+
+def _describe(value):
+    # Objects in snapshots may refer to each other in cycles, which `==`
+    # can't handle, so compare them one at a time with references as uids.
+    if isinstance(value, (list, frozenset)):
+        items = [_describe(item) for item in value]
+        return items if isinstance(value, list) else sorted(items, key=repr)
+    elif isinstance(value, structures.DataStructure) and hasattr(value, "uid"):
+        return value.uid
+    return value
+
+def _describe_object(obj):
+    attrs = {name: _describe(getattr(obj, name))
+             for name in ("data", "children", "referent", "orig", "dest",
+                          "nodes", "edges")
+             if hasattr(obj, name)}
+    if isinstance(obj, (structures.Array, structures.String)):
+        attrs["data"] = _describe(list(obj) if isinstance(obj, structures.Array)
+                                  else str(obj))
+    return (type(obj), getattr(obj, "metadata", None), attrs)
+
+def _describe_snapshot(snapshot):
+    return ({name: obj.uid for name, obj in snapshot.names.items()},
+            {uid: _describe_object(obj)
+             for uid, obj in snapshot.obj_table.items()})
+
+class ExampleObjectsRoundTripTestCase(unittest.TestCase):
+    """Every example should decode to the same snapshots from either format"""
+
+    def assertSameSnapshots(self, first, second):
+        self.assertEqual([_describe_snapshot(s) for s in first],
+                         [_describe_snapshot(s) for s in second])
+
+    def test_example_objects(self):
+        filenames = sorted(name for name in os.listdir(_EXAMPLE_DIR)
+                           if name.endswith(".json"))
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with self.subTest(filename=filename):
+                with open(os.path.join(_EXAMPLE_DIR, filename), "r") as f:
+                    text = f.read()
+                if text.lstrip()[1:].lstrip().startswith("["):
+                    # A trace, which may be missing its final "]"
+                    raw = [json_objects.parse(span.text) for span in
+                           json_objects.SnapshotScanner.for_text(text)]
+                    expected = json_objects.reads(text)
+                else:
+                    # A single snapshot rather than a list of them
+                    raw = [json_objects.parse(text)]
+                    expected = [json_objects.decode_snapshot_text(text)]
+                data = binary.dumps(raw)
+                self.assertLess(len(data), len(text))
+                self.assertSameSnapshots(binary.loads(data), expected)
+                self.assertSameSnapshots(binary.load(io.BytesIO(data)), expected)
+
+class TraceFileTestCase(unittest.TestCase):
+
+    def test_write_and_iterate(self):
+        trace = [[{"type": "widget", "uid": "w{}".format(i), "var": "x"}]
+                 for i in range(3)]
+        f = io.BytesIO()
+        binary.write_header(f)
+        for snapshot in trace:
+            binary.write_snapshot(f, snapshot)
+        self.assertEqual(f.getvalue(), binary.dumps(trace))
+        f.seek(0)
+        snapshots = list(binary.iter_snapshots(f))
+        self.assertEqual([s.names["x"].uid for s in snapshots], ["w0", "w1", "w2"])
+
+    def test_delta_snapshots(self):
+        trace = [[{"type": "widget", "uid": "w", "var": "x"}],
+                 [{"type": "delta", "removed": ["w"]},
+                  {"type": "widget", "uid": "v", "var": "y"}]]
+        first, second = binary.loads(binary.dumps(trace))
+        self.assertEqual(set(second.names), {"y"})
+        self.assertEqual(_describe_snapshot(second),
+                         _describe_snapshot(json_objects.decode_json(json.dumps(trace))[1]))
+
+    def test_truncated_trace(self):
+        data = binary.dumps([[1, 2, 3]] * 2)
+        with self.assertRaises(binary.BinaryFormatError):
+            binary.loads(data[:-1])
+        with self.assertRaises(binary.BinaryFormatError):
+            binary.load(io.BytesIO(data[:-1]))
+
+    def test_rejects_json(self):
+        with self.assertRaises(binary.BinaryFormatError):
+            binary.loads(json.dumps([[]]).encode())
+
+    def test_validation(self):
+        bad = binary.dumps([[{"type": "ptr", "uid": "p"}]])
+        with self.assertRaises(json_objects.ValidationError):
+            binary.loads(bad)
+        with self.assertRaises(json_objects.ValidationError):
+            binary.load(io.BytesIO(bad))
+        with self.assertRaises(json_objects.ValidationError):
+            binary.decode_payload(next(binary.iter_payloads(io.BytesIO(bad))))
+
+    def test_trusted(self):
+        aliased = binary.dumps([[{"T": "widget", "uid": "w", "var": "x"}]])
+        self.assertEqual(binary.loads(aliased)[0].names["x"].uid, "w")
+        trace = [[{"type": "widget", "uid": "w", "var": "x"}]]
+        self.assertEqual(binary.loads(binary.dumps(trace), trusted=True),
+                         binary.loads(binary.dumps(trace)))
+
+if __name__ == "__main__":
+    unittest.main()
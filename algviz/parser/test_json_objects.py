@@ -1,5 +1,7 @@
 import collections.abc
+import io
 import json
+import os
 import unittest
 
 from . import json_objects
@@ -8,6 +10,9 @@ from . import structures
 def _text_to_snapshot(text):
     return json_objects.decode_snapshot(*json_objects.parse(text))
 
+def _text_to_snapshot_lazily(text, lazy):
+    return json_objects.decode_snapshot(*json_objects.parse(text), lazy=lazy)
+
 def _list_to_snapshot(lst):
     return _text_to_snapshot(json.dumps(lst))
 
@@ -46,6 +51,33 @@ class JSONObjectsTestCase(unittest.TestCase):
                          structures.Array([1, 2, 3, snapshot.names["my_widget"]],
                                           uid="testuid"))
 
+    def test_numeric_arrays_are_typed(self):
+        snapshot = _list_to_snapshot([
+            {"T": "array", "var": "ints", "data": [1, -2, 3]},
+            {"T": "array", "var": "floats", "data": [0.5, 1.5]},
+            {"T": "array", "var": "mixed", "data": [1, 1.5]},
+            {"T": "array", "var": "refs", "data": [1, {"T": "widget"}]}])
+        self.assertEqual([snapshot.names[var].typecode
+                          for var in ("ints", "floats", "mixed", "refs")],
+                         ["q", "d", None, None])
+        self.assertEqual(list(snapshot.names["ints"]), [1, -2, 3])
+        self.assertEqual(repr(snapshot.names["mixed"]), "[1, 1.5]")
+
+    def test_table_indexes(self):
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                snapshot = _text_to_snapshot_lazily(json.dumps([
+                    {"T": "tree", "uid": "t", "var": "root", "data": 0,
+                     "children": [{"T": "tree", "uid": "c", "data": 1,
+                                   "metadata": {"highlight": True}}]},
+                    {"T": "widget", "uid": "w"}]), lazy=lazy)
+                table = snapshot.obj_table
+                self.assertEqual([t.uid for t in table.by_type(structures.Tree)],
+                                 ["c", "t"])
+                self.assertEqual(table.by_var("root").children[0].data, 1)
+                self.assertEqual([obj.uid for obj in table.by_metadata("highlight", True)],
+                                 ["c"])
+
     def test_can_handle_missing_outermost_close_bracket(self):
         """Sometimes it's more trouble than it's worth to print the last
         closing brace, since that amounts to saying "I'm confident there will
@@ -54,6 +86,593 @@ class JSONObjectsTestCase(unittest.TestCase):
         self.assertEqual(json_objects.reads('[[{"T": "widget"}]]'),
                          json_objects.reads('[[{"T": "widget"}]'))
 
+    def test_rejects_data_after_the_trace(self):
+        text = '[[{"T": "widget"}]] \n'
+        self.assertEqual(len(json_objects.reads(text)), 1)
+        self.assertEqual(len(list(json_objects.iter_snapshots(io.StringIO(text)))), 1)
+        for junk in ("junk", "[]", "]", ", [[]]"):
+            bad = text + junk
+            with self.subTest(junk=junk):
+                with self.assertRaisesRegex(json_objects.JSONObjectError,
+                                            "after the end of the trace"):
+                    json_objects.reads(bad)
+                with self.assertRaisesRegex(json_objects.JSONObjectError,
+                                            "after the end of the trace"):
+                    list(json_objects.iter_snapshots(io.StringIO(bad), chunk_size=3))
+
+def _deep_pointer_chain(depth):
+    # Built directly rather than with `json.loads`, which has its own limit
+    chain = {"type": "ptr", "uid": "end", "data": 0}
+    for i in range(depth):
+        chain = {"type": "ptr", "uid": "p{}".format(i), "data": chain}
+    return chain
+
+class DeepNestingTestCase(unittest.TestCase):
+    depth = 100000
+
+    def test_decode_deep_chain(self):
+        snapshot = json_objects.decode_snapshot(_deep_pointer_chain(self.depth))
+        self.assertEqual(len(snapshot.obj_table), self.depth + 2)  # and Null
+        ptr = snapshot.obj_table.getuid("p{}".format(self.depth - 1))
+        for _ in range(self.depth):
+            ptr = ptr.referent
+        self.assertEqual(ptr.uid, "end")
+
+    def test_post_order_visit_deep_list(self):
+        nested = []
+        for _ in range(self.depth):
+            nested = [nested, 1]
+        copy = json_objects.post_order_visit(nested)
+        self.assertIsNot(copy, nested)
+        for _ in range(self.depth):
+            self.assertEqual(copy[1], 1)
+            copy = copy[0]
+        self.assertEqual(copy, [])
+
+    def test_decode_in_place_reuses_containers(self):
+        raw = {"T": "array", "uid": "a", "data": [1, "x", {"T": "widget"}]}
+        data = raw["data"]
+        json_objects.decode_in_place(raw, lambda x: x)
+        self.assertIs(raw["data"], data)
+
+    def test_post_order_visit_skips_keys(self):
+        visited = []
+        def visit(node):
+            visited.append(node)
+            return node
+        json_objects.post_order_visit({"a": [1], "b": 2},
+                                      visit=visit, skip=lambda node: ("a",))
+        self.assertEqual(visited, [2, {"a": [1], "b": 2}])
+
+class IterSnapshotsTestCase(unittest.TestCase):
+    """Test the streaming reader against the all-at-once reader"""
+    trace = [
+        [{"T": "string", "uid": "s", "var": "tricky", "data": "[\\\"{]},"}],
+        [{"T": "array", "uid": "a", "var": "arr", "data": [1, 2.5, {"T": "widget"}]}],
+        [],
+        [{"T": "ptr", "uid": "p", "var": "ptr", "data": "a"},
+         {"T": "array", "uid": "a", "data": [3]}],
+    ]
+
+    def _stream(self, text, **kwargs):
+        return list(json_objects.iter_snapshots(io.StringIO(text), **kwargs))
+
+    def test_matches_reads_for_every_chunk_size(self):
+        text = json.dumps(self.trace, indent=2)
+        expected = json_objects.reads(text)
+        for chunk_size in (1, 2, 3, 7, 64, len(text)):
+            self.assertEqual(self._stream(text, chunk_size=chunk_size), expected,
+                             msg="chunk_size={}".format(chunk_size))
+
+    def test_binary_file(self):
+        text = json.dumps(self.trace)
+        self.assertEqual(
+            list(json_objects.iter_snapshots(io.BytesIO(text.encode()), chunk_size=5)),
+            json_objects.reads(text))
+
+    def test_missing_outermost_close_bracket(self):
+        text = json.dumps(self.trace)
+        self.assertEqual(self._stream(text[:-1], chunk_size=4),
+                         self._stream(text, chunk_size=4))
+
+    def test_yields_snapshots_before_end_of_input(self):
+        text = json.dumps(self.trace)
+        snapshots = json_objects.iter_snapshots(io.StringIO(text + "garbage"))
+        self.assertEqual(str(next(snapshots).names["tricky"]), '[\\"{]},')
+
+    def test_truncated_snapshot_is_an_error(self):
+        text = json.dumps(self.trace)
+        with self.assertRaisesRegex(json_objects.JSONObjectError, "middle of"):
+            self._stream(text[:-10])
+
+    def test_parallel_decoding_matches_serial(self):
+        text = json.dumps(self.trace * 3)
+        parallel = json_objects.decode_json(text, workers=2)
+        self.assertEqual(parallel, json_objects.decode_json(text))
+        self.assertIs(parallel[-1].obj_table.getuid(structures.Null.uid),
+                      structures.Null)
+
+    def test_parallel_decoding_of_long_chains(self):
+        length = 20000
+        chain = [{"T": "ptr", "uid": "p{}".format(i), "data": "p{}".format(i + 1)}
+                 for i in range(length)]
+        chain[0]["var"] = "x"
+        chain.append({"T": "node", "uid": "p{}".format(length), "data": 1})
+        snapshot, = json_objects.decode_json(json.dumps([chain]), workers=2)
+        obj = snapshot.names["x"]
+        for i in range(length):
+            self.assertEqual(obj.uid, "p{}".format(i))
+            obj = obj.referent
+        self.assertEqual(obj.data, 1)
+        self.assertIs(obj, snapshot.obj_table.getuid("p{}".format(length)))
+
+    def test_scanner_offsets(self):
+        text = '[ [1] ,[{"a": "]"}]'
+        spans = list(json_objects.SnapshotScanner(io.StringIO(text), chunk_size=2))
+        self.assertEqual([text[span.start:span.stop] for span in spans],
+                         [span.text for span in spans])
+        self.assertEqual([span.text for span in spans], ['[1]', '[{"a": "]"}]'])
+
+class LazyFinalizeTestCase(unittest.TestCase):
+    objects = [
+        {"T": "tree", "uid": "a", "var": "first", "data": 1, "children": ["a1"]},
+        {"T": "tree", "uid": "a1", "data": 2, "children": [{"T": "ptr", "uid": "p", "data": "b1"}]},
+        {"T": "tree", "uid": "b", "var": "second", "data": 3, "children": ["b1"]},
+        {"T": "tree", "uid": "b1", "data": 4},
+    ]
+
+    def decode(self, lazy):
+        return _text_to_snapshot_lazily(json.dumps(self.objects), lazy)
+
+    def unresolved_children(self, snapshot, uid):
+        # Peek at the object without resolving it
+        obj = dict.__getitem__(snapshot.obj_table, structures.ObjectTableReference(uid))
+        return [child for child in obj.children
+                if isinstance(child, structures.ObjectTableReference)]
+
+    def test_resolves_only_what_is_reachable(self):
+        snapshot = self.decode(lazy=True)
+        self.assertTrue(self.unresolved_children(snapshot, "a"))
+        first = snapshot.names["first"]
+        self.assertEqual(first.children[0].children[0].referent.data, 4)
+        self.assertFalse(self.unresolved_children(snapshot, "a1"))
+        self.assertTrue(self.unresolved_children(snapshot, "b"))
+        self.assertEqual(snapshot.names["second"].children[0].data, 4)
+        self.assertFalse(self.unresolved_children(snapshot, "b"))
+
+    def test_cycles(self):
+        snapshot = _text_to_snapshot_lazily(json.dumps([
+            {"T": "ptr", "uid": "p", "var": "p", "data": "q"},
+            {"T": "ptr", "uid": "q", "data": "p"},
+        ]), lazy=True)
+        p = snapshot.names["p"]
+        self.assertIs(p.referent.referent, p)
+
+    def test_matches_eager_finalize(self):
+        self.assertEqual(self.decode(lazy=True), self.decode(lazy=False))
+        snapshot = self.decode(lazy=True)
+        for obj in snapshot.obj_table.values():
+            for child in getattr(obj, "children", ()):
+                self.assertIsInstance(child, structures.DataStructure)
+        self.assertEqual(set(snapshot.names), {"first", "second"})
+
+class PrunedDecodingTestCase(unittest.TestCase):
+    objects = [
+        {"T": "tree", "uid": "a", "var": "first", "data": 1,
+         "children": ["a1", {"T": "tree", "uid": "a2", "data": "s"}]},
+        {"T": "tree", "uid": "a1", "data": 2},
+        {"T": "string", "uid": "s", "data": "b"},
+        {"T": "array", "uid": "arr", "var": "second", "data": [
+            {"T": "ptr", "uid": "p", "data": "a1"}, "b"]},
+        {"T": "tree", "uid": "b", "var": "third", "data": 3},
+    ]
+
+    def decode(self, **kwargs):
+        return json_objects.decode_snapshot(
+            *json_objects.parse(json.dumps(self.objects)), **kwargs)
+
+    def uids(self, snapshot):
+        return set(snapshot.obj_table) - {structures.Null.uid}
+
+    def test_roots(self):
+        snapshot = self.decode(roots=["a"])
+        self.assertEqual(self.uids(snapshot), {"a", "a1", "a2", "s"})
+        self.assertEqual(set(snapshot.names), {"first"})
+        full = self.decode()
+        self.assertEqual(snapshot.names["first"], full.names["first"])
+
+    def test_root_vars(self):
+        snapshot = self.decode(root_vars=["second"])
+        self.assertEqual(self.uids(snapshot), {"arr", "p", "a1", "b"})
+        self.assertIs(snapshot.names["second"][0].referent,
+                      snapshot.obj_table.getuid("a1"))
+        self.assertEqual(set(snapshot.names), {"second", "third"})
+
+    def test_nested_root(self):
+        snapshot = self.decode(roots=["p"], lazy=True)
+        self.assertEqual(self.uids(snapshot), {"p", "a1"})
+        self.assertEqual(snapshot.obj_table.getuid("p").referent.data, 2)
+
+    def test_missing_references_stay_unresolved(self):
+        snapshot = json_objects.decode_snapshot(
+            {"type": "ptr", "uid": "p", "data": "nowhere"}, roots=["p"])
+        self.assertEqual(snapshot.obj_table.getuid("p").referent,
+                         structures.ObjectTableReference("nowhere"))
+        with self.assertRaises(KeyError):
+            json_objects.decode_snapshot({"type": "ptr", "uid": "p", "data": "nowhere"})
+
+class PartialTraceTestCase(unittest.TestCase):
+    trace = IterSnapshotsTestCase.trace
+
+    def test_every_cut(self):
+        text = json.dumps(self.trace, indent=1)
+        spans = list(json_objects.SnapshotScanner.for_text(text))
+        expected = json_objects.decode_json(text)
+        for cut in range(len(text) + 1):
+            with self.subTest(cut=cut):
+                snapshots, truncated_at = json_objects.reads_partial(text[:cut])
+                complete = [span for span in spans if span.stop <= cut]
+                self.assertEqual(snapshots, expected[:len(complete)])
+                cut_span = [span for span in spans if span.start < cut < span.stop]
+                self.assertEqual(truncated_at,
+                                 cut_span[0].start if cut_span else None)
+
+    def test_reads_rejects_truncated_snapshot(self):
+        text = json.dumps(self.trace)
+        with self.assertRaisesRegex(json_objects.JSONObjectError, "middle of"):
+            json_objects.reads(text[:-10])
+        self.assertEqual(json_objects.reads(text[:-1]), json_objects.reads(text))
+
+    def test_malformed_snapshot_is_not_truncation(self):
+        with self.assertRaises(json.JSONDecodeError):
+            json_objects.reads_partial('[[{"T": "widget"}], [1 2], [')
+        with self.assertRaises(json_objects.JSONObjectError):
+            json_objects.reads_partial('[[], {"T": "widget"}]')
+
+    def test_read_partial(self):
+        text = json.dumps(self.trace)
+        trace = json_objects.read_partial(io.StringIO(text[:-3]))
+        self.assertEqual(len(trace.snapshots), len(self.trace) - 1)
+        self.assertEqual(trace.truncated_at, text.rindex(", [") + 2)
+
+class ValidationTestCase(unittest.TestCase):
+
+    def assertInvalid(self, *objects):
+        with self.assertRaises(json_objects.ValidationError):
+            json_objects.validate_snapshot(json_objects.parse(json.dumps(objects)))
+
+    def test_valid_objects(self):
+        json_objects.validate_snapshot(json_objects.parse(json.dumps([
+            {"T": "array", "uid": "a", "var": "x",
+             "data": [1, 2.5, True, "b", {"T": "widget"}],
+             "metadata": {"anything": [None, True]}},
+            {"T": "tree", "uid": "b", "children": ["#null", {"T": "null"}]},
+            {"T": "graph", "nodes": [{"T": "node", "uid": "n"}],
+             "edges": [{"T": "edge", "from": "n", "to": "n", "data": 4}]},
+            {"T": "ptr", "data": {"T": "string", "data": "[text]"}},
+            {"T": "null", "uid": "#null", "var": "nothing"},
+            "a",
+        ])))
+
+    def test_invalid_objects(self):
+        self.assertInvalid({"uid": "no type"})
+        self.assertInvalid({"T": "no such type"})
+        self.assertInvalid({"T": "array"})
+        self.assertInvalid({"T": "array", "data": [[1]]})
+        self.assertInvalid({"T": "array", "data": [None]})
+        self.assertInvalid({"T": "widget", "colour": "red"})
+        self.assertInvalid({"T": "widget", "uid": 5})
+        self.assertInvalid({"T": "widget", "uid": "#5"})
+        self.assertInvalid({"T": "null", "uid": "n"})
+        self.assertInvalid({"T": "string", "data": 5})
+        self.assertInvalid({"T": "ptr", "data": None})
+        self.assertInvalid({"T": "tree", "children": [{"T": "tree", "children": "x"}]})
+        self.assertInvalid({"T": "widget"}, {"T": "delta"})
+        self.assertInvalid({"T": "delta", "removed": "x"})
+        self.assertInvalid(None)
+
+    def test_error_names_the_object(self):
+        with self.assertRaisesRegex(json_objects.ValidationError, "'t'.*children"):
+            json_objects.validate_snapshot([{"type": "treenode", "uid": "t",
+                                             "children": 3}])
+
+    def test_example_objects_are_valid(self):
+        directory = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))), "example_objects")
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".json"):
+                with self.subTest(filename=filename):
+                    with open(os.path.join(directory, filename)) as f:
+                        text = f.read()
+                    if text.lstrip()[1:].lstrip().startswith("["):
+                        for span in json_objects.SnapshotScanner.for_text(text):
+                            json_objects.parse_snapshot(span.text)
+                    else:
+                        # A single snapshot rather than a list of them
+                        json_objects.parse_snapshot(text)
+
+    def test_deep_nesting(self):
+        json_objects.validate_snapshot([_deep_pointer_chain(100000)])
+
+    def test_trusted_skips_validation_and_aliases(self):
+        text = json.dumps([[{"type": "widget", "uid": "w", "var": "x", "extra": 1}]])
+        with self.assertRaises(json_objects.ValidationError):
+            json_objects.decode_json(text)
+        for decode in (json_objects.decode_json, json_objects.reads):
+            self.assertEqual(decode(text, trusted=True)[0].names["x"].uid, "w")
+        self.assertEqual(json_objects.parse('{"T": 1}', trusted=True), {"T": 1})
+        trace = json.dumps([IterSnapshotsTestCase.trace[1]])
+        self.assertEqual(json_objects.reads(trace.replace('"T"', '"type"'),
+                                            trusted=True),
+                         json_objects.reads(trace))
+
+class DeltaSnapshotTestCase(unittest.TestCase):
+
+    full = [
+        {"T": "tree", "uid": "root", "var": "t", "data": 1, "children": ["l", "r"]},
+        {"T": "tree", "uid": "l", "data": 2, "children": ["ll"]},
+        {"T": "tree", "uid": "ll", "data": 3},
+        {"T": "tree", "uid": "r", "data": 4},
+        {"T": "ptr", "uid": "p", "var": "cursor", "data": "ll"},
+        {"T": "widget", "uid": "w", "var": "unrelated"},
+    ]
+
+    def decode(self, *raw_snapshots):
+        return json_objects.decode_json(json.dumps(list(raw_snapshots)))
+
+    def test_unchanged_objects_are_shared(self):
+        first, second = self.decode(self.full, [
+            {"T": "delta"},
+            {"T": "tree", "uid": "ll", "data": 30},
+        ])
+        self.assertEqual(second.obj_table.getuid("ll").data, 30)
+        self.assertEqual(first.obj_table.getuid("ll").data, 3)
+        # Everything that refers to the changed node is copied...
+        for uid in ("root", "l", "p"):
+            self.assertIsNot(first.obj_table.getuid(uid),
+                             second.obj_table.getuid(uid))
+        self.assertEqual(second.names["t"].children[0].children[0].data, 30)
+        self.assertEqual(second.names["cursor"].referent.data, 30)
+        # ...and nothing else is
+        self.assertIs(first.obj_table.getuid("r"), second.obj_table.getuid("r"))
+        self.assertIs(first.names["unrelated"], second.names["unrelated"])
+        self.assertIs(second.names["t"].children[1], first.obj_table.getuid("r"))
+
+    def test_table_indexes(self):
+        first, second, third = self.decode(
+            self.full,
+            [{"T": "delta", "removed": ["w"]},
+             {"T": "widget", "uid": "r", "var": "cursor",
+              "metadata": {"highlight": True}}],
+            [{"T": "delta"},
+             {"T": "tree", "uid": "r", "data": 5, "var": "right"},
+             {"T": "widget", "uid": "w2", "var": "unrelated"}])
+        for snapshot in (second, third):
+            self.assertIsInstance(snapshot.obj_table, structures.ObjectTableView)
+        def uids(objects):
+            return [obj.uid for obj in objects]
+        table = second.obj_table
+        self.assertEqual(uids(table.by_type(structures.Tree)), ["root", "l", "ll"])
+        self.assertEqual(uids(table.by_type(structures.Widget)), ["r"])
+        self.assertEqual(uids(table.by_type(structures.DataStructure, subclasses=True)),
+                         ["#null", "root", "l", "ll", "p", "r"])
+        self.assertEqual(table.by_var("cursor").uid, "r")
+        self.assertEqual(table.by_var("t").uid, "root")
+        with self.assertRaises(KeyError):
+            table.by_var("unrelated")
+        self.assertEqual(uids(table.by_metadata("highlight", True)), ["r"])
+        table = third.obj_table
+        self.assertEqual(uids(table.by_type(structures.Tree)), ["root", "l", "ll", "r"])
+        self.assertEqual(uids(table.by_type(structures.Widget)), ["w2"])
+        self.assertEqual(table.by_var("right").uid, "r")
+        self.assertEqual(table.by_var("unrelated").uid, "w2")
+        with self.assertRaises(KeyError):
+            table.by_var("cursor")
+        self.assertEqual(table.by_metadata("highlight"), [])
+        # Earlier snapshots are unaffected
+        self.assertEqual(uids(first.obj_table.by_type(structures.Widget)), ["w"])
+        self.assertEqual(second.obj_table.by_var("cursor").uid, "r")
+
+    def test_anonymous_objects_keep_their_identity(self):
+        # An unchanged pointer to an anonymous object must keep pointing at it
+        # when later deltas add anonymous objects of their own
+        first, second, third = self.decode(
+            [{"T": "ptr", "uid": "p", "var": "p",
+              "data": {"T": "string", "data": "old"}}],
+            [{"T": "delta"}, {"T": "string", "var": "s", "data": "new"}],
+            [{"T": "delta"}, {"T": "string", "var": "s2", "data": "newer"}])
+        for snapshot in (first, second, third):
+            self.assertEqual(str(snapshot.names["p"].referent), "old")
+        self.assertEqual(str(second.names["s"]), "new")
+        self.assertEqual(str(third.names["s"]), "new")
+        self.assertEqual(str(third.names["s2"]), "newer")
+        self.assertEqual(len({third.names[var].uid for var in ("s", "s2")} |
+                             {third.names["p"].referent.uid}), 3)
+
+    def test_matches_full_snapshots(self):
+        changed_leaf = {"T": "tree", "uid": "ll", "data": 30}
+        full_again = [changed_leaf if obj["uid"] == "ll" else obj
+                      for obj in self.full]
+        _, from_delta = self.decode(self.full, [{"T": "delta"}, changed_leaf])
+        _, expected = self.decode(self.full, full_again)
+        self.assertEqual(from_delta, expected)
+        self.assertEqual(len(from_delta.obj_table), len(expected.obj_table))
+        self.assertEqual(set(from_delta.obj_table), set(expected.obj_table))
+
+    def test_fingerprints_follow_changes(self):
+        decoder = json_objects.TraceDecoder()
+        first = decoder.decode(json_objects.parse(json.dumps(self.full)))
+        first_root = first.names["t"].fingerprint
+        # The copies of the changed node's ancestors mustn't keep the old
+        # fingerprints
+        second = decoder.decode(json_objects.parse(json.dumps([
+            {"T": "delta"},
+            {"T": "tree", "uid": "ll", "data": 30},
+        ])))
+        self.assertNotEqual(second.names["t"].fingerprint, first_root)
+        self.assertEqual(first.names["t"].fingerprint, first_root)
+        self.assertEqual(second.obj_table.getuid("r").fingerprint,
+                         first.obj_table.getuid("r").fingerprint)
+
+    def test_added_and_removed_objects(self):
+        first, second, third = self.decode(self.full, [
+            {"T": "delta", "removed": ["r", "w"]},
+            {"T": "tree", "uid": "root", "var": "t", "data": 1, "children": ["l", "n"]},
+            {"T": "string", "uid": "n", "data": "new"},
+        ], [
+            {"T": "delta"},
+            {"T": "widget", "uid": "w", "var": "unrelated"},
+        ])
+        self.assertNotIn("unrelated", second.names)
+        self.assertNotIn(structures.ObjectTableReference("r"), second.obj_table)
+        with self.assertRaises(KeyError):
+            second.obj_table.getuid("w")
+        self.assertEqual(str(second.names["t"].children[1]), "new")
+        self.assertEqual(len(second.obj_table), len(first.obj_table) - 1)
+        self.assertEqual(third.names["unrelated"].uid, "w")
+        self.assertIs(third.names["t"], second.names["t"])
+        self.assertEqual(len(third.obj_table), len(first.obj_table))
+
+    def test_long_run_of_deltas(self):
+        counter = [{"T": "ptr", "uid": "p", "var": "i", "data": 0},
+                   {"T": "array", "uid": "a", "var": "arr", "data": list(range(100))}]
+        deltas = [[{"T": "delta"}, {"T": "ptr", "uid": "p", "var": "i", "data": i}]
+                  for i in range(1, 50)]
+        snapshots = self.decode(counter, *deltas)
+        self.assertEqual([s.names["i"].referent for s in snapshots], list(range(50)))
+        self.assertEqual(len({id(s.names["arr"]) for s in snapshots}), 1)
+
+    def test_delta_needs_a_previous_snapshot(self):
+        with self.assertRaises(json_objects.JSONObjectError):
+            self.decode([{"T": "delta"}])
+
+    def test_array_patches(self):
+        first, second, third = self.decode(
+            [{"T": "array", "uid": "a", "var": "arr", "data": list(range(100))},
+             {"T": "array", "uid": "b", "var": "objs", "data": ["n", "m", 3]},
+             {"T": "node", "uid": "n", "data": 1},
+             {"T": "node", "uid": "m", "data": 2},
+             {"T": "ptr", "uid": "p", "var": "p", "data": "b"}],
+            [{"T": "delta"},
+             {"T": "array", "uid": "a", "set": {"5": -5, "99": 1.5}},
+             {"T": "array", "uid": "b", "set": {"2": "m"}},
+             {"T": "node", "uid": "n", "data": 10}],
+            [{"T": "delta"},
+             {"T": "array", "uid": "b", "set": {"1": {"T": "node", "data": 20}}}])
+        self.assertEqual(list(second.names["arr"]),
+                         list(range(5)) + [-5] + list(range(6, 99)) + [1.5])
+        self.assertEqual(list(first.names["arr"]), list(range(100)))
+        # Cells that weren't set still follow changes to the objects in them
+        self.assertEqual([node.data for node in second.names["objs"]], [10, 2, 2])
+        self.assertIs(second.names["objs"][2], second.obj_table.getuid("m"))
+        self.assertIs(second.names["p"].referent, second.names["objs"])
+        self.assertEqual([getattr(item, "data", item) for item in first.names["objs"]],
+                         [1, 2, 3])
+        self.assertEqual([node.data for node in third.names["objs"]], [10, 20, 2])
+        self.assertIs(third.names["arr"], second.names["arr"])
+
+    def test_invalid_array_patches(self):
+        full = [{"T": "array", "uid": "a", "data": [1, 2]},
+                {"T": "node", "uid": "n"}]
+        for patch in [{"T": "array", "uid": "a", "set": {"01": 5}},
+                      {"T": "array", "uid": "a", "set": {"-1": 5}},
+                      {"T": "array", "uid": "a", "set": {"0": None}},
+                      {"T": "array", "uid": "a", "set": {"0": 5}, "var": "x"},
+                      {"T": "array", "set": {"0": 5}}]:
+            with self.subTest(patch=patch):
+                with self.assertRaises(json_objects.ValidationError):
+                    self.decode(full, [{"T": "delta"}, patch])
+        for patch in [{"T": "array", "uid": "a", "set": {"2": 5}},
+                      {"T": "array", "uid": "n", "set": {"0": 5}},
+                      {"T": "array", "uid": "x", "set": {"0": 5}}]:
+            with self.subTest(patch=patch):
+                with self.assertRaises(json_objects.JSONObjectError):
+                    self.decode(full, [{"T": "delta"}, patch])
+        # Only delta snapshots may hold patches
+        with self.assertRaises(json_objects.ValidationError):
+            self.decode([{"T": "array", "uid": "a", "set": {"0": 5}}])
+
+    def test_streaming_and_parallel_decoding(self):
+        trace = [self.full, [{"T": "delta", "removed": ["p"]}],
+                 [{"T": "delta"}, {"T": "tree", "uid": "r", "data": 40}]] * 2
+        text = json.dumps(trace)
+        expected = json_objects.decode_json(text)
+        self.assertNotIn("cursor", expected[1].names)
+        self.assertEqual(expected[2].names["t"].children[1].data, 40)
+        self.assertEqual(list(json_objects.iter_snapshots(io.StringIO(text))),
+                         expected)
+        self.assertEqual(json_objects.decode_json(text, workers=2), expected)
+
+class DiffSnapshotsTestCase(unittest.TestCase):
+
+    full = DeltaSnapshotTestCase.full + [
+        {"T": "array", "uid": "a", "var": "arr", "data": [1, 2, 3]},
+        {"T": "graph", "uid": "g", "var": "g", "nodes": ["n1", "n2"], "edges": []},
+        {"T": "node", "uid": "n1", "data": 1},
+        {"T": "node", "uid": "n2", "data": 2},
+    ]
+
+    def diff(self, *raw_snapshots, **kwargs):
+        first, second = json_objects.decode_json(json.dumps(list(raw_snapshots)))
+        return structures.diff_snapshots(first, second, **kwargs)
+
+    def replace(self, *objects, removed=()):
+        by_uid = {obj["uid"]: obj for obj in objects}
+        return [by_uid.pop(obj["uid"], obj) for obj in self.full
+                if obj["uid"] not in removed] + list(by_uid.values())
+
+    def test_no_changes(self):
+        self.assertEqual(self.diff(self.full, self.full),
+                         structures.SnapshotDiff(set(), set(), set(), []))
+        self.assertEqual(self.diff(self.full, [{"T": "delta"}]),
+                         structures.SnapshotDiff(set(), set(), set(), []))
+
+    def test_field_changes(self):
+        new_objects = [
+            {"T": "tree", "uid": "ll", "data": 30},
+            {"T": "tree", "uid": "r", "data": 4, "children": ["x"]},
+            {"T": "tree", "uid": "x", "data": 5},
+            {"T": "ptr", "uid": "p", "var": "cursor", "data": "r"},
+            {"T": "array", "uid": "a", "var": "arr", "data": [1, 20, 3, 4]},
+            {"T": "graph", "uid": "g", "var": "g", "nodes": ["n1"], "edges": []},
+        ]
+        delta = [{"T": "delta", "removed": ["n2"]}] + new_objects
+        for second in (self.replace(*new_objects, removed=["n2"]), delta):
+            with self.subTest(delta=second is delta):
+                diff = self.diff(self.full, second)
+                self.assertEqual(diff.added, {"x"})
+                self.assertEqual(diff.removed, {"n2"})
+                self.assertEqual(diff.modified, {"ll", "r", "p", "a", "g"})
+                changes = {(c.uid, c.field, c.index): (getattr(c.old, "uid", c.old),
+                                                       getattr(c.new, "uid", c.new))
+                           for c in diff.changes}
+                self.assertEqual(changes, {
+                    ("ll", "data", None): (3, 30),
+                    ("r", "children", 0): (None, "x"),
+                    ("p", "referent", None): ("ll", "r"),
+                    ("a", "data", 1): (2, 20),
+                    ("a", "data", 3): (None, 4),
+                    ("g", "nodes", None): ("n2", None),
+                })
+
+    def test_roots(self):
+        second = self.replace({"T": "tree", "uid": "ll", "data": 30},
+                              {"T": "array", "uid": "a", "var": "arr", "data": []})
+        self.assertEqual(self.diff(self.full, second, roots=["a"]).modified, {"a"})
+        self.assertEqual(self.diff(self.full, second, roots=["r"]).modified, set())
+
+    def test_type_change(self):
+        diff = self.diff(self.full, self.replace({"T": "widget", "uid": "r"}))
+        self.assertEqual((diff.added, diff.removed, diff.modified),
+                         ({"r"}, {"r"}, set()))
+
+    def test_cycles(self):
+        cycle = [{"T": "ptr", "uid": "a", "var": "a", "data": "b"},
+                 {"T": "ptr", "uid": "b", "data": "c"},
+                 {"T": "ptr", "uid": "c", "data": "a"}]
+        changed = cycle[:2] + [{"T": "ptr", "uid": "c", "data": "b"}]
+        self.assertEqual(self.diff(cycle, changed).modified, {"c"})
+
 class GenericDecodingTestCase(unittest.TestCase):
     """Make a subclass of this to test decoding of a specific type of object.
 
@@ -247,6 +866,94 @@ class GraphDecodingTestCase(GenericDecodingTestCase):
             edges=[e0, e1, structures.Edge(n2, n2), e3])
         self.same_uid_object = self.unexpected_object
 
+class CompactGraphDecodingTestCase(GraphDecodingTestCase):
+    """Edges without uids are decoded into a CompactEdgeSet"""
+    def set_up_expectations(self):
+        super().set_up_expectations()
+        for raw_edge in self.snapshot_input[0]["edges"]:
+            del raw_edge["uid"]
+        n0, n1, n2 = sorted(self.expected_object.nodes, key=lambda n: n.uid)
+        def edge(i, orig, dest, **kwargs):
+            return structures.Edge(orig, dest, uid="{}#e{}".format(self.expected_uid, i),
+                                   **kwargs)
+        self.expected_object = self.factory(
+            nodes=[n0, n1, n2],
+            edges=[edge(0, n0, n1), edge(1, n0, n2), edge(2, n2, n2, data=100),
+                   edge(3, n2, n0)])
+
+    def test_edges_are_compact(self):
+        edges = self.actual_object.edges
+        self.assertIsInstance(edges, structures.CompactEdgeSet)
+        self.assertEqual((list(edges.orig), list(edges.dest)),
+                         ([0, 0, 2, 2], [1, 2, 2, 0]))
+        self.assertEqual(edges[2].data, 100)
+        self.assertIn(edges[1], edges)
+        self.assertNotIn(structures.Edge(edges[1].orig, edges[1].dest,
+                                         uid=edges[1].uid, data=5), edges)
+        # No Edge objects were put in the table
+        self.assertEqual(len(self.actual_snapshot.obj_table), 6)
+
+    def test_adjacency(self):
+        adjacency = self.actual_object.adjacency
+        n2 = self.actual_snapshot.obj_table.getuid("n2")
+        self.assertEqual([n.uid for n in adjacency.successors(n2)], ["n2", "n0"])
+        self.assertEqual([e.data for e in adjacency.in_edges(n2)], [structures.Null, 100])
+
+    def test_edges_with_uids_are_not_compact(self):
+        snapshot = _list_to_snapshot([
+            {"T": "graph", "uid": "g", "nodes": ["n"],
+             "edges": [{"T": "edge", "from": "n", "to": "n"},
+                       {"T": "edge", "from": "n", "to": "n", "metadata": {}}]},
+            {"T": "node", "uid": "n", "data": 1}])
+        self.assertIsInstance(snapshot.obj_table.getuid("g").edges, frozenset)
+
+    def test_rewiring_is_a_change(self):
+        def snapshot(ends):
+            return json_objects.decode_snapshot(
+                {"type": "graph", "uid": "g", "nodes": ["a", "b"],
+                 "edges": [{"type": "edge", "from": o, "to": d} for o, d in ends]},
+                {"type": "node", "uid": "a", "data": 1},
+                {"type": "node", "uid": "b", "data": 2})
+        first = snapshot([("a", "b"), ("b", "a")])
+        second = snapshot([("a", "b"), ("a", "b")])
+        g1, g2 = first.obj_table.getuid("g"), second.obj_table.getuid("g")
+        self.assertEqual(g1.fingerprint, snapshot([("a", "b"), ("b", "a")])
+                         .obj_table.getuid("g").fingerprint)
+        self.assertNotEqual(g1.fingerprint, g2.fingerprint)
+        diff = structures.diff_snapshots(first, second, roots=["g"])
+        self.assertEqual([(c.uid, c.field, c.index) for c in diff.changes],
+                         [("g", "edge_endpoints", 1)])
+
+    def test_literal_ends(self):
+        def graph(ends):
+            snapshot = json_objects.decode_snapshot(
+                {"type": "graph", "uid": "g", "nodes": [1, 2, 2.0],
+                 "edges": [{"type": "edge", "from": o, "to": d} for o, d in ends]})
+            return snapshot.obj_table.getuid("g")
+        g = graph([(1, 2), (2, 2.0)])
+        self.assertEqual([(e.orig, e.dest) for e in g.edges], [(1, 2), (2, 2.0)])
+        self.assertIs(type(list(g.edges)[1].dest), float)
+        self.assertEqual(g.edges.endpoints(),
+                         [((int, 1), (int, 2)), ((int, 2), (float, 2.0))])
+        self.assertEqual(g.fingerprint, graph([(1, 2), (2, 2.0)]).fingerprint)
+        self.assertNotEqual(g.fingerprint, graph([(1, 2), (2, 2)]).fingerprint)
+        self.assertEqual(list(g.adjacency.successors(1)), [2])
+
+    def test_lazy_and_delta(self):
+        raw = json.dumps(self.snapshot_input)
+        lazy = _text_to_snapshot_lazily(raw, lazy=True)
+        self.assertEqual(_get_from_table(lazy.obj_table, self.expected_uid),
+                         self.expected_object)
+        first, second = json_objects.decode_json(json.dumps([
+            self.snapshot_input,
+            [{"T": "delta"}, {"T": "node", "uid": "n2", "data": 11}]]))
+        self.assertEqual([e.orig.data for e in
+                          first.obj_table.getuid(self.expected_uid).edges],
+                         [0, 0, 10, 10])
+        self.assertEqual([e.orig.data for e in
+                          second.obj_table.getuid(self.expected_uid).edges],
+                         [0, 0, 11, 11])
+
 class NodeDecodingTestCase(GenericDecodingTestCase):
     cls_under_test = structures.Node
     def set_up_expectations(self):
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import json_objects
+from . import snapshot_index
+
+class LazySnapshotSequenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "trace.json")
+        self.write_trace(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_trace(self, length):
+        trace = [[{"T": "array", "uid": "a", "var": "arr", "data": [i, "ü"]},
+                  {"T": "string", "uid": "ü", "data": "ünïcode"}]
+                 for i in range(length)]
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(trace, f, indent=2, ensure_ascii=False)
+        os.utime(self.path, ns=(0, length))  # make sure the mtime changes
+
+    def read_eagerly(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json_objects.read(f)
+
+    def test_matches_eager_reading(self):
+        lazy = snapshot_index.LazySnapshotSequence(self.path)
+        self.assertEqual(len(lazy), 5)
+        self.assertEqual(list(lazy), self.read_eagerly())
+        self.assertEqual(lazy[-1], self.read_eagerly()[-1])
+        self.assertEqual(lazy[1:3], self.read_eagerly()[1:3])
+        with self.assertRaises(IndexError):
+            lazy[5]
+
+    def test_sidecar_is_written_and_reused(self):
+        snapshot_index.LazySnapshotSequence(self.path)
+        index_path = self.path + snapshot_index.INDEX_SUFFIX
+        self.assertTrue(os.path.exists(index_path))
+        index = snapshot_index.SnapshotIndex.load(index_path)
+        self.assertTrue(index.is_current(self.path))
+        self.assertEqual(index.spans,
+                         snapshot_index.SnapshotIndex.build(self.path).spans)
+
+    def test_stale_sidecar_is_rebuilt(self):
+        snapshot_index.LazySnapshotSequence(self.path)
+        self.write_trace(7)
+        lazy = snapshot_index.LazySnapshotSequence(self.path)
+        self.assertEqual(len(lazy), 7)
+        self.assertEqual(list(lazy), self.read_eagerly())
+
+    def test_delta_snapshots(self):
+        trace = [[{"T": "ptr", "uid": "p", "var": "i", "data": 0}]]
+        trace += [[{"T": "delta"}, {"T": "ptr", "uid": "p", "var": "i", "data": i}]
+                  for i in range(1, 4)]
+        with open(self.path, "w") as f:
+            json.dump(trace, f)
+        lazy = snapshot_index.LazySnapshotSequence(self.path, use_sidecar=False)
+        self.assertEqual([s.names["i"].referent for s in lazy], [0, 1, 2, 3])
+        self.assertEqual(lazy[-2], self.read_eagerly()[-2])
+
+    def test_lazy(self):
+        lazy = snapshot_index.LazySnapshotSequence(self.path, lazy=True)
+        self.assertEqual(list(lazy), self.read_eagerly())
+        self.assertEqual(str(lazy[2].names["arr"][1]), "ünïcode")
+
+    def test_roots(self):
+        lazy = snapshot_index.LazySnapshotSequence(self.path, root_vars=["arr"])
+        self.assertEqual(lazy[3].names["arr"], self.read_eagerly()[3].names["arr"])
+        lazy = snapshot_index.LazySnapshotSequence(self.path, roots=["ü"])
+        self.assertEqual(set(lazy[3].names), set())
+        self.assertEqual(str(lazy[3].obj_table.getuid("ü")), "ünïcode")
+
+    def test_without_sidecar(self):
+        lazy = snapshot_index.LazySnapshotSequence(self.path, use_sidecar=False)
+        self.assertEqual(len(lazy), 5)
+        self.assertFalse(os.path.exists(self.path + snapshot_index.INDEX_SUFFIX))
+
+class ChangeHistoryTestCase(unittest.TestCase):
+
+    trace = [
+        [{"T": "tree", "uid": "t", "var": "t", "data": 0, "children": ["l"]},
+         {"T": "tree", "uid": "l", "data": 1},
+         {"T": "widget", "uid": "w"}],
+        [{"T": "delta"}, {"T": "tree", "uid": "l", "data": 2}],
+        [{"T": "delta", "removed": ["w"]},
+         {"T": "tree", "uid": "t", "var": "t", "data": 0, "children": ["l", "r"]},
+         {"T": "tree", "uid": "r", "data": 3}],
+        [{"T": "tree", "uid": "t", "var": "t", "data": 5, "children": ["l", "r"]},
+         {"T": "tree", "uid": "l", "data": 2},
+         {"T": "ptr", "uid": "r", "data": 3}],
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "trace.json")
+        with open(self.path, "w") as f:
+            json.dump(self.trace, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, history):
+        C = snapshot_index.Change
+        self.assertEqual(len(history), 4)
+        self.assertEqual(set(history), {"t", "l", "w", "r"})
+        self.assertEqual(history.changes("t"), [
+            C(0, "added", ()), C(2, "modified", ("children",)),
+            C(3, "modified", ("data",))])
+        self.assertEqual(history.snapshots("l"), [0, 1])
+        self.assertEqual(history.snapshots("w"), [0, 2])
+        self.assertEqual(history.changes("r"), [
+            C(2, "added", ()), C(3, "modified", ("type",))])
+        self.assertEqual(history.changes("nothing"), [])
+        self.assertEqual(history.last_change("t", field="children").snapshot, 2)
+        self.assertEqual(history.last_change("t", snapshot=1).snapshot, 0)
+        self.assertEqual(history.last_change("t", snapshot=1, field="data").snapshot, 0)
+        self.assertIsNone(history.last_change("r", snapshot=1))
+
+    def test_build(self):
+        self.check(snapshot_index.ChangeHistory.build(self.path))
+
+    def test_sidecar(self):
+        history = snapshot_index.LazySnapshotSequence(self.path).change_history()
+        self.check(history)
+        sidecar_path = self.path + snapshot_index.HISTORY_SUFFIX
+        self.check(snapshot_index.ChangeHistory.load(sidecar_path))
+        self.assertTrue(history.is_current(self.path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,6 @@
+import array
+import copy
+import pickle
 import unittest
 from . import structures
 
@@ -12,6 +15,19 @@ class NullTestCase(unittest.TestCase):
         self.assertFalse(structures.Null)
         self.assertEqual(hash(structures.Null), hash(structures.Null))
 
+    def test_Null_has_no_metadata(self):
+        self.assertIs(structures.Null.metadata, None)
+
+    def test_empty_metadata_is_immutable(self):
+        with self.assertRaises(TypeError):
+            structures.EMPTY_METADATA["key"] = "value"
+        self.assertIs(pickle.loads(pickle.dumps(structures.EMPTY_METADATA)),
+                      structures.EMPTY_METADATA)
+
+    def test_Null_survives_pickling(self):
+        self.assertIs(pickle.loads(pickle.dumps(structures.Null)),
+                      structures.Null)
+
 class DataStructuresTestMixin:
 
     def test_hashable(self):
@@ -20,7 +36,25 @@ class DataStructuresTestMixin:
     def test_equality(self):
         self.assertEqual(self.instance(), self.instance())
 
-class PointerTestCase(DataStructuresTestMixin, unittest.TestCase):
+    def test_survives_pickling_and_copying(self):
+        for copy_of in (copy.copy, lambda obj: pickle.loads(pickle.dumps(obj))):
+            self.assertEqual(copy_of(self.instance()), self.instance())
+
+    def test_metadata(self):
+        obj = self.instance()
+        self.assertIs(obj.metadata, structures.EMPTY_METADATA)
+        self.assertEqual(obj.metadata, {})
+        obj.metadata = {"draw_once": False}
+        self.assertEqual(obj.metadata["draw_once"], False)
+        self.assertIs(self.instance().metadata, structures.EMPTY_METADATA)
+
+class CompactDataStructuresTestMixin(DataStructuresTestMixin):
+    """For the classes that use `__slots__` to save memory"""
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.instance(), "__dict__"))
+
+class PointerTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Pointer(structures.String("foo", uid="s"),
                                   uid="p")
@@ -29,40 +63,377 @@ class StringTestCase(DataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.String("foo", uid="s")
 
-class WidgetTestCase(DataStructuresTestMixin, unittest.TestCase):
+class WidgetTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Widget(uid="w")
 
-class ArrayTestCase(DataStructuresTestMixin, unittest.TestCase):
+class ArrayTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Array([], uid='arr')
 
-class LinkedListNodeTestCase(DataStructuresTestMixin, unittest.TestCase):
+    def test_list_behaviour(self):
+        arr = structures.Array([1, 2, 3], uid="arr")
+        arr.append(4)
+        self.assertEqual(list(arr), [1, 2, 3, 4])
+        self.assertEqual((len(arr), arr[-1], 3 in arr), (4, 4, True))
+        self.assertIsInstance(arr[1:3], structures.Array)
+        self.assertEqual(list(arr[1:3]), [2, 3])
+        arr[0] = 0
+        del arr[1]
+        self.assertEqual(arr.data, [0, 3, 4])
+        self.assertEqual(repr(arr), "[0, 3, 4]")
+
+class TypedArrayTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
+    def instance(self):
+        return structures.Array(structures.pack_numbers([1, 2, 3]), uid="arr")
+
+    def test_pack_numbers(self):
+        self.assertEqual(structures.pack_numbers([1, -2, 2**63 - 1]).typecode, "q")
+        self.assertEqual(structures.pack_numbers([0.5, -1e300]).typecode, "d")
+        for items in ([], [1, 2.5], [2.5, 1], [2**63], [1, True], ["a"],
+                      [1, structures.Null]):
+            with self.subTest(items=items):
+                self.assertIsNone(structures.pack_numbers(items))
+
+    def test_list_behaviour(self):
+        arr = self.instance()
+        self.assertEqual(arr.typecode, "q")
+        arr.append(4)
+        self.assertEqual(list(arr), [1, 2, 3, 4])
+        self.assertEqual((len(arr), arr[-1], 3 in arr), (4, 4, True))
+        self.assertEqual(repr(arr), "[1, 2, 3, 4]")
+        self.assertEqual(arr, structures.Array([1, 2, 3, 4], uid="arr"))
+        self.assertNotEqual(arr, structures.Array([1, 2, 3], uid="arr"))
+
+    def test_slices_share_storage(self):
+        arr = self.instance()
+        part = arr[1:]
+        self.assertIsInstance(part, structures.Array)
+        self.assertIsInstance(part.data, memoryview)
+        self.assertEqual((list(part), part.typecode), ([2, 3], "q"))
+        part[0] = 20
+        arr[2] = 30
+        self.assertEqual((list(arr), list(part)), ([1, 20, 30], [20, 30]))
+        reverse = part[::-1]
+        self.assertEqual(list(reverse), [30, 20])
+        part.sort()
+        self.assertEqual(list(reverse), [30, 20])
+        reverse.sort()
+        self.assertEqual(list(arr), [1, 30, 20])
+        # Changing length gives the original its own copy...
+        arr.append(4)
+        arr[1] = 0
+        self.assertEqual((list(arr), list(part)), ([1, 0, 20, 4], [30, 20]))
+        # ...and the same goes for a slice
+        part.insert(0, 5)
+        part[1] = 6
+        self.assertEqual((list(part), list(reverse)), ([5, 6, 20], [20, 30]))
+        self.assertEqual(list(arr), [1, 0, 20, 4])
+        arr.insert(0, 0)
+        del arr[1]
+        arr[1:3] = [7]
+        self.assertEqual(list(arr), [0, 7, 4])
+        # Slices of lists are copies
+        listed = structures.Array([1, "a"])
+        listed[:1][0] = 5
+        self.assertEqual(list(listed), [1, "a"])
+
+    def test_views_survive_pickling_and_copying(self):
+        part = self.instance()[1:]
+        for copy_of in (copy.copy, lambda obj: pickle.loads(pickle.dumps(obj))):
+            result = copy_of(part)
+            self.assertEqual(list(result), [2, 3])
+            result[0] = 5
+            result.append(6)
+            self.assertEqual(list(result), [5, 3, 6])
+
+    def test_list_methods(self):
+        for data in ([3, 1, 2], structures.pack_numbers([3, 1, 2])):
+            with self.subTest(typecode=getattr(data, "typecode", None)):
+                arr = structures.Array(data, uid="arr")
+                arr.sort()
+                self.assertEqual(list(arr), [1, 2, 3])
+                arr.sort(reverse=True)
+                self.assertEqual(list(arr), [3, 2, 1])
+                copied = arr.copy()
+                copied[0] = 0
+                self.assertEqual((list(arr), copied.uid), ([3, 2, 1], None))
+                self.assertEqual(list(arr + [4]), [3, 2, 1, 4])
+                self.assertEqual(list([0] + arr), [0, 3, 2, 1])
+                self.assertEqual(list(arr[:1] + arr[1:]), [3, 2, 1])
+                self.assertEqual(list(arr * 2), [3, 2, 1] * 2)
+                self.assertEqual(list(2 * arr[:1]), [3, 3])
+                self.assertTrue(arr > [3, 2] and arr >= arr[:] and arr < [4])
+                self.assertTrue(arr[1:] <= [2, 1] and not arr < arr[:])
+                arr += [5.5]
+                arr *= 2
+                self.assertEqual(list(arr), [3, 2, 1, 5.5] * 2)
+                self.assertIs(type(arr), structures.Array)
+                arr.clear()
+                self.assertEqual(len(arr), 0)
+
+    def test_other_values_switch_to_a_list(self):
+        for value in ("five", 5.5, True, structures.Null, 2**64):
+            with self.subTest(value=value):
+                arr = self.instance()
+                arr.insert(1, value)
+                self.assertIsNone(arr.typecode)
+                self.assertEqual(list(arr), [1, value, 2, 3])
+                self.assertIs(type(arr[1]), type(value))
+                arr = self.instance()
+                arr[2] = value
+                self.assertEqual(list(arr), [1, 2, value])
+                arr = self.instance()
+                arr[1:2] = [value, value]
+                self.assertEqual(list(arr), [1, value, value, 3])
+        arr = self.instance()
+        arr[:] = [7, 8]
+        arr.append(9)
+        self.assertEqual((list(arr), arr.typecode), ([7, 8, 9], "q"))
+
+    def test_untablify_leaves_numbers_alone(self):
+        arr = self.instance()
+        data = arr.data
+        arr.untablify(structures.ObjectTable())
+        self.assertIs(arr.data, data)
+
+class LinkedListNodeTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.LinkedListNode(0,
                                          structures.LinkedListNode(1, uid="t"),
                                          uid="h")
 
-class GraphTestCase(DataStructuresTestMixin, unittest.TestCase):
+class GraphTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Graph([], [], uid="g")
 
-class NodeTestCase(DataStructuresTestMixin, unittest.TestCase):
+class CompactGraphTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
+    def instance(self):
+        nodes = [structures.Node(i, uid="n{}".format(i)) for i in range(3)]
+        edges = structures.CompactEdgeSet("g", nodes, array.array("q", [0, 1]),
+                                          array.array("q", [1, 2]))
+        return structures.Graph(nodes, edges, uid="g")
+
+    def test_edges_made_on_demand(self):
+        graph = self.instance()
+        n0, n1, n2 = sorted(graph.nodes, key=lambda n: n.uid)
+        expected = {structures.Edge(n0, n1, uid="g#e0"),
+                    structures.Edge(n1, n2, uid="g#e1")}
+        self.assertEqual(graph.edges, expected)
+        self.assertEqual(graph, structures.Graph(graph.nodes, expected, uid="g"))
+        self.assertEqual(hash(graph.edges), hash(frozenset(expected)))
+        self.assertEqual([e.uid for e in graph.edges], ["g#e0", "g#e1"])
+        self.assertEqual(graph.edges[-1].uid, "g#e1")
+
+    def test_references(self):
+        self.assertEqual({obj.uid for obj in structures.iter_references(self.instance())},
+                         {"n0", "n1", "n2"})
+
+class AdjacencyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [structures.Node(i, uid=uid)
+                                          for i, uid in enumerate("abcd")]
+        def edge(uid, orig, dest):
+            return structures.Edge(orig, dest, uid=uid)
+        self.edges = [edge("e0", self.a, self.b), edge("e1", self.a, self.c),
+                      edge("e2", self.c, self.a), edge("e3", self.a, self.b),
+                      edge("e4", self.b, self.d)]
+        self.graph = structures.Graph([self.c, self.b, self.a], self.edges,
+                                      uid="g")
+
+    def test_ids_follow_uids(self):
+        adjacency = self.graph.adjacency
+        self.assertIs(adjacency, self.graph.adjacency)
+        self.assertEqual(len(adjacency), 3)
+        self.assertEqual(adjacency.nodes, [self.a, self.b, self.c])
+        self.assertEqual([adjacency.id(n) for n in adjacency.nodes], [0, 1, 2])
+        with self.assertRaises(KeyError):
+            adjacency.id(self.d)
+
+    def test_neighbors(self):
+        adjacency = self.graph.adjacency
+        self.assertEqual(list(adjacency.successors(self.a)),
+                         [self.b, self.c, self.b])
+        self.assertEqual(list(adjacency.predecessors(self.b)), [self.a, self.a])
+        self.assertEqual(list(adjacency.successor_ids(2)), [0])
+        self.assertEqual([e.uid for e in adjacency.out_edges(self.a)],
+                         ["e0", "e1", "e3"])
+        self.assertEqual([e.uid for e in adjacency.in_edges(self.a)], ["e2"])
+        # e4 leads out of the graph, so it's left out
+        self.assertEqual([(adjacency.out_degree(n), adjacency.in_degree(n),
+                           adjacency.degree(n)) for n in adjacency.nodes],
+                         [(3, 1, 4), (0, 2, 2), (1, 1, 2)])
+
+    def test_shared_nodes(self):
+        subgraph = structures.Graph([self.c, self.a], self.edges, uid="h")
+        self.assertEqual(subgraph.adjacency.id(self.c), 1)
+        self.assertEqual(self.graph.adjacency.id(self.c), 2)
+        self.assertEqual(list(subgraph.adjacency.successors(self.a)), [self.c])
+
+    def test_literal_nodes(self):
+        edges = [structures.Edge(1, 2.5, uid="e0"), structures.Edge(self.a, 1, uid="e1"),
+                 structures.Edge(2.5, 7, uid="e2")]
+        graph = structures.Graph([2.5, 1, self.a], edges, uid="g")
+        adjacency = graph.adjacency
+        self.assertEqual(adjacency.nodes, [self.a, 2.5, 1])
+        self.assertEqual(list(adjacency.successors(1)), [2.5])
+        self.assertEqual(list(adjacency.predecessors(1)), [self.a])
+        self.assertEqual(adjacency.degree(2.5), 1)
+        with self.assertRaises(KeyError):
+            adjacency.id(7)
+
+    def test_rebuilt_after_untablify(self):
+        adjacency = self.graph.adjacency
+        self.graph.untablify(structures.ObjectTable())
+        self.assertIsNot(self.graph.adjacency, adjacency)
+
+class NodeTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Node(structures.Null, uid="n")
 
-class EdgeTestCase(DataStructuresTestMixin, unittest.TestCase):
+class EdgeTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Edge(structures.Node(0, uid="n0"),
                                structures.Node(1, uid="n1"),
                                uid="e")
 
-class TreeTestCase(DataStructuresTestMixin, unittest.TestCase):
+class TreeTestCase(CompactDataStructuresTestMixin, unittest.TestCase):
     def instance(self):
         return structures.Tree(5, children=[structures.Null,
                                                 structures.Null],
                                    uid="tree")
 
+class TreeMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        #        root
+        #       /  |  \
+        #      a  Null  b
+        #     / \
+        #    c   d
+        Tree = structures.Tree
+        self.c, self.d = Tree(3, uid="c"), Tree(4, uid="d", children=[structures.Null])
+        self.a = Tree(1, uid="a", children=[self.c, self.d])
+        self.b = Tree(2, uid="b")
+        self.root = Tree(0, uid="root", children=[self.a, structures.Null, self.b])
+
+    def test_metrics(self):
+        self.assertEqual((self.root.size(), self.root.height(), self.root.width(),
+                          self.root.leaf_count()), (5, 3, 3, 3))
+        self.assertEqual((self.a.size(), self.a.height(), self.a.width(),
+                          self.a.leaf_count()), (3, 2, 2, 2))
+        self.assertEqual((self.d.size(), self.d.height(), self.d.width(),
+                          self.d.leaf_count()), (1, 1, 1, 1))
+
+    def test_invalidation(self):
+        self.assertEqual(self.root.size(), 5)
+        self.c.children.append(structures.Tree(5))
+        self.assertEqual(self.root.size(), 5)  # still cached
+        for node in (self.c, self.a, self.root):
+            node.invalidate_metrics()
+        self.assertEqual((self.root.size(), self.root.height()), (6, 4))
+
+    def test_shared_subtree(self):
+        root = structures.Tree(0, children=[self.a, self.a])
+        self.assertEqual((root.size(), root.leaf_count()), (7, 4))
+
+    def test_deep_tree(self):
+        tree = structures.Tree(0)
+        for i in range(100000):
+            tree = structures.Tree(i, children=[tree])
+        self.assertEqual((tree.height(), tree.size(), tree.width()),
+                         (100001, 100001, 1))
+
+    def test_cycle(self):
+        self.c.children.append(self.root)
+        with self.assertRaises(ValueError):
+            self.root.height()
+
+class FingerprintTestCase(unittest.TestCase):
+
+    def _tree(self, values, prefix="t"):
+        # A chain of tree nodes holding `values`, top first
+        node = structures.Null
+        for i, value in reversed(list(enumerate(values))):
+            node = structures.Tree(value, children=[node],
+                                   uid="{}{}".format(prefix, i))
+        return node
+
+    def test_same_content_same_fingerprint(self):
+        first, second = self._tree([1, 2, 3]), self._tree([1, 2, 3], prefix="u")
+        self.assertIsInstance(first.fingerprint, bytes)
+        self.assertEqual(first.fingerprint, second.fingerprint)
+        self.assertNotEqual(first.fingerprint, self._tree([1, 2, 4]).fingerprint)
+        self.assertNotEqual(first.fingerprint, self._tree([1, 2]).fingerprint)
+        self.assertNotEqual(first.fingerprint, self._tree([1, 2.0, 3]).fingerprint)
+
+    def test_types_and_metadata_count(self):
+        node = structures.Node(1, uid="n")
+        self.assertNotEqual(node.fingerprint,
+                            structures.Pointer(1, uid="n").fingerprint)
+        self.assertNotEqual(node.fingerprint,
+                            structures.Node(1, uid="n", metadata={"a": 1}).fingerprint)
+        self.assertNotEqual(structures.String("a", uid="s").fingerprint,
+                            structures.String("b", uid="s").fingerprint)
+
+    def test_typed_and_list_arrays_match(self):
+        self.assertEqual(
+            structures.Array([1, 2], uid="a").fingerprint,
+            structures.Array(structures.pack_numbers([1, 2]), uid="b").fingerprint)
+
+    def test_unordered_fields(self):
+        nodes = [structures.Node(i, uid="n{}".format(i)) for i in range(5)]
+        self.assertEqual(structures.Graph(nodes, [], uid="g").fingerprint,
+                         structures.Graph(reversed(nodes), [], uid="h").fingerprint)
+
+    def test_cycle(self):
+        a = structures.Pointer(structures.Null, uid="a")
+        b = structures.Pointer(a, uid="b")
+        a.referent = b
+        self.assertNotEqual(a.fingerprint, b.fingerprint)
+        c = structures.Pointer(structures.Null, uid="a")
+        d = structures.Pointer(c, uid="b")
+        c.referent = d
+        self.assertEqual(a.fingerprint, c.fingerprint)
+
+    def _ring(self, values):
+        # Arrays of pointers and a string, where each pointer points to an array
+        pointers = [structures.Pointer(structures.Null, uid="p{}".format(i))
+                    for i in range(len(values))]
+        rings = [structures.Array(pointers[i:] + pointers[:i] +
+                                  [structures.String(value, uid="s{}".format(i))],
+                                  uid="r{}".format(i))
+                 for i, value in enumerate(values)]
+        for i, pointer in enumerate(pointers):
+            pointer.referent = rings[(i + 1) % len(rings)]
+        return pointers, rings
+
+    def test_cycle_order_does_not_matter(self):
+        first, first_rings = self._ring("abc")
+        second, second_rings = self._ring("abc")
+        for obj in first + first_rings:
+            obj.fingerprint
+        for obj in reversed(second_rings + second):
+            obj.fingerprint
+        self.assertEqual([obj.fingerprint for obj in first + first_rings],
+                         [obj.fingerprint for obj in second + second_rings])
+        # The whole cycle counts, not just the uids in it
+        third, _ = self._ring("abd")
+        self.assertNotEqual(first[0].fingerprint, third[0].fingerprint)
+
+    def test_deep_chain(self):
+        self.assertEqual(self._tree(range(100000)).fingerprint,
+                         self._tree(range(100000), prefix="u").fingerprint)
+
+    def test_invalidation(self):
+        tree = self._tree([1, 2])
+        before = tree.fingerprint
+        tree.data = 5
+        self.assertEqual(tree.fingerprint, before)
+        tree.invalidate_fingerprint()
+        self.assertNotEqual(tree.fingerprint, before)
+
 class ObjectTableTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -72,16 +443,80 @@ class ObjectTableTestCase(unittest.TestCase):
         self.assertIn(structures.ObjectTableReference(structures.Null.uid),
                       self.obj_tab)
 
-    def test_keys_must_be_object_table_references(self):
+    def test_keys_must_be_uids(self):
         obj = structures.Widget(uid="some_kinda_widget")
         with self.assertRaises(TypeError):
-            self.obj_tab[obj.uid] = obj
+            self.obj_tab[obj] = obj
         # make sure the key didn't go in before the error got thrown
         self.assertNotIn(obj.uid, self.obj_tab)
 
+    def test_references_and_uids_are_interchangeable(self):
+        obj = structures.Widget(uid="some_kinda_widget")
+        ref = structures.ObjectTableReference(obj.uid)
+        self.obj_tab[ref] = obj
+        self.assertIs(self.obj_tab[obj.uid], obj)
+        self.assertIs(self.obj_tab[ref], obj)
+        self.assertEqual(hash(ref), hash(obj))
+        self.assertEqual(ref.uid, obj.uid)
+        # The table keeps the plain uid, not the reference
+        key, = (key for key in self.obj_tab if key == obj.uid)
+        self.assertIs(type(key), str)
+
+    def test_reference_pickling(self):
+        ref = structures.ObjectTableReference("r")
+        loaded = pickle.loads(pickle.dumps(ref))
+        self.assertIs(type(loaded), structures.ObjectTableReference)
+        self.assertEqual(loaded.uid, "r")
+
     def test_getuid_convenience_method(self):
         self.assertEqual(self.obj_tab.getuid(structures.Null.uid),
                          structures.Null)
 
+    def _add(self, obj):
+        self.obj_tab[structures.ObjectTableReference(obj.uid)] = obj
+        return obj
+
+    def test_index_by_type(self):
+        w1 = self._add(structures.Widget(uid="w1"))
+        t = self._add(structures.Tree(0, uid="t"))
+        w2 = self._add(structures.Widget(uid="w2"))
+        self.assertEqual(self.obj_tab.by_type(structures.Widget), [w1, w2])
+        self.assertEqual(self.obj_tab.by_type(structures.Tree), [t])
+        self.assertEqual(self.obj_tab.by_type(structures.DataStructure), [])
+        self.assertEqual(self.obj_tab.by_type(structures.DataStructure, subclasses=True),
+                         [structures.Null, w1, w2, t])
+        # Replacing and deleting objects updates the index
+        t2 = self._add(structures.Widget(uid="t"))
+        self.assertEqual(self.obj_tab.by_type(structures.Tree), [])
+        del self.obj_tab[structures.ObjectTableReference("w1")]
+        self.assertEqual(self.obj_tab.by_type(structures.Widget), [w2, t2])
+
+    def test_index_by_var(self):
+        w = self._add(structures.Widget(uid="w"))
+        self.obj_tab.index_var("x", structures.ObjectTableReference("w"))
+        self.assertIs(self.obj_tab.by_var("x"), w)
+        del self.obj_tab[structures.ObjectTableReference("w")]
+        with self.assertRaises(KeyError):
+            self.obj_tab.by_var("x")
+
+    def test_index_by_metadata(self):
+        a = self._add(structures.Widget(uid="a", metadata={"color": "red"}))
+        b = self._add(structures.Widget(uid="b", metadata={"color": "blue"}))
+        self._add(structures.Widget(uid="c"))
+        self.assertEqual(self.obj_tab.by_metadata("color"), [a, b])
+        self.assertEqual(self.obj_tab.by_metadata("color", "blue"), [b])
+        self.assertEqual(self.obj_tab.by_metadata("size"), [])
+
+    def test_unindexed(self):
+        table = structures.ObjectTable(indexed=False)
+        table[structures.ObjectTableReference("w")] = structures.Widget(uid="w")
+        with self.assertRaises(TypeError):
+            table.by_type(structures.Widget)
+
+    def test_indexes_survive_pickling(self):
+        w = self._add(structures.Widget(uid="w"))
+        table = pickle.loads(pickle.dumps(self.obj_tab))
+        self.assertEqual(table.by_type(structures.Widget), [w])
+
 if __name__ == "__main__":
     unittest.main()
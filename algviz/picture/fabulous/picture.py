@@ -243,15 +243,11 @@ class TreePicture(InternalPicture):
         super().__init__(tree_root, width, height, **kwargs)
 
     def _width_estimate(self, root):
+        # Each leaf gets the same amount of room.  leaf_count() is cached on
+        # the tree, so this is cheap to call for every subtree.
         if root is structures.Null:
             return 0
-        if root.is_leaf():
-            return 2*self.node_width+self.node_sep
-        width = 0
-        for child in root.children:
-            child_width = self._width_estimate(child)
-            width += child_width
-        return width
+        return root.leaf_count()*(2*self.node_width+self.node_sep)
 
     def _determine_height_coef(self, x):
         """expirementally determined function to provide larger trees with smaller relative heights. Cuts off some white space at bottom."""
@@ -267,33 +263,25 @@ class TreePicture(InternalPicture):
         return c*tree_height*(2*self.node_width+self.edge_length) - self.edge_length
             
     def _layout_nodes(self, parent, level_roots):
-        sub_widths = []
-        for subtree in level_roots:
-            if subtree is structures.Null:
-                sub_widths.append(0)
-                continue
-            sub_width = self.width_dict.get(subtree, self._width_estimate(subtree))
-            if subtree in self.width_dict:
-                sub_widths.append(self.width_dict[subtree])
-            else:
-                sub_width = self._width_estimate(subtree)
-                self.width_dict[subtree] = sub_width
-                sub_widths.append(sub_width)
-        level_length = sum(sub_widths)
-        y = parent.center[1] +self.edge_length
-        far_x_bound = parent.center[0] - level_length/2
-        for i in range(0, len(level_roots)):
-            subtree = level_roots[i]
-            sub_width = sub_widths[i]
-            x = far_x_bound + sub_width/2
-            far_x_bound += sub_width
-            if subtree is not structures.Null:
-                new_node = TreePicture.Tree((x,y), subtree.data,
-                                                self.node_width, self.node_height,
-                                                self.node_shape, self.style)
-                parent.add_child(new_node)
-                if not subtree.is_leaf():
-                    self._layout_nodes(new_node, subtree.children)
+        # An explicit stack of (parent node, subtrees below it), so deep
+        # trees don't hit the recursion limit
+        stack = [(parent, level_roots)]
+        while stack:
+            parent, level_roots = stack.pop()
+            sub_widths = [self._width_estimate(subtree) for subtree in level_roots]
+            level_length = sum(sub_widths)
+            y = parent.center[1] +self.edge_length
+            far_x_bound = parent.center[0] - level_length/2
+            for subtree, sub_width in zip(level_roots, sub_widths):
+                x = far_x_bound + sub_width/2
+                far_x_bound += sub_width
+                if subtree is not structures.Null:
+                    new_node = TreePicture.Tree((x,y), subtree.data,
+                                                    self.node_width, self.node_height,
+                                                    self.node_shape, self.style)
+                    parent.add_child(new_node)
+                    if not subtree.is_leaf():
+                        stack.append((new_node, subtree.children))
 
     def _node_generator(self):
         node_queue = [self.root_node]
@@ -306,7 +294,6 @@ class TreePicture(InternalPicture):
     def draw(self):
         if self.is_drawn():
             return
-        self.width_dict = {}
         root_x = self.width/2
         root_y = self.node_height/2+self.node_sep
         root_center = (root_x, root_y)
@@ -30,15 +30,17 @@ def make_svg(snapshots, user_config):
 def _get_object_to_draw(snapshots, user_config):
     # TODO - snapshots should really be an OrderedDict, and users should be
     # able to name their snapshots
+    # `snapshots` may be a snapshot_index.LazySnapshotSequence, in which case
+    # only the chosen snapshot is decoded.
     if _keys.snapshot not in user_config and len(snapshots) != 1:
-        raise InvalidUserCOnfigError("Specify {} to choose a snapshot ({} available)"
+        raise InvalidUserConfigError("Specify {} to choose a snapshot ({} available)"
                                      .format(_keys.snapshot, len(snapshots)))
     snap_key = int(user_config.get(_keys.snapshot, 0))
     try:
         snapshot = snapshots[snap_key]
     except (KeyError, IndexError):
         raise InvalidUserConfigError("{}={} - no such snapshot".format(
-            _keys.snapshot, snapshot))
+            _keys.snapshot, snap_key))
     return _choose_object_from_snapshot(snapshot, user_config)
 
     obj = user_config.get(_keys.var, user_config.get(_keys.uid))
@@ -294,7 +294,8 @@ class CompositeLayout(AbstractLayout):
 class CircularGraphLayout(AbstractLayout):
     def __init__(self, graph, **kwargs):
         super().__init__(**kwargs)
-        self.node_layouts = [self.make_child(node) for node in graph.nodes]
+        adjacency = graph.adjacency
+        self.node_layouts = [self.make_child(node) for node in adjacency.nodes]
         if not self.node_layouts:
             self.finalize(width=self.svg_hint.margin, height=self.svg_hint.margin)
             return
@@ -308,12 +309,10 @@ class CircularGraphLayout(AbstractLayout):
             x = radius * math.cos(angle)
             y = radius * math.sin(angle)
             self.add_child(node_layout, Coord(x, y), anchor=Anchor.center)
-        if graph.edges:
-            to_elt = {node: layout.node_element
-                      for node, layout in zip(graph.nodes, self.node_layouts)}
-            for edge in graph.edges:
-                src, dst = edge.orig, edge.dest
-                self.add_decoration(elements.StraightArrow(to_elt[src], to_elt[dst]))
+        elts = [layout.node_element for layout in self.node_layouts]
+        for src in range(len(adjacency)):
+            for dst in adjacency.successor_ids(src):
+                self.add_decoration(elements.StraightArrow(elts[src], elts[dst]))
         total_diameter = 2 * (radius + node_radius)
         self.finalize(width=total_diameter, height=total_diameter,
                       ref_point=Coord(0, 0), ref_anchor=Anchor.center)
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+"""
+Rough timings for the parser and the output interface.
+
+Run with --help for usage information.  Each benchmark prints one line per
+measurement.  Times are the best of several runs.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from algviz.parser import binary, json_objects, snapshot_index, structures
+
+_EXAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "example_objects")
+
+benchmarks = {}
+
+def benchmark(name):
+    """Register the decorated function as the benchmark called `name`"""
+    def _decorate(f):
+        benchmarks[name] = f
+        return f
+    return _decorate
+
+def best_time(f, repeat=5):
+    """Return the shortest of `repeat` timings of `f()`, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report(label, seconds, count=None, unit="item"):
+    line = "{:<40} {:>10.2f} ms".format(label, seconds * 1000)
+    if count:
+        line += "  ({:.2f} us/{})".format(seconds / count * 1e6, unit)
+    print(line)
+
+def example_path(filename):
+    return os.path.join(_EXAMPLE_DIR, filename)
+
+def read_example(filename):
+    with open(example_path(filename), "r") as f:
+        return f.read()
+
+@benchmark("decode")
+def bench_decode(repeat):
+    text = read_example("huge_qs_tree.json")
+    report("decode huge_qs_tree.json",
+           best_time(lambda: json_objects.reads(text), repeat))
+    report("decode huge_qs_tree.json, trusted",
+           best_time(lambda: json_objects.reads(text, trusted=True), repeat))
+    raw = [json_objects.parse(span.text)
+           for span in json_objects.SnapshotScanner.for_text(text)]
+    report("validate huge_qs_tree.json", best_time(
+        lambda: [json_objects.validate_snapshot(s) for s in raw], repeat))
+
+@benchmark("binary")
+def bench_binary(repeat):
+    text = read_example("huge_qs_tree.json")
+    raw = [json_objects.parse(span.text)
+           for span in json_objects.SnapshotScanner.for_text(text)]
+    data = binary.dumps(raw)
+    compact = json.dumps(raw, separators=(",", ":"))
+    print("huge_qs_tree.json: {} bytes as JSON, {} as compact JSON, {} as binary"
+          .format(len(text), len(compact), len(data)))
+    report("decode JSON", best_time(lambda: json_objects.reads(text), repeat))
+    report("decode binary", best_time(lambda: binary.loads(data), repeat))
+    report("decode JSON, trusted",
+           best_time(lambda: json_objects.reads(text, trusted=True), repeat))
+    report("decode binary, trusted",
+           best_time(lambda: binary.loads(data, trusted=True), repeat))
+    report("parse JSON (no decoding)",
+           best_time(lambda: json_objects.parse(text), repeat))
+    report("parse binary (no decoding)", best_time(
+        lambda: [binary.decode_value(payload)
+                 for payload in binary.iter_payloads(io.BytesIO(data))], repeat))
+
+@benchmark("deep_chain")
+def bench_deep_chain(repeat, depth=100000):
+    def _chain():
+        # json.loads can't parse this deep, so build the objects directly
+        chain = {json_objects.Tokens.TYPE: json_objects.Tokens.POINTER_T,
+                 json_objects.Tokens.DATA: 0}
+        for _ in range(depth):
+            chain = {json_objects.Tokens.TYPE: json_objects.Tokens.POINTER_T,
+                     json_objects.Tokens.DATA: chain}
+        return chain
+    # decode_snapshot consumes its input, so time the construction separately
+    build = best_time(_chain, repeat)
+    total = best_time(lambda: json_objects.decode_snapshot(_chain()), repeat)
+    report("decode {}-deep pointer chain".format(depth), total - build,
+           depth, "level")
+
+@benchmark("random_access")
+def bench_random_access(repeat, length=10000):
+    trace = [[{"T": "array", "uid": "a", "var": "arr", "data": list(range(i, i + 50))}]
+             for i in range(length)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.json")
+        with open(path, "w") as f:
+            json.dump(trace, f, indent=2)
+        report("index {} snapshots".format(length),
+               best_time(lambda: snapshot_index.SnapshotIndex.build(path), repeat))
+        snapshots = snapshot_index.LazySnapshotSequence(path)
+        for i in (0, length - 1000):
+            report("lazy snapshot {}".format(i),
+                   best_time(lambda: snapshots[i], repeat))
+        def _eager():
+            with open(path, "r") as f:
+                return json_objects.read(f)[length - 1000]
+        report("eager snapshot {}".format(length - 1000), best_time(_eager, 1))
+
+@benchmark("parallel")
+def bench_parallel(repeat, length=100):
+    trace = [_binary_tree(500) for i in range(length)]
+    text = json.dumps(trace)
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        report("decode {} snapshots, {} workers".format(length, workers),
+               best_time(lambda: json_objects.decode_json(text, workers=workers),
+                         repeat))
+
+def _binary_tree(size, value=lambda j: j):
+    return [{"T": "treenode", "uid": "t{}".format(j), "data": value(j),
+             "children": ["t{}".format(2 * j + 1), "t{}".format(2 * j + 2)]
+             if 2 * j + 2 < size else []}
+            for j in range(size)]
+
+def peak_memory(f):
+    """Return `(result of f(), peak bytes allocated while running it)`"""
+    tracemalloc.start()
+    try:
+        result = f()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@benchmark("delta")
+def bench_delta(repeat, length=2000, size=200):
+    # One leaf changes per step, written as full snapshots and as deltas
+    traces = {
+        "full": [_binary_tree(size, lambda j: i if j == size - 1 else j)
+                 for i in range(length)],
+        "delta": [_binary_tree(size)] + [
+            [{"T": "delta"},
+             {"T": "treenode", "uid": "t{}".format(size - 1), "data": i}]
+            for i in range(1, length)],
+    }
+    for label in ("full", "delta"):
+        text = json.dumps(traces.pop(label))
+        snapshots, peak = peak_memory(lambda: json_objects.decode_json(text))
+        del snapshots
+        print("{} snapshots of {} nodes as {}: {:.1f} MB of text, {:.1f} MB peak"
+              .format(length, size, label, len(text) / 1e6, peak / 1e6))
+        report("decode {} trace".format(label),
+               best_time(lambda: json_objects.decode_json(text), 1),
+               length, "snapshot")
+
+@benchmark("lazy")
+def bench_lazy(repeat, size=100000):
+    # Draw a small tree out of a snapshot that holds a much bigger one
+    text = json.dumps(_binary_tree(size) + [
+        {"T": "treenode", "uid": "small", "var": "small", "data": 0,
+         "children": ["t{}".format(size - 1)]}])
+    def _decode(**kwargs):
+        snapshot = json_objects.decode_snapshot_text(text, **kwargs)
+        return snapshot.names["small"]
+    for label, kwargs in [("eager", {}), ("lazy", {"lazy": True}),
+                          ("pruned", {"root_vars": ["small"]})]:
+        report("decode {}-node snapshot, {}".format(size, label),
+               best_time(lambda: _decode(**kwargs), repeat))
+
+@benchmark("memory")
+def bench_memory(repeat, size=100000):
+    # Memory held by the decoded objects of one big snapshot, per object
+    raw_snapshots = {
+        "treenode": _binary_tree(size),
+        "array": [{"T": "array", "uid": "a{}".format(j), "data": [j]}
+                  for j in range(size)],
+        "ptr": [{"T": "ptr", "uid": "p{}".format(j), "data": j}
+                for j in range(size)],
+    }
+    for type_, objects in raw_snapshots.items():
+        raw = json_objects.parse(json.dumps(objects))
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        snapshot = json_objects.decode_snapshot(*raw)
+        del raw
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print("{:<40} {:>10.1f} bytes/object".format(
+            "{} {} objects".format(len(snapshot.obj_table) - 1, type_),
+            used / size))
+
+@benchmark("typed_array")
+def bench_typed_array(repeat, length=1000000):
+    # One big array of numbers, stored as a list and as an array.array
+    numbers = [j * 1000 for j in range(length)]
+    for label, make_data in [("list", lambda: list(numbers)),
+                             ("typed", lambda: structures.pack_numbers(numbers))]:
+        arr, peak = peak_memory(lambda: structures.Array(make_data(), uid="a"))
+        print("{:<40} {:>10.1f} bytes/item".format(
+            "{}-item array, {}".format(length, label), peak / length))
+        table = structures.ObjectTable()
+        report("untablify {}-item array, {}".format(length, label),
+               best_time(lambda: arr.untablify(table), repeat), length)
+        report("slice {}-item array, {}".format(length, label),
+               best_time(lambda: arr[length // 2:], repeat))
+
+@benchmark("fingerprint")
+def bench_fingerprint(repeat, size=100000):
+    # Compare two copies of a big tree by fingerprint and with ==
+    text = json.dumps(_binary_tree(size))
+    def _decode_root():
+        return json_objects.decode_snapshot_text(text).obj_table.getuid("t0")
+    first, second = _decode_root(), _decode_root()
+    report("fingerprint {}-node tree".format(size),
+           best_time(lambda: _decode_root().fingerprint, 1) -
+           best_time(_decode_root, 1), size, "node")
+    report("compare {}-node trees by fingerprint".format(size),
+           best_time(lambda: first.fingerprint == second.fingerprint, repeat))
+    report("compare {}-node trees with ==".format(size),
+           best_time(lambda: first == second, repeat))
+
+@benchmark("diff")
+def bench_diff(repeat, size=100000):
+    # Diff two snapshots of a big tree that differ in one leaf
+    trace = [_binary_tree(size),
+             [{"T": "delta"},
+              {"T": "treenode", "uid": "t{}".format(size - 2), "data": -1}]]
+    first, second = json_objects.decode_json(json.dumps(trace))
+    roots = ["t0"]
+    report("first diff of {}-node tree".format(size), best_time(
+        lambda: structures.diff_snapshots(first, second, roots=roots), 1))
+    report("diff again, fingerprints known", best_time(
+        lambda: structures.diff_snapshots(first, second, roots=roots), repeat))
+
+@benchmark("history")
+def bench_history(repeat, length=2000, size=200):
+    # Find when one node changed, from a change history or by decoding
+    trace = [_binary_tree(size)] + [
+        [{"T": "delta"},
+         {"T": "treenode", "uid": "t{}".format(i % size), "data": -i}]
+        for i in range(1, length)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.json")
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        report("build history of {} snapshots".format(length), best_time(
+            lambda: snapshot_index.ChangeHistory.build(path), 1), length, "snapshot")
+        snapshot_index.ChangeHistory.for_trace(path)
+        report("load history and query", best_time(
+            lambda: snapshot_index.ChangeHistory.for_trace(path).snapshots("t5"),
+            repeat))
+        def _scan():
+            with open(path, "r") as f:
+                snapshots = json_objects.iter_snapshots(f)
+                previous = None
+                found = []
+                for i, snapshot in enumerate(snapshots):
+                    node = snapshot.obj_table.getuid("t5")
+                    if previous is None or node.data != previous.data:
+                        found.append(i)
+                    previous = node
+                return found
+        report("decode and scan instead", best_time(_scan, 1))
+
+@benchmark("table_index")
+def bench_table_index(repeat, size=100000):
+    # Find the one graph among many other objects
+    snapshot = json_objects.decode_snapshot(*json_objects.parse(json.dumps(
+        _binary_tree(size) + [{"T": "graph", "uid": "g", "nodes": [], "edges": []}])))
+    table = snapshot.obj_table
+    report("scan {} objects for a graph".format(size), best_time(
+        lambda: [obj for obj in table.values()
+                 if isinstance(obj, structures.Graph)], repeat))
+    report("look up graphs by type", best_time(
+        lambda: table.by_type(structures.Graph), repeat))
+
+@benchmark("adjacency")
+def bench_adjacency(repeat, size=10000, degree=5, lookups=100):
+    # Neighbors of a few nodes, by scanning the edges and from the index
+    rng = random.Random(0)
+    nodes = [structures.Node(j, uid="n{}".format(j)) for j in range(size)]
+    edges = [structures.Edge(nodes[j], rng.choice(nodes), uid="e{}.{}".format(j, k))
+             for j in range(size) for k in range(degree)]
+    graph = structures.Graph(nodes, edges, uid="g")
+    wanted = nodes[:lookups]
+    report("scan edges for {} nodes' successors".format(lookups), best_time(
+        lambda: [[e.dest for e in graph.edges if e.orig is node] for node in wanted],
+        1), lookups, "node")
+    report("build adjacency, {} edges".format(len(edges)),
+           best_time(lambda: structures.Adjacency(graph), repeat))
+    adjacency = graph.adjacency
+    report("look up {} nodes' successors".format(lookups), best_time(
+        lambda: [list(adjacency.successors(node)) for node in wanted], repeat),
+           lookups, "node")
+
+@benchmark("compact_edges")
+def bench_compact_edges(repeat, size=10000, degree=10):
+    # Memory and time to decode a graph whose edges have no uids, compared
+    # with the same edges given uids (which makes them separate objects)
+    rng = random.Random(0)
+    ends = [(j, rng.randrange(size)) for j in range(size) for _ in range(degree)]
+    def _graph(edge_uids):
+        edges = [{"T": "edge", "from": "n{}".format(orig), "to": "n{}".format(dest)}
+                 for orig, dest in ends]
+        if edge_uids:
+            for k, edge in enumerate(edges):
+                edge["uid"] = "e{}".format(k)
+        nodes = [{"T": "node", "uid": "n{}".format(j), "data": j} for j in range(size)]
+        return [{"T": "graph", "uid": "g", "nodes": [n["uid"] for n in nodes],
+                 "edges": edges}] + nodes
+    for label, edge_uids in [("Edge objects", True), ("compact", False)]:
+        text = json.dumps(_graph(edge_uids))
+        raw = json_objects.parse(text)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        snapshot = json_objects.decode_snapshot(*raw)
+        del raw
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print("{:<40} {:>10.1f} MB".format(
+            "{} edges, {}".format(len(ends), label), used / 1e6))
+        report("decode {} edges, {}".format(len(ends), label), best_time(
+            lambda: json_objects.decode_snapshot_text(text), 1), len(ends), "edge")
+        del snapshot
+
+@benchmark("intern")
+def bench_intern(repeat):
+    # Decoding and table lookups, which are keyed directly on the uids
+    text = read_example("huge_qs_tree.json")
+    snapshots = json_objects.reads(text, trusted=True)
+    report("decode huge_qs_tree.json, trusted",
+           best_time(lambda: json_objects.reads(text, trusted=True), repeat),
+           len(snapshots), "snapshot")
+    table = snapshots[-1].obj_table
+    uids = list(table)
+    objects = list(table.values())
+    report("look up {} objects by uid".format(len(uids)),
+           best_time(lambda: [table[uid] for uid in uids], repeat), len(uids))
+    report("hash {} objects".format(len(objects)),
+           best_time(lambda: set(objects), repeat), len(objects))
+
+@benchmark("output")
+def bench_output(repeat, length=10000, count=10):
+    # Emitting a trace of `count` snapshots of a list from the interface, to
+    # a line-buffered file like stdout on a terminal
+    from algviz.interface import high_level, output
+    data = list(range(length))
+    def _emit(**kwargs):
+        with tempfile.TemporaryFile("w", buffering=1) as f:
+            outman = output.OutputManager(f, **kwargs)
+            for _ in range(count):
+                high_level.show(data, var="data", _out=outman)
+            outman.end()
+    for label, kwargs in [("unbuffered", {"buffered": False}),
+                          ("buffered", {}),
+                          ("buffered, compact", {"compact": True}),
+                          ("background", {"background": True})]:
+        report("emit {} items, {}".format(length * count, label),
+               best_time(lambda: _emit(**kwargs), repeat), length * count)
+
+@benchmark("sampling")
+def bench_sampling(repeat, calls=100000, length=100):
+    # The cost of calls to show that a sampling policy skips
+    from algviz.interface import high_level, output, sampling
+    data = list(range(length))
+    def _show_all(policy):
+        outman = output.OutputManager(io.StringIO(), sampling=policy)
+        for _ in range(calls):
+            high_level.show(data, _out=outman)
+        outman.end()
+    for label, policy in [("every 1000th", lambda: sampling.EveryNth(1000)),
+                          ("at most 10 per second", lambda: sampling.RateLimit(10)),
+                          ("on change", lambda: sampling.OnChange())]:
+        report("show {} times, {}".format(calls, label),
+               best_time(lambda: _show_all(policy()), repeat), calls, "call")
+
+@benchmark("delta_output")
+def bench_delta_output(repeat, steps=20, length=100000):
+    # Size and time of a trace of a flat array of ints, one cell of which
+    # changes at each step, written as full snapshots and as deltas
+    from algviz.interface import high_level, output
+    def _emit(delta, steps=steps):
+        data = list(range(length))
+        f = io.StringIO()
+        outman = output.OutputManager(f, delta=delta)
+        for step in range(steps):
+            data[step % length] = -step
+            high_level.show(data, var="data", _out=outman)
+        outman.end()
+        return len(f.getvalue())
+    for label, delta in [("full", False), ("delta", True)]:
+        # Leave out the first snapshot, which is always in full
+        size = _emit(delta) - _emit(delta, steps=1)
+        print("{:<40} {:>10.1f} KB per step".format(
+            "{} items, {}".format(length, label), size / (steps - 1) / 1e3))
+        report("emit {} steps, {}".format(steps, label),
+               best_time(lambda: _emit(delta), repeat), steps, "step")
+
+@benchmark("dispatch")
+def bench_dispatch(repeat, length=1000000):
+    # Emitting a list of ints, which dispatches once per item
+    from algviz.interface import high_level, output
+    data = list(range(length))
+    def _emit():
+        outman = output.OutputManager(io.StringIO())
+        high_level.show(data, _out=outman)
+        outman.end()
+    report("emit a list of {} ints".format(length),
+           best_time(_emit, repeat), length)
+
+def main():
+    """Run this script with --help for documentation"""
+    parser = argparse.ArgumentParser("Time algviz parsing and output")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="benchmarks to run (default: all).  Choose from: {}"
+                        .format(", ".join(sorted(benchmarks))))
+    parser.add_argument("--repeat", "-n", type=int, default=5,
+                        help="number of runs to take the best time from")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error("no benchmark called {!r}".format(name))
+    for name in args.names or sorted(benchmarks):
+        benchmarks[name](args.repeat)
+
+if __name__ == "__main__":
+    main()
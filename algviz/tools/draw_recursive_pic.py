@@ -5,12 +5,12 @@ import math
 import svgwrite
 import sys
 
-from algviz.parser import json_objects
+from algviz.parser import json_objects, snapshot_index
 from algviz.picture import main as pic_main
 
 def main():
     parser = argparse.ArgumentParser("Draw a picture of an object from JSON")
-    parser.add_argument("infile", type=argparse.FileType("r"),
+    parser.add_argument("infile", type=str,
                         help="input file.  - for stdin")
     parser.add_argument("outfile", type=argparse.FileType("w"),
                         help="output file (to be overwritten).")
@@ -20,14 +20,24 @@ def main():
                         help="var name of object to be drawn.  Takes precedence over UID.")
     parser.add_argument("--module", "-m", default="recursive", type=str,
                         help="algviz submodule to create the drawing")
+    parser.add_argument("--snapshot", "-s", default="0", type=str,
+                        help="index of the snapshot to draw (default 0)")
     args = parser.parse_args()
-    snapshots = json_objects.read(args.infile)
+    if args.infile == "-":
+        snapshots = json_objects.read(sys.stdin)
+    else:
+        # Only the chosen snapshot gets decoded, and only the part of it
+        # reachable from the object being drawn
+        snapshots = snapshot_index.LazySnapshotSequence(
+            args.infile,
+            roots=None if args.var is not None else [args.uid],
+            root_vars=[args.var] if args.var is not None else None)
     config = {"module": args.module}
     if args.var is not None:
         config[pic_main._keys.var] = args.var
     else:
         config[pic_main._keys.uid] = args.uid
-    config[pic_main._keys.snapshot] = "0"
+    config[pic_main._keys.snapshot] = args.snapshot
     print(pic_main.make_svg(snapshots, config), file=args.outfile, end="")
 
 if __name__ == "__main__":
@@ -58,14 +58,11 @@ def main():
     elif args.uid:
         graph = snapshot.obj_table.getuid(args.uid)
     else:
-        # Just search for the first graph we find in the snapshot
-        graph = None
-        for obj in snapshot.obj_table.values():
-            if isinstance(obj, structures.Graph):
-                graph = obj
-                break
-        if graph is None:
+        # Just take the first graph in the snapshot, of any Graph subclass
+        graphs = snapshot.obj_table.by_type(structures.Graph, subclasses=True)
+        if not graphs:
             raise Exception("No graph found in JSON input")
+        graph = graphs[0]
 
     gv_graph = graph_to_pgv(graph)
     gv_graph.layout(prog=args.prog)
@@ -13,6 +13,7 @@ setup(name='algviz',
               "algviz_quicksort_example=algviz.tools.quicksort_tree:main",
               "algviz_rec_draw=algviz.tools.draw_recursive_pic:main",
               "algviz_random_tree=algviz.tools.bin_tree_maker:main",
+              "algviz_benchmark=algviz.tools.benchmark:main",
           ]},
       install_requires=[
           'pygraphviz',